@@ -10,6 +10,8 @@ import torch
 import torch.optim as optim
 import time
 from utils.util import ensure_dir
+from utils.checkpoint_writer import CheckpointWriter, snapshot
+from utils import distributed
 from collections import defaultdict
 from utils.curriculum import Curriculum
 from model import *
@@ -42,6 +44,9 @@ class BaseTrainer:
         self.save_step_minor = config['trainer']['save_step_minor'] if 'save_step_minor' in config['trainer'] else None
         self.log_step = config['trainer']['log_step']
         self.verbosity = config['trainer']['verbosity']
+        # data-parallel training, see utils/distributed.py
+        self.distributed = distributed.is_distributed()
+        self.is_main = distributed.is_main()
         self.with_cuda = config['cuda'] and torch.cuda.is_available()
         if config['cuda'] and not torch.cuda.is_available():
             self.logger.warning(
@@ -228,15 +233,16 @@ class BaseTrainer:
         self.checkpoint_dir = os.path.join(
             config['trainer']['save_dir'], self.name)
         ensure_dir(self.checkpoint_dir)
-        json.dump(
-            config,
-            open(
-                os.path.join(
-                    self.checkpoint_dir,
-                    'config.json'),
-                'w'),
-            indent=4,
-            sort_keys=False)
+        if self.is_main:
+            json.dump(
+                config,
+                open(
+                    os.path.join(
+                        self.checkpoint_dir,
+                        'config.json'),
+                    'w'),
+                indent=4,
+                sort_keys=False)
         self.swa = config['trainer']['swa'] if 'swa' in config['trainer'] else (
             config['trainer']['weight_averaging'] if 'weight_averaging' in config['trainer'] else False)
         if self.swa:
@@ -252,9 +258,15 @@ class BaseTrainer:
             self.alt_save = os.environ['INTERACTIVE_SESSION_ARCHIVE']
         except KeyError:
             self.alt_save = None
+        # checkpoints are written in the background, with at most this many
+        # pending (0 to write them before training continues)
+        self.checkpoint_writer = CheckpointWriter(
+            config['trainer']['save_in_flight'] if 'save_in_flight' in config['trainer'] else 2)
 
         if resume:
             self._resume_checkpoint(resume)
+        # all processes start from the same weights
+        distributed.broadcast_model(self.model)
 
         if 'debug' in config and config['debug']:
             torch.autograd.set_detect_anomaly(True)
@@ -339,11 +351,12 @@ class BaseTrainer:
                 for key in sumLog:
                     sumLog[key] = 0
                 # we'll do it later if we have a validation pass
-                if self.iteration % self.val_step != 0 or self.val_step < 0:
+                if (self.iteration % self.val_step != 0 or self.val_step < 0) and self.is_main:
                     self.train_logger.add_entry(log)
 
-            # VALIDATION
-            if self.iteration % self.val_step == 0 and self.val_step > 0:
+            # VALIDATION (the other processes go on to wait for rank 0 in the
+            # next iteration)
+            if self.iteration % self.val_step == 0 and self.val_step > 0 and self.is_main:
                 val_result = self._valid_epoch()
                 for key, value in val_result.items():
                     if 'metrics' in key:
@@ -396,6 +409,9 @@ class BaseTrainer:
                 #    print()#clear inplace text
                 #self.logger.info('Minor checkpoint saved for iteration '+str(self.iteration))
 
+        # let the last checkpoints finish writing
+        self.checkpoint_writer.wait()
+
     def _train_iteration(self, iteration):
         """
         Training logic for a single iteration
@@ -406,6 +422,7 @@ class BaseTrainer:
 
     def save(self):
         self._save_checkpoint(self.iteration, None)
+        self.checkpoint_writer.wait()
 
     def _save_checkpoint(self, iteration, log, save_best=False, minor=False):
         """
@@ -415,32 +432,34 @@ class BaseTrainer:
         :param log: logging information of the ipoch
         :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
         """
+        if not self.is_main:
+            # the processes are identical, rank 0 saves
+            return
         arch = type(self.model).__name__
+        # the logger keeps getting entries while the checkpoint is written
+        # (when it logs to a file this is just the file and its length)
+        train_logger = copy.copy(self.train_logger)
         state = {
             'arch': arch,
             'iteration': iteration,
-            'logger': self.train_logger,
-            'optimizer': self.optimizer.state_dict(),
+            'logger': train_logger,
+            'optimizer': snapshot(self.optimizer.state_dict()),
             'monitor_best': self.monitor_best,
             'config': self.config
         }
         if 'save_mode' not in self.config or self.config['save_mode'] == 'state_dict':
-            state_dict = self.model.state_dict()
-            for k, v in state_dict.items():
-                state_dict[k] = v.cpu()
-            state['state_dict'] = state_dict
+            state['state_dict'] = snapshot(self.model.state_dict())
             if self.swa:
-                swa_state_dict = self.swa_model.state_dict()
-                for k, v in swa_state_dict.items():
-                    swa_state_dict[k] = v.cpu()
-                state['swa_state_dict'] = swa_state_dict
+                state['swa_state_dict'] = snapshot(self.swa_model.state_dict())
         else:
+            # the model itself is pickled, so it has to be written now
+            self.checkpoint_writer.wait()
             state['model'] = self.model.cpu()
             if self.swa:
                 state['swa_model'] = self.swa_model.cpu()
+            torch.cuda.empty_cache()  # weird gpu memory issue when calling torch.save()
         # if self.swa:
         #    state['swa_n']=self.swa_n
-        torch.cuda.empty_cache()  # weird gpu memory issue when calling torch.save()
         if not minor:
             filename = os.path.join(
                 self.checkpoint_dir,
@@ -450,34 +469,25 @@ class BaseTrainer:
                 self.checkpoint_dir,
                 'checkpoint-latest.pth')
 
-        # print(self.module.state_dict().keys())
-        torch.save(state, filename)
+        links = []
         if not minor:
-            # remove minor as this is the latest
-            filename_late = os.path.join(
-                self.checkpoint_dir, 'checkpoint-latest.pth')
-            try:
-                os.remove(filename_late)
-            except FileNotFoundError:
-                pass
-            # os.link(filename,filename_late) #this way checkpoint-latest
-            # always does have the latest
-            # something is wrong with thel inkgin
-            torch.save(state, filename_late)
-
+            # checkpoint-latest is always the latest (a hard link to it)
+            links.append(os.path.join(
+                self.checkpoint_dir, 'checkpoint-latest.pth'))
             if self.alt_save is not None:
-                torch.save(
-                    state,
-                    os.path.join(
-                        self.alt_save,
-                        'checkpoint-iteration{}.pth'.format(iteration)))
+                links.append(os.path.join(
+                    self.alt_save,
+                    'checkpoint-iteration{}.pth'.format(iteration)))
+
+        if save_best:
+            best_filename = os.path.join(self.checkpoint_dir, 'model_best.pth')
+        else:
+            best_filename = None
+        self.checkpoint_writer.save(state, filename, links, best_filename)
+        if 'model' in state:
+            self.checkpoint_writer.wait()
 
         if save_best:
-            os.rename(
-                filename,
-                os.path.join(
-                    self.checkpoint_dir,
-                    'model_best.pth'))
             self.logger.info(
                 "Saved current best: {} ...".format('model_best.pth'))
         else:
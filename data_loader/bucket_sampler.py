@@ -0,0 +1,114 @@
+import math
+import random
+import numpy as np
+import torch.utils.data
+
+
+# Batches instances of similar width together so collate pads less.
+# The dataset needs an item_widths() giving the (estimated, pre-augmentation)
+# padded width of each instance. Indices are shuffled, cut into pools of
+# pool_size batches, each pool is sorted by width and cut into batches, and
+# then the order of all the batches is shuffled. So every epoch still sees
+# every instance once in a random-ish order, but a batch is made of instances
+# of about the same width.
+# Enable with "bucket_by_width": true in the data_loader config
+# (optionally "bucket_pool_size": number of batches sorted together, default 50)
+# For distributed training (num_replicas processes), every process shuffles
+# with the same seed (plus the epoch, see set_epoch()) and takes every
+# num_replicas-th batch, repeating a few so they all get the same number.
+
+
+class WidthBucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, widths, batch_size, shuffle=True,
+                 pool_size=50, drop_last=False,
+                 num_replicas=1, rank=0, seed=0):
+        self.widths = np.asarray(widths, dtype=np.float32)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def all_batches(self):
+        if self.num_replicas > 1:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            shuffle_batches = rng.shuffle
+        else:
+            rng = np.random
+            shuffle_batches = random.shuffle
+        if self.shuffle:
+            indices = rng.permutation(len(self.widths))
+        else:
+            indices = np.arange(len(self.widths))
+        pool_len = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, len(indices), pool_len):
+            pool = indices[start:start + pool_len]
+            # stable, so ties keep the shuffled order
+            pool = pool[np.argsort(self.widths[pool], kind='stable')]
+            for b in range(0, len(pool), self.batch_size):
+                batch = pool[b:b + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            shuffle_batches(batches)
+        return batches
+
+    def batches(self):
+        # this process's batches
+        batches = self.all_batches()
+        if self.num_replicas == 1:
+            return batches
+        num = len(self) * self.num_replicas
+        batches += batches[:num - len(batches)]
+        return batches[self.rank:num:self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        total = self._num_batches()
+        return int(math.ceil(total / self.num_replicas))
+
+    def _num_batches(self):
+        if self.drop_last:
+            # only the last pool can have a partial batch
+            return len(self.widths) // self.batch_size
+        full_pools = len(self.widths) // (self.batch_size * self.pool_size)
+        rest = len(self.widths) - full_pools * self.batch_size * self.pool_size
+        return full_pools * self.pool_size + \
+            int(math.ceil(rest / self.batch_size))
+
+
+def padding_fraction(widths, batches):
+    # fraction of the collated image area that is padding
+    widths = np.asarray(widths, dtype=np.float64)
+    used = 0
+    total = 0
+    for batch in batches:
+        w = widths[batch]
+        used += w.sum()
+        total += w.max() * len(w)
+    return 1 - used / total if total > 0 else 0
+
+
+def random_batches(num, batch_size):
+    indices = np.random.permutation(num)
+    return [indices[b:b + batch_size].tolist()
+            for b in range(0, num, batch_size)]
+
+
+def report_padding(widths, sampler):
+    before = padding_fraction(widths, random_batches(
+        len(widths), sampler.batch_size))
+    after = padding_fraction(widths, sampler.batches())
+    print('padding fraction (batch size {}): shuffled {:.3f}, width bucketed {:.3f}'.format(
+        sampler.batch_size, before, after))
+    return before, after
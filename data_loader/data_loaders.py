@@ -6,6 +6,8 @@ from datasets import author_hw_dataset
 from datasets import author_rimeslines_dataset
 from datasets import author_best_dataset
 from base import BaseDataLoader
+from data_loader.bucket_sampler import WidthBucketBatchSampler, report_padding
+from utils import distributed
 
 
 def getDataLoader(config, split):
@@ -150,6 +152,46 @@ def basic(
         return trainLoader, validLoader
 
 
+def trainDataLoader(
+        trainData,
+        collateFunc,
+        batch_size,
+        shuffle,
+        numDataWorkers,
+        config):
+    bucket = config['data_loader']['bucket_by_width'] if 'bucket_by_width' in config['data_loader'] else False
+    if not bucket:
+        if distributed.is_distributed():
+            # each process gets its own share of the (author) instances
+            sampler = torch.utils.data.distributed.DistributedSampler(
+                trainData, shuffle=shuffle)
+            return torch.utils.data.DataLoader(
+                trainData,
+                batch_size=batch_size,
+                sampler=sampler,
+                num_workers=numDataWorkers,
+                collate_fn=collateFunc)
+        return torch.utils.data.DataLoader(
+            trainData,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            num_workers=numDataWorkers,
+            collate_fn=collateFunc)
+    # group lines of similar width into a batch to cut padding
+    pool_size = config['data_loader']['bucket_pool_size'] if 'bucket_pool_size' in config['data_loader'] else 50
+    widths = trainData.item_widths()
+    sampler = WidthBucketBatchSampler(
+        widths, batch_size, shuffle, pool_size,
+        num_replicas=distributed.get_world_size(),
+        rank=distributed.get_rank())
+    report_padding(widths, sampler)
+    return torch.utils.data.DataLoader(
+        trainData,
+        batch_sampler=sampler,
+        num_workers=numDataWorkers,
+        collate_fn=collateFunc)
+
+
 def withCollate(
         setObj,
         collateFunc,
@@ -166,12 +208,13 @@ def withCollate(
             dirPath=data_dir,
             split='train',
             config=config['data_loader'])
-        trainLoader = torch.utils.data.DataLoader(
+        trainLoader = trainDataLoader(
             trainData,
-            batch_size=batch_size,
-            shuffle=shuffle,
-            num_workers=numDataWorkers,
-            collate_fn=collateFunc)
+            collateFunc,
+            batch_size,
+            shuffle,
+            numDataWorkers,
+            config)
         validData = setObj(
             dirPath=data_dir,
             split='valid',
@@ -205,12 +248,13 @@ def withCollate(
                 'train',
                 'valid'],
             config=config['data_loader'])
-        trainLoader = torch.utils.data.DataLoader(
+        trainLoader = trainDataLoader(
             trainData,
-            batch_size=batch_size,
-            shuffle=shuffle,
-            num_workers=numDataWorkers,
-            collate_fn=collateFunc)
+            collateFunc,
+            batch_size,
+            shuffle,
+            numDataWorkers,
+            config)
         validData = setObj(
             dirPath=data_dir,
             split=[
@@ -0,0 +1,81 @@
+import threading
+import collections
+
+
+# Feeds the trainer image batches from a DataLoader, fetching only as many
+# ahead as the coming iterations will use.
+# With a curriculum, many iterations are text-only (e.g. "gen"/"no-step"
+# lessons use TextData) and never take an image batch. The trainer looks
+# ahead in the curriculum (Curriculum.peekLesson) and calls set_demand() with
+# how many of the next iterations need images; a background thread keeps that
+# many batches ready (at most max_ahead), pulling from the DataLoader (whose
+# workers only make more as batches are taken) and restarting it at the end
+# of each epoch. So before a stretch of image lessons the batches are ready,
+# and during a stretch of text lessons nothing is loaded that would sit
+# around going stale.
+# Enable with "image_lookahead": <iterations> in the trainer config.
+
+
+class DemandLoader:
+    def __init__(self, data_loader, on_epoch_end=None, max_ahead=8):
+        self.data_loader = data_loader
+        self.on_epoch_end = on_epoch_end
+        self.max_ahead = max_ahead
+        self.ready = collections.deque()
+        self.demand = 1
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def set_demand(self, num_batches):
+        # num_batches of the coming iterations will take a batch
+        with self.cond:
+            self.demand = min(num_batches, self.max_ahead)
+            self.cond.notify_all()
+
+    def _run(self):
+        # anything going wrong (loading, restarting, on_epoch_end) is raised
+        # in next() instead of leaving it waiting for a batch
+        try:
+            self._fill()
+        except Exception as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+
+    def _fill(self):
+        data_iter = iter(self.data_loader)
+        while True:
+            with self.cond:
+                while len(self.ready) >= self.demand:
+                    self.cond.wait()
+            try:
+                batch = next(data_iter)
+            except StopIteration:
+                if self.on_epoch_end is not None:
+                    self.on_epoch_end()
+                data_iter = iter(self.data_loader)
+                continue
+            with self.cond:
+                self.ready.append(batch)
+                self.cond.notify_all()
+
+    def next(self):
+        with self.cond:
+            while len(self.ready) == 0:
+                if self.error is not None:
+                    raise self.error
+                # needed now, whatever the look-ahead said
+                self.demand = max(self.demand, 1)
+                self.cond.notify_all()
+                self.cond.wait()
+            batch = self.ready.popleft()
+            self.cond.notify_all()
+            return batch
+
+    def __next__(self):
+        return self.next()
+
+    def __iter__(self):
+        return self
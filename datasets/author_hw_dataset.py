@@ -16,6 +16,9 @@ from utils.util import ensure_dir
 from utils import string_utils, augmentation, normalize_line
 from utils.parseIAM import getLineBoundaries as parseXML
 from utils.util import makeMask
+from utils.preprocess_cache import PreprocessCache
+from utils.line_store import LineStore, line_key, resized_width
+from utils.style_store import load_styles_by_id
 import itertools
 import pickle
 
@@ -146,6 +149,9 @@ def collate(batch):
         toRet['fg_mask'] = fg_masks
     if 'changed_image' in batch[0]:
         toRet['changed_image'] = changed_batch
+    if 'aug_params' in batch[0]:
+        toRet['aug_params'] = {k: np.concatenate(
+            [b['aug_params'][k] for b in batch]) for k in batch[0]['aug_params']}
     return toRet
 
 
@@ -160,6 +166,14 @@ class AuthorHWDataset(Dataset):
         self.max_width = config['max_width'] if 'max_width' in config else 3000
         # assert(config['batch_size']==1)
         self.warning = False
+        if 'line_store' in config and config['line_store'] is not None:
+            # pre-cropped, height-normalized lines (see pack_lines.py)
+            self.line_store = LineStore(config['line_store'])
+            assert self.line_store.matches(self.img_height, self.max_width), \
+                'line_store {} was packed with a different img_height/max_width'.format(
+                    config['line_store'])
+        else:
+            self.line_store = None
 
         self.triplet = config['triplet'] if 'triplet' in config else False
         if self.triplet:
@@ -243,8 +257,12 @@ class AuthorHWDataset(Dataset):
                         self.fg_masks_dir, '{}_{}.png'.format(
                             author, line))
                     if not os.path.exists(fg_path):
-                        # read as grayscale, crop line
-                        img = cv2.imread(img_path, 0)[lb[0]:lb[1], lb[2]:lb[3]]
+                        if self.line_store is not None and line_key(img_path, lb) in self.line_store:
+                            img = self.line_store.get(line_key(img_path, lb))
+                        else:
+                            # read as grayscale, crop line
+                            img = cv2.imread(img_path, 0)[
+                                lb[0]:lb[1], lb[2]:lb[3]]
 
                         if img.shape[0] != self.img_height:
                             if img.shape[0] < self.img_height and not self.warning:
@@ -286,14 +304,34 @@ class AuthorHWDataset(Dataset):
         self.char_to_idx = char_set['char_to_idx']
 
         self.augmentation = config['augmentation'] if 'augmentation' in config else None
+        # 'griddata' (exact) or 'fast' (separable interpolation) grid distortion
+        self.warp_mode = config['warp_mode'] if 'warp_mode' in config else 'griddata'
         self.normalized_dir = config['cache_normalized'] if 'cache_normalized' in config else None
         if self.normalized_dir is not None:
             ensure_dir(self.normalized_dir)
+        if 'preprocess_cache' in config and config['preprocess_cache'] is not None:
+            # decoded, cropped, resized (and normalized) lines, kept across
+            # epochs and runs (see utils/preprocess_cache.py)
+            max_mb = config['preprocess_cache_size'] if 'preprocess_cache_size' in config else 2048
+            self.preprocess_cache = PreprocessCache(
+                config['preprocess_cache'], max_mb)
+        else:
+            self.preprocess_cache = None
+        self.preprocess_params = {
+            'img_height': self.img_height,
+            'max_width': self.max_width,
+            'normalization': isinstance(
+                self.augmentation,
+                str) and 'normalization' in self.augmentation}
         self.max_strech = 0.4
         self.max_rot_rad = 45 / 180 * math.pi
 
         self.remove_bg = config['remove_bg'] if 'remove_bg' in config else False
         self.include_stroke_aug = config['include_stroke_aug'] if 'include_stroke_aug' in config else False
+        # leave affine and stroke augmentation to utils/batch_augmentation.py,
+        # only drawing their parameters here
+        self.batch_aug = config['batch_augmentation'] if 'batch_augmentation' in config else False
+        assert not (self.batch_aug and self.remove_bg)
 
         # DEBUG
         if 'overfit' in config and config['overfit']:
@@ -303,29 +341,7 @@ class AuthorHWDataset(Dataset):
         self.center = False
 
         if 'style_loc' in config:
-            by_author_styles = defaultdict(list)
-            by_author_all_ids = defaultdict(set)
-            style_loc = config['style_loc']
-            if style_loc[-1] != '*':
-                style_loc += '*'
-            all_style_files = glob(style_loc)
-            assert(len(all_style_files) > 0)
-            for loc in all_style_files:
-                #print('loading '+loc)
-                with open(loc, 'rb') as f:
-                    styles = pickle.load(f)
-                for i in range(len(styles['authors'])):
-                    by_author_styles[styles['authors'][i]].append(
-                        (styles['styles'][i], styles['ids'][i]))
-                    by_author_all_ids[styles['authors']
-                                      [i]].update(styles['ids'][i])
-
-            self.styles = defaultdict(lambda: defaultdict(list))
-            for author in by_author_styles:
-                for id in by_author_all_ids[author]:
-                    for style, ids in by_author_styles[author]:
-                        if id not in ids:
-                            self.styles[author][id].append(style)
+            self.styles = load_styles_by_id(config['style_loc'])
 
             for author in self.authors:
                 assert(author in self.styles)
@@ -425,7 +441,18 @@ class AuthorHWDataset(Dataset):
 
             if self.no_spaces:
                 gt = gt.replace(' ', '')
-            if isinstance(
+            cache_key = None
+            img = None
+            if self.preprocess_cache is not None:
+                key = self.preprocess_cache.key(
+                    img_path, lb, self.preprocess_params)
+                img = self.preprocess_cache.get(key)
+                if img is None:
+                    cache_key = key  # stored once preprocessed
+            if img is not None:
+                # deskewed+skeletonized too if normalizing
+                readNorm = self.preprocess_params['normalization']
+            elif isinstance(
                 self.augmentation,
                 str) and 'normalization' in self.augmentation and self.normalized_dir is not None and os.path.exists(
                 os.path.join(
@@ -441,6 +468,10 @@ class AuthorHWDataset(Dataset):
                             line)),
                     0)
                 readNorm = True
+            elif self.line_store is not None and line_key(img_path, lb) in self.line_store:
+                # already cropped and height-normalized
+                img = self.line_store.get(line_key(img_path, lb))
+                readNorm = False
             else:
                 img = cv2.imread(img_path, 0)
                 if img is None:
@@ -474,14 +505,18 @@ class AuthorHWDataset(Dataset):
                         img, ((diff // 2, diff // 2 + diff %
                                2), (0, 0)), 'constant', constant_values=255)
 
+            if cache_key is not None and not self.preprocess_params['normalization']:
+                self.preprocess_cache.put(cache_key, img)
+                cache_key = None
+
             if self.augmentation == 'affine':
                 if img.shape[1] * strech > self.max_width:
                     strech = self.max_width / img.shape[1]
-            images.append((line, gt, img, author))
+            images.append((line, gt, img, author, readNorm, cache_key))
             # we split the processing here so that strech will be adjusted for
             # longest image in author batch
 
-        for line, gt, img, author in images:
+        for line, gt, img, author, readNorm, cache_key in images:
             if self.fg_masks_dir is not None:
                 fg_path = os.path.join(
                     self.fg_masks_dir, '{}_{}.png'.format(
@@ -505,6 +540,8 @@ class AuthorHWDataset(Dataset):
                     str) and 'normalization' in self.augmentation and not readNorm:
                 img = normalize_line.deskew(img)
                 img = normalize_line.skeletonize(img)
+                if cache_key is not None:
+                    self.preprocess_cache.put(cache_key, img)
                 if self.normalized_dir is not None:
                     cv2.imwrite(
                         os.path.join(
@@ -515,15 +552,16 @@ class AuthorHWDataset(Dataset):
                         img)
             if isinstance(self.augmentation,
                           str) and 'affine' in self.augmentation:
-                img, fg_mask = augmentation.affine_trans(
-                    img, fg_mask, skew, strech)
-            elif self.augmentation is not None and (not isinstance(self.augmentation, None) or 'warp' in self.augmentation):
+                if not self.batch_aug:
+                    img, fg_mask = augmentation.affine_trans(
+                        img, fg_mask, skew, strech)
+            elif isinstance(self.augmentation, str) and 'warp' in self.augmentation:
                 #img = augmentation.apply_random_color_rotation(img)
                 img = augmentation.apply_tensmeyer_brightness(img)
-                img = grid_distortion.warp_image(img)
+                img = grid_distortion.warp_image(img, mode=self.warp_mode)
                 assert(fg_mask is None)
 
-            if self.include_stroke_aug:
+            if self.include_stroke_aug and not self.batch_aug:
                 new_img = augmentation.change_thickness(
                     img, thickness_change, fg_shade, bg_shade, blur_size, noise_sigma)
                 if len(new_img.shape) == 2:
@@ -548,12 +586,13 @@ class AuthorHWDataset(Dataset):
                 return None
             gt_label = string_utils.str2label_single(gt, self.char_to_idx)
 
+            name = '{}_{}'.format(author, line)
             if self.styles:
-                style_i = self.npr.choice(len(self.styles[author][id]))
-                style = self.styles[author][id][style_i]
+                # the author's styles extracted without this line
+                style_i = np.random.choice(len(self.styles[author][name]))
+                style = self.styles[author][name][style_i]
             else:
                 style = None
-            name = '{}_{}'.format(author, line)
             if self.identity_spaced:
                 spaced_label = gt_label[:, None].astype(np.long)
             else:
@@ -575,7 +614,7 @@ class AuthorHWDataset(Dataset):
             }
             if self.fg_masks_dir is not None:
                 toAppend['fg_mask'] = fg_mask
-            if self.include_stroke_aug:
+            if self.include_stroke_aug and not self.batch_aug:
                 toAppend['changed_image'] = new_img
             batch.append(toAppend)
 
@@ -603,7 +642,7 @@ class AuthorHWDataset(Dataset):
             fg_masks = np.full(
                 (len(batch), dim0, dim1, 1), 0).astype(
                 np.float32)
-        if self.include_stroke_aug:
+        if self.include_stroke_aug and not self.batch_aug:
             changed_batch = np.full(
                 (len(batch), dim0, dim1, dim2), PADDING_CONSTANT).astype(
                 np.float32)
@@ -618,7 +657,7 @@ class AuthorHWDataset(Dataset):
             if self.fg_masks_dir is not None:
                 fg_masks[i, :, toPad:toPad +
                          b_img.shape[1], 0] = batch[i]['fg_mask']
-            if self.include_stroke_aug:
+            if self.include_stroke_aug and not self.batch_aug:
                 changed_batch[i, :, toPad:toPad +
                               b_img.shape[1], :] = batch[i]['changed_image']
 
@@ -686,11 +725,54 @@ class AuthorHWDataset(Dataset):
         }
         if self.fg_masks_dir is not None:
             toRet['fg_mask'] = fg_masks
-        if self.include_stroke_aug:
+        if self.include_stroke_aug and not self.batch_aug:
             changed_images = changed_batch.transpose([0, 3, 1, 2])
             changed_images = torch.from_numpy(changed_images)
             toRet['changed_image'] = changed_images
+        if self.batch_aug:
+            # applied after collating, see utils/batch_augmentation.py
+            num = len(batch)
+            aug_params = {
+                'width': np.array([b['image'].shape[1] for b in batch]),
+                'padding': np.full(num, PADDING_CONSTANT, np.float32)}
+            if isinstance(
+                    self.augmentation,
+                    str) and 'affine' in self.augmentation:
+                aug_params['skew'] = np.full(num, skew)
+                aug_params['strech'] = np.full(num, strech)
+            if self.include_stroke_aug:
+                aug_params['thickness_change'] = np.full(num, thickness_change)
+                aug_params['fg_shade'] = np.full(num, fg_shade)
+                aug_params['bg_shade'] = np.full(num, bg_shade)
+                aug_params['blur_size'] = np.full(num, blur_size)
+                aug_params['noise_sigma'] = np.full(num, noise_sigma)
+            toRet['aug_params'] = aug_params
         return toRet
 
     def max_len(self):
         return self.max_char_len
+
+    def line_sources(self):
+        # (image path, crop box) of every line, for pack_lines.py
+        return [(img_path, lb) for lines in self.authors.values()
+                for img_path, lb, gt in lines]
+
+    def item_widths(self):
+        # estimated width of each instance (its widest line) once it is
+        # height-normalized, from the crop boxes; for width bucketing
+        widths = []
+        for author, lines in self.lineIndex:
+            width = 0
+            for line in lines:
+                if line >= len(self.authors[author]):
+                    line = (line + 37) % len(self.authors[author])
+                img_path, lb, gt = self.authors[author][line]
+                key = line_key(img_path, lb)
+                if self.line_store is not None and key in self.line_store:
+                    w = self.line_store.width(key)
+                else:
+                    w = resized_width(
+                        lb[1] - lb[0], lb[3] - lb[2], self.img_height, self.max_width)
+                width = max(width, w)
+            widths.append(width)
+        return widths
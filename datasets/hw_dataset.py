@@ -98,6 +98,8 @@ class HWDataset(Dataset):
         self.char_to_idx = char_set['char_to_idx']
 
         self.augmentation = config['augmentation'] if 'augmentation' in config else None
+        # 'griddata' (exact) or 'fast' (separable interpolation) grid distortion
+        self.warp_mode = config['warp_mode'] if 'warp_mode' in config else 'griddata'
         self.normalized_dir = config['cache_normalized'] if 'cache_normalized' in config else None
         if self.normalized_dir is not None:
             ensure_dir(self.normalized_dir)
@@ -181,10 +183,10 @@ class HWDataset(Dataset):
                     img = augmentation.apply_tensmeyer_brightness(img)
                 if random.random() > 0.01:
                     img = grid_distortion.warp_image(
-                        img, w_mesh_std=0.7, h_mesh_std=0.7)
+                        img, w_mesh_std=0.7, h_mesh_std=0.7, mode=self.warp_mode)
             else:
                 img = augmentation.apply_tensmeyer_brightness(img)
-                img = grid_distortion.warp_image(img)
+                img = grid_distortion.warp_image(img, mode=self.warp_mode)
         if len(img.shape) == 2:
             img = img[..., None]
 
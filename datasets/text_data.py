@@ -4,6 +4,7 @@ import json
 import torch
 import numpy as np
 from utils import string_utils
+from utils.text_corpus import TextCorpus
 
 
 class TextData():
@@ -15,34 +16,52 @@ class TextData():
             max_len=20,
             words=False,
             characterBalance=False,
-            hardsplit_newline=False):
+            hardsplit_newline=False,
+            indexed=True):
         self.max_len = max_len
         self.characterBalance = characterBalance
         if characterBalance:
             self.chars = [
                 c for c in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ']
 
-        # with open(os.path.join(dirPath,'sets.json')) as f:
-        with open(textfile) as f:
-            text = f.read()
-        # text = text.replace('\n', ' ')#.replace('  ',' ')
-        if hardsplit_newline:
-            self.text = text.split('\n')
-            self.words = True
-        else:
-            # This takes a minute on large text, but only needs done once.
-            text = re.sub('\\s+', ' ', text)
-            self.text = text
-            self.words = words
-
-            if words:
-                words = text.strip().split(' ')
-                self.text = []  # words
-                for word in words:
-                    m = re.match(r'[.,:\'"?!]*', word)
-                    if m is None or m.span()[0] != 0 or m.span()[
-                            1] < len(word):
-                        self.text.append(word)
+        if indexed:
+            # prebuilt, memory-mapped version of the normalized text (built
+            # the first time, see utils/text_corpus.py)
+            if hardsplit_newline:
+                mode = 'lines'
+            elif words:
+                mode = 'words'
+            else:
+                mode = 'chars'
+            try:
+                self.text = TextCorpus(textfile, mode)
+                self.words = hardsplit_newline or words
+            except OSError as e:
+                print('Could not index {} ({}), reading it instead'.format(
+                    textfile, e))
+                indexed = False
+        if not indexed:
+            # with open(os.path.join(dirPath,'sets.json')) as f:
+            with open(textfile) as f:
+                text = f.read()
+            # text = text.replace('\n', ' ')#.replace('  ',' ')
+            if hardsplit_newline:
+                self.text = text.split('\n')
+                self.words = True
+            else:
+                # This takes a minute on large text, but only needs done once.
+                text = re.sub('\\s+', ' ', text)
+                self.text = text
+                self.words = words
+
+                if words:
+                    words = text.strip().split(' ')
+                    self.text = []  # words
+                    for word in words:
+                        m = re.match(r'[.,:\'"?!]*', word)
+                        if m is None or m.span()[0] != 0 or m.span()[
+                                1] < len(word):
+                            self.text.append(word)
         if len(char_set_path) > 0:
             with open(char_set_path) as f:
                 char_set = json.load(f)
@@ -55,7 +74,32 @@ class TextData():
         self.max_len = max_len
         self.min_len = max(max_len - 3, 1)
 
+    def prefetch(self, num_workers=1, pin_memory=None):
+        # From now on getInstance() takes batches made ahead of time by
+        # num_workers DataLoader workers (and pinned, if there's a GPU)
+        # instead of making them when asked.
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        self.prefetcher = None
+        loader = torch.utils.data.DataLoader(
+            TextDataStream(self),
+            batch_size=None,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            worker_init_fn=_seed_worker)
+        self.prefetcher = iter(loader)
+
     def getInstance(self):
+        if getattr(self, 'prefetcher', None) is not None:
+            return next(self.prefetcher)
+        return self.makeInstance()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['prefetcher'] = None
+        return state
+
+    def makeInstance(self):
 
         all_labels = []
         label_lengths = []
@@ -72,7 +116,18 @@ class TextData():
             else:
                 length = random.randint(self.min_len, self.max_len)
                 idx = np.random.randint(0, len(self.text) - length)
-                if self.characterBalance:
+                if self.characterBalance and isinstance(self.text, TextCorpus):
+                    goalChar = random.choice(self.chars)
+                    start = self.text.window_with(goalChar, length)
+                    if start is not None:
+                        text = self.text[start:start + length]
+                    else:
+                        # this char is not in the text set, so we'll just
+                        # add it somewhere random
+                        text = self.text[idx:idx + length]
+                        r = random.randint(0, len(text))
+                        text = text[:r] + goalChar + text[r + 1:]
+                elif self.characterBalance:
                     startIdx = idx
                     flipped = False
                     goalChar = random.choice(self.chars)
@@ -122,3 +177,21 @@ class TextData():
                 'gt': gt,
                 'image': None
             }
+
+
+def _seed_worker(worker_id):
+    # DataLoader gives each worker its own torch seed; make numpy's and
+    # random's differ between workers too
+    seed = torch.initial_seed() % (2**32)
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+class TextDataStream(torch.utils.data.IterableDataset):
+    # endless batches from a TextData, to be made by DataLoader workers
+    def __init__(self, text_data):
+        self.text_data = text_data
+
+    def __iter__(self):
+        while True:
+            yield self.text_data.makeInstance()
@@ -1,9 +1,19 @@
-import sys
+import argparse
 import numpy as np
+import torch
 from glob import glob
 import pickle
+from utils.style_store import StyleStore
 
 
+# Writer identification with the style vectors: each line's style is the
+# query and every other line is ranked by its distance (L2 and L1) to it; a
+# line by the same author is a match. Reports the mean rank of the first
+# match, top-k accuracy (a match in the k nearest) and mAP, over the queries
+# whose author has other lines.
+# The distances are computed a block of query rows at a time (block x all
+# lines), so memory doesn't grow with the square of the number of lines.
+
 # def getEmbeddings(dataset,trainer):
 #    ret={}
 #    for instance in dataset:
@@ -12,93 +22,106 @@ import pickle
 #            ret[author] = style[i]
 #    return ret
 
-def topN(n, scores, gt):
-    total = 0
-    for i in range(scores.shape[0]):
-        paired = list(zip(scores[i], gt[i]))
-        paired.sort(key=lambda a: a[0])
-
-        # paired.reverse()
-        #paired = np.stack((scores[i],gt[i]),axis=1)
-        #paired = np.sort
-        t = 0
-        for i in range(1, n + 1):
-            if paired[i][1]:
-                t += 1
-        total += t > 0
-    return total / scores.shape[0]
-
-
-def bestTrue(scores, gt):
-    total = 0
-    for i in range(scores.shape[0]):
-        paired = list(zip(scores[i], gt[i]))
-        #paired.sort(lambda a,b: a[0]<b[0])
-        paired.sort(key=lambda a: a[0])
-        #paired = np.stack((scores[i],gt[i]),axis=1)
-        #paired = np.sort
-        for rank in range(1, len(paired)):
-            if paired[i][1]:
-                break
-        total += rank
-    return total / scores.shape[0]
-
-
-style_loc = sys.argv[1]
-if style_loc[-1] != '*':
-    style_loc += '*'
-styles = []
-authors = []
-for loc in glob(style_loc):
-    with open(loc, 'rb') as f:
-        data = pickle.load(f)
-    s = data['styles']
-    if len(s.shape) == 4:
-        s = s[:, :, 0, 0]
-    styles.append(s)
-
-    authors += list(data['authors'])
-styles = np.concatenate(styles, axis=0)
-
-print('styles: {}'.format(styles.shape))
-# compute distance
-
-#styles_expand = np.repeat(styles[None,:,:],styles.shape[0],axis=0)
-#diff = styles_expand - np.transpose(styles_expand,(1,0,2))
-#print('diff: {}'.format(diff))
-#
-#l2 = np.power(diff,2).sum(axis=2)
-#l1 = np.abs(diff).sum(axis=2)
-
-l1 = np.empty((styles.shape[0], styles.shape[0]))
-l2 = np.empty((styles.shape[0], styles.shape[0]))
-for i in range(styles.shape[0]):
-    for j in range(styles.shape[0]):
-        diff = styles[i] - styles[j]
-        l1[i, j] = np.abs(diff).sum()
-        l2[i, j] = np.power(diff, 2).sum()
-
-gt = np.empty((styles.shape[0], styles.shape[0]), dtype=np.int8)
-for i, author1 in enumerate(authors):
-    for j, author2 in enumerate(authors):
-        gt[i, j] = author1 == author2
-
-#uptrI = np.triu_indices(styles.shape[0])
-#l2 = l2[uptrI]
-#l1 = l1[uptrI]
-#gt = gt[uptrI]
-
-print('l2 rank: {}'.format(bestTrue(l2, gt)))
-print(
-    'l2\ttop1:{},\ttop5:\t{},\ttop20:\t{}'.format(
-        topN(
-            1, l2, gt), topN(
-                5, l2, gt), topN(
-                    20, l2, gt)))
-print('l1 rank: {}'.format(bestTrue(l1, gt)))
-print(
-    'l1\ttop1:{},\ttop5:\t{},\ttop20:\t{}'.format(
-        topN(
-            1, l1, gt), topN(
-                5, l1, gt), topN(
-                    20, l1, gt)))
+
+def load(style_loc):
+    # (lines x features styles, authors) from a style store or pickles
+    if StyleStore.is_store(style_loc):
+        store = StyleStore(style_loc)
+        return store.matrix(), list(store.row_authors())
+    if style_loc[-1] != '*':
+        style_loc += '*'
+    styles = []
+    authors = []
+    for loc in glob(style_loc):
+        with open(loc, 'rb') as f:
+            data = pickle.load(f)
+        s = data['styles']
+        if len(s.shape) == 4:
+            s = s[:, :, 0, 0]
+        styles.append(s)
+
+        authors += list(data['authors'])
+    return np.concatenate(styles, axis=0), authors
+
+
+def rank_block(dist, same, ks):
+    # dist: queries x lines distances (the query itself at inf), same: whether
+    # each line has the query's author. Returns the rank of the first match,
+    # whether there is a match in the top k (for each k) and the average
+    # precision, per query.
+    rows = np.arange(dist.shape[0])[:, None]
+
+    first_match = np.where(same, dist, np.inf).min(axis=1)
+    first_rank = (dist < first_match[:, None]).sum(axis=1) + 1
+
+    k_max = min(max(ks), dist.shape[1])
+    nearest = np.argpartition(dist, k_max - 1, axis=1)[:, :k_max]
+    nearest = np.take_along_axis(
+        nearest, np.argsort(dist[rows, nearest], axis=1), axis=1)
+    hits = same[rows, nearest]
+    top = {k: hits[:, :k].any(axis=1) for k in ks}
+
+    order = np.argsort(dist, axis=1)
+    hits = same[rows, order]
+    precision = np.cumsum(hits, axis=1) / np.arange(1, dist.shape[1] + 1)
+    ap = (precision * hits).sum(axis=1) / np.maximum(hits.sum(axis=1), 1)
+    return first_rank, top, ap
+
+
+def evaluate(styles, authors, ks=[1, 5, 20], block=1024):
+    # {'l2': {...}, 'l1': {...}} of the mean first match rank, top-k
+    # accuracies and mAP
+    styles = torch.from_numpy(np.ascontiguousarray(styles, dtype=np.float32))
+    num = styles.size(0)
+    author_ids = np.unique(np.array(authors, dtype=str), return_inverse=True)[1]
+    # queries with no other line by their author can't be matched
+    has_match = np.bincount(author_ids)[author_ids] > 1
+
+    results = {}
+    for name, p in [('l2', 2), ('l1', 1)]:
+        first_ranks = []
+        tops = {k: [] for k in ks}
+        aps = []
+        for start in range(0, num, block):
+            end = min(start + block, num)
+            dist = torch.cdist(styles[start:end], styles, p=p).numpy()
+            queries = np.arange(end - start)
+            dist[queries, start + queries] = np.inf
+            same = author_ids[start:end, None] == author_ids[None, :]
+            same[queries, start + queries] = False
+
+            keep = has_match[start:end]
+            first_rank, top, ap = rank_block(dist[keep], same[keep], ks)
+            first_ranks.append(first_rank)
+            for k in ks:
+                tops[k].append(top[k])
+            aps.append(ap)
+        results[name] = {'rank': np.concatenate(first_ranks).mean(),
+                         'mAP': np.concatenate(aps).mean()}
+        for k in ks:
+            results[name]['top{}'.format(k)] = np.concatenate(tops[k]).mean()
+    return results, int(has_match.sum())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Writer identification accuracy of style vectors')
+    parser.add_argument('style_loc', type=str,
+                        help='style store, or pickle(s), from get_styles.py')
+    parser.add_argument('-k', '--top', default='1,5,20', type=str,
+                        help='k of the top-k accuracies (default: 1,5,20)')
+    parser.add_argument('-b', '--block', default=1024, type=int,
+                        help='query lines per block (default: 1024)')
+    args = parser.parse_args()
+
+    styles, authors = load(args.style_loc)
+    print('styles: {}'.format(styles.shape))
+    ks = [int(k) for k in args.top.split(',')]
+    results, num_queries = evaluate(styles, authors, ks, args.block)
+    print('{} queries ({} lines with no other line by their author)'.format(
+        num_queries, styles.shape[0] - num_queries))
+    for name in ['l2', 'l1']:
+        print('{} rank: {}'.format(name, results[name]['rank']))
+        print('{}\t'.format(name) + ',\t'.join(
+            ['top{}:\t{}'.format(k, results[name]['top{}'.format(k)])
+             for k in ks] + ['mAP:\t{}'.format(results[name]['mAP'])]))
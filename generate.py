@@ -17,10 +17,13 @@ import pickle
 from glob import glob
 import cv2
 from utils import string_utils
+from utils.alignment import correct_pred
 from utils.util import ensure_dir
+from utils.style_store import StyleStore, read_pickles
 import random
 import re
 import csv
+from concurrent.futures import ThreadPoolExecutor
 
 #from datasets.forms_detect import FormsDetect
 #from datasets import forms_detect
@@ -113,6 +116,20 @@ def get_style(config, model, instance, gpu=None):
     return style
 
 
+def load_styles(style_loc):
+    # styles (by author) from a style store or the pickles get_styles.py
+    # writes
+    styles = defaultdict(list)
+    if StyleStore.is_store(style_loc):
+        styles.update(StyleStore(style_loc).by_author())
+    else:
+        for file_styles, authors, ids in read_pickles(style_loc):
+            for i in range(len(authors)):
+                styles[authors[i]].append(file_styles[i])
+    authors = [author for author in styles if len(styles[author]) > 0]
+    return styles, authors
+
+
 def main(
         resume,
         saveDir,
@@ -122,7 +139,10 @@ def main(
         fromDataset=True,
         test=False,
         arguments=None,
-        style_loc=None):
+        style_loc=None,
+        manifest=None,
+        batch_size=32,
+        write_workers=4):
     np.random.seed(1234)
     torch.manual_seed(1234)
     if resume is not None:
@@ -258,37 +278,9 @@ def main(
         char_set = json.load(f)
     char_to_idx = char_set['char_to_idx']
 
-    by_author_styles = defaultdict(list)
-    by_author_all_ids = defaultdict(set)
     #style_loc = config['style_loc'] if 'style_loc' in config else style_loc
     if style_loc is not None:
-        if style_loc[-1] != '*':
-            style_loc += '*'
-        all_style_files = glob(style_loc)
-        assert(len(all_style_files) > 0)
-        for loc in all_style_files:
-            #print('loading '+loc)
-            with open(loc, 'rb') as f:
-                styles = pickle.load(f)
-            if 'ids' in styles:
-                for i in range(len(styles['authors'])):
-                    by_author_styles[styles['authors'][i]].append(
-                        (styles['styles'][i], styles['ids'][i]))
-                    by_author_all_ids[styles['authors']
-                                      [i]].update(styles['ids'][i])
-            else:
-                for i in range(len(styles['authors'])):
-                    by_author_styles[styles['authors'][i]].append(
-                        (styles['styles'][i], None))
-
-        styles = defaultdict(list)
-        authors = set()
-        for author in by_author_styles:
-            for style, ids in by_author_styles[author]:
-                styles[author].append(style)
-            if len(styles[author]) > 0:
-                authors.add(author)
-        authors = list(authors)
+        styles, authors = load_styles(style_loc)
     elif not test:
         authors = None
         styles = None
@@ -306,6 +298,14 @@ def main(
 
     charSpec = model.char_style_dim > 0
 
+    if manifest is not None:
+        # non-interactive, see batch_generate()
+        ensure_dir(saveDir)
+        batch_generate(model, read_manifest(manifest), styles, char_to_idx,
+                       saveDir, gpu, charSpec, batch_size, write_workers,
+                       os.path.join(saveDir, 'texts.txt'))
+        return
+
     with torch.no_grad():
         while True:
             if arguments is None:
@@ -465,72 +465,16 @@ def main(
                 else:
                     textList = None
 
-                # sample the styles
-                stylesL = []
-                textL = []
-                text_falseL = []
                 ensure_dir(os.path.join(saveDir))  # ,'fake'))
+                jobs = []
                 for i in range(num_inst):
-                    if not model.vae:
-                        #authorA = random.choice(get_authors())
-                        authorA = random.choice(list(styles.keys()))
-                        instance = random.randint(0, len(styles[authorA]) - 1)
-                        style1 = styles[authorA][instance]
-                        #authorB = random.choice(get_authors())
-                        authorB = random.choice(list(styles.keys()))
-                        instance = random.randint(0, len(styles[authorB]) - 1)
-                        style2 = styles[authorB][instance]
-
-                        #inter = random.random()
-                        inter = 2 * random.random() - 0.5
-                        if charSpec:
-                            style = (
-                                style1[0] * inter + style2[0] * (1 - inter),
-                                style1[1] * inter + style2[1] * (1 - inter),
-                                style1[2] * inter + style2[2] * (1 - inter)
-                            )
-                        else:
-                            style = style1 * inter + style2 * (1 - inter)
-
-                        # stylesL.append(style)
-                    else:  # VAE
-                        stylesL = [
-                            torch.FloatTensor(
-                                1, model.style_dim).normal_() for i in range(num_styles)]
-                    # for i,style in enumerate(stylesL):
-                    if charSpec:
-                        if gpu is not None:
-                            style = (torch.from_numpy(style[0])[None, ...].to(gpu), torch.from_numpy(
-                                style[1][None, ...]).to(gpu), torch.from_numpy(style[2][None, ...]).to(gpu))
-                        else:
-                            style = (torch.from_numpy(style[0])[None, ...], torch.from_numpy(
-                                style[1])[None, ...], torch.from_numpy(style[2])[None, ...])
-                    else:
-                        if gpu is not None:
-                            style = torch.from_numpy(style).to(gpu)
-                        else:
-                            style = torch.from_numpy(style)
-                        style = style[None, ...]
-
-                    if textList is not None:
-                        text = textList[i]
-                    im = generate(model, style, text, char_to_idx, gpu)
-                    im = (
-                        (1 -
-                         im[0].permute(
-                             1,
-                             2,
-                             0)) *
-                        127.5).cpu().numpy().astype(
-                        np.uint8)
-                    image_name = 'sample_{}.png'.format(i + index_offset)
-                    path = os.path.join(saveDir, image_name)
-                    cv2.imwrite(path, im)
-                    if textList is not None:
-                        with open('OUT.txt', 'a') as out:
-                            out.write(
-                                '{}:'.format(
-                                    i + index_offset) + text + '\n')
+                    jobs.append({
+                        'text': textList[i] if textList is not None else text,
+                        'out': 'sample_{}.png'.format(i + index_offset),
+                        'id': i + index_offset})
+                batch_generate(model, jobs, styles, char_to_idx, saveDir, gpu,
+                               charSpec, batch_size, write_workers,
+                               'OUT.txt' if textList is not None else None)
 
             elif action[0] == 'm':  # style vector math, this is broken
                 assert(
@@ -974,17 +918,149 @@ def main(
                         cv2.imwrite(path_mask, mask[b])
 
 
-# generates an image
+# generates an image for each style in the batch, of text (or text[b], if a
+# list)
 def generate(model, style, text, char_to_idx, gpu):
-    # print(style)
-    batch_size = 1  # style.size(0)
-    label = string_utils.str2label_single(text, char_to_idx)
-    label = torch.from_numpy(label.astype(np.int32))[
-        :, None].expand(-1, batch_size).to(gpu).long()
-    label_len = torch.IntTensor(batch_size).fill_(label.size(0))
-    results = []
-    styles = []
-    return model(label, label_len, style)
+    if isinstance(style, tuple):
+        batch_size = style[0].size(0)
+    else:
+        batch_size = style.size(0)
+    if isinstance(text, str):
+        text = [text] * batch_size
+    labels = [string_utils.str2label_single(t, char_to_idx) for t in text]
+    label_len = torch.IntTensor([len(l) for l in labels])
+    label = torch.zeros(int(label_len.max()), batch_size, dtype=torch.long)
+    for b, l in enumerate(labels):
+        label[:len(l), b] = torch.from_numpy(l.astype(np.int64))
+    return model(label.to(gpu), label_len, style)
+
+
+# Jobs for batch_generate(), from a JSON-lines file with one job per line:
+#   {"text": "...", "author": "a01"}  a style of author a01 (a random one of
+#                                      theirs, or "index": i)
+#   {"text": "...", "authors": ["a01", "b02"], "mix": 0.3}
+#                                      0.3*a01's style + 0.7*b02's
+#   {"text": "..."}                    random interpolation of two styles (as
+#                                      the "R" option does)
+# and optionally "out": image file name (default sample_<line number>.png).
+# A .txt file is one text per line, with random styles.
+def read_manifest(path):
+    jobs = []
+    with open(path, encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            line = line.rstrip('\n')
+            if len(line.strip()) == 0:
+                continue
+            if path.endswith('.txt'):
+                job = {'text': line}
+            else:
+                job = json.loads(line)
+            if 'out' not in job:
+                job['out'] = 'sample_{}.png'.format(i)
+            if 'id' not in job:
+                job['id'] = i
+            jobs.append(job)
+    return jobs
+
+
+def sample_style(model, styles, job, charSpec):
+    # the (numpy) style a job asks for
+    if model.vae and styles is None:
+        return torch.FloatTensor(model.style_dim).normal_().numpy()
+    assert styles is not None, 'perhaps you forgot to set "-s path/to/styles.pkl"?'
+    if 'author' in job:
+        author_styles = styles[job['author']]
+        assert len(author_styles) > 0, 'no styles for author {}'.format(job['author'])
+        index = job['index'] if 'index' in job else random.randint(
+            0, len(author_styles) - 1)
+        return author_styles[index]
+    if 'authors' in job:
+        authorA, authorB = job['authors']
+        inter = job['mix'] if 'mix' in job else 0.5
+        style1 = random.choice(styles[authorA])
+        style2 = random.choice(styles[authorB])
+    else:
+        authorA = random.choice(list(styles.keys()))
+        style1 = styles[authorA][random.randint(0, len(styles[authorA]) - 1)]
+        authorB = random.choice(list(styles.keys()))
+        style2 = styles[authorB][random.randint(0, len(styles[authorB]) - 1)]
+        inter = 2 * random.random() - 0.5
+    if charSpec:
+        return (style1[0] * inter + style2[0] * (1 - inter),
+                style1[1] * inter + style2[1] * (1 - inter),
+                style1[2] * inter + style2[2] * (1 - inter))
+    return style1 * inter + style2 * (1 - inter)
+
+
+def stack_styles(style_list, charSpec, gpu):
+    if charSpec:
+        return tuple(torch.from_numpy(np.stack([s[k] for s in style_list])).to(gpu)
+                     for k in range(3))
+    return torch.from_numpy(np.stack(style_list)).to(gpu)
+
+
+# Generates the jobs of a batch together, returns their images (uint8,
+# height x width x channels), each cropped to its own line. style_list, if
+# given, has each job's style already (from sample_style()).
+def render_batch(model, batch, styles, char_to_idx, gpu, charSpec,
+                 style_list=None):
+    if style_list is None:
+        style_list = [sample_style(model, styles, job, charSpec)
+                      for job in batch]
+    style = stack_styles(style_list, charSpec, gpu)
+    gen = generate(model, style, [job['text']
+                   for job in batch], char_to_idx, gpu)
+    # one copy off the device for the batch
+    images = ((1 - gen.permute(0, 2, 3, 1)) *
+              127.5).cpu().numpy().astype(np.uint8)
+    spaced_len = model.gen_spaced.size(0)
+    px_per_step = images.shape[2] / spaced_len
+    cropped = []
+    for b in range(len(batch)):
+        # the line's own length, plus a few blanks
+        line_len = spaced_len * (1 - model.gen_padded[b]) + 3
+        width = min(images.shape[2], int(math.ceil(line_len * px_per_step)))
+        cropped.append(images[b, :, :width])
+    return cropped
+
+
+# Generates the image of every job (see read_manifest()) into saveDir.
+# Jobs are sorted by text length and run batch_size at a time, so a batch is
+# padded little; each image is cropped back to its own line's length. The
+# PNGs are written by write_workers threads while the next batch generates,
+# and text_log (if given) gets an "id:text" line per job, written at the end.
+def batch_generate(model, jobs, styles, char_to_idx, saveDir, gpu, charSpec,
+                   batch_size=32, write_workers=4, text_log=None):
+    ok = []
+    for job in jobs:
+        if len(string_utils.str2label_single(job['text'], char_to_idx)) == 0:
+            print('skipping {}, no known characters in: {}'.format(
+                job['out'], job['text']))
+        else:
+            ok.append(job)
+    jobs = sorted(ok, key=lambda job: len(job['text']))
+    inference_mode = torch.inference_mode if hasattr(
+        torch, 'inference_mode') else torch.no_grad
+    pending = []
+    with ThreadPoolExecutor(max(write_workers, 1)) as pool, inference_mode():
+        for start in range(0, len(jobs), batch_size):
+            batch = jobs[start:start + batch_size]
+            images = render_batch(model, batch, styles,
+                                  char_to_idx, gpu, charSpec)
+            # the previous batch's images are written by now (at most two
+            # batches are held)
+            for future in pending:
+                future.result()
+            pending = []
+            for job, image in zip(batch, images):
+                pending.append(pool.submit(
+                    cv2.imwrite, os.path.join(saveDir, job['out']), image))
+        for future in pending:
+            future.result()
+    if text_log is not None:
+        with open(text_log, 'a') as out:
+            for job in sorted(jobs, key=lambda job: job['id']):
+                out.write('{}:'.format(job['id']) + job['text'] + '\n')
 
 # generates a series of images interpolating between the styles
 
@@ -1072,77 +1148,6 @@ def onehot(label, num_class):
     return label_onehot.to(label.device)
 
 
-def correct_pred(pred, label):
-    # Get optimal alignment
-    # use DTW
-    # introduce blanks at front, back, and inbetween chars
-    label_with_blanks = torch.LongTensor(
-        label.size(0) * 2 + 1, label.size(1)).zero_()
-    label_with_blanks[1::2] = label.cpu()
-    pred_use = pred.cpu().detach()
-
-    batch_size = pred_use.size(1)
-    label_len = label_with_blanks.size(0)
-    pred_len = pred_use.size(0)
-
-    dtw = torch.FloatTensor(
-        pred_len + 1,
-        label_len + 1,
-        batch_size).fill_(
-        float('inf'))
-    dtw[0, 0] = 0
-    w = max(pred_len // 2, abs(pred_len - label_len))
-    for i in range(1, pred_len + 1):
-        dtw[i, max(1, i - w):min(label_len, i + w) + 1] = 0
-    history = torch.IntTensor(pred_len, label_len, batch_size)
-    for i in range(1, pred_len + 1):
-        for j in range(max(1, i - w), min(label_len, i + w) + 1):
-            cost = 1 - \
-                pred_use[i - 1, torch.arange(0, batch_size).long(), label_with_blanks[j - 1, :]]
-            per_batch_min, history[i -
-                                   1, j -
-                                   1] = torch.min(torch.stack((dtw[i -
-                                                                   1, j], dtw[i -
-                                                                              1, j -
-                                                                              1], dtw[i, j -
-                                                                                      1])), dim=0)
-            dtw[i, j] = cost + per_batch_min
-    new_labels = []
-    maxlen = 0
-    for b in range(batch_size):
-        new_label = []
-        i = pred_len - 1
-        j = label_len - 1
-        #accum += allCosts[b,i,j]
-        new_label.append(label_with_blanks[j, b])
-        while(i > 0 or j > 0):
-            if history[i, j, b] == 0:
-                i -= 1
-            elif history[i, j, b] == 1:
-                i -= 1
-                j -= 1
-            elif history[i, j, b] == 2:
-                j -= 1
-            # accum+=allCosts[b,i,j]
-            new_label.append(label_with_blanks[j, b])
-        new_label.reverse()
-        maxlen = max(maxlen, len(new_label))
-        new_label = torch.stack(new_label, dim=0)
-        new_labels.append(new_label)
-
-    new_labels = [F.pad(l, (0, maxlen - l.size(0)), value=0)
-                  for l in new_labels]
-    new_label = torch.LongTensor(maxlen, batch_size)
-    for b, l in enumerate(new_labels):
-        new_label[:l.size(0), b] = l
-
-    # set to one hot at alignment
-    # fuzzy other neighbor preds
-    # TODO
-
-    return new_label.to(label.device)
-
-
 if __name__ == '__main__':
     logger = logging.getLogger()
 
@@ -1181,6 +1186,16 @@ if __name__ == '__main__':
         default=None,
         type=str,
         help='location of pkl of styles, generated with get_styles.py')
+    parser.add_argument(
+        '-m',
+        '--manifest',
+        default=None,
+        type=str,
+        help='generate the jobs in this file (JSON-lines, or a .txt of texts) instead of running interactively, see read_manifest() (default: None)')
+    parser.add_argument('-b', '--batch_size', default=32, type=int,
+                        help='batch size for generating (default: 32)')
+    parser.add_argument('-w', '--write_workers', default=4, type=int,
+                        help='threads writing the images (default: 4)')
 
     args = parser.parse_args()
 
@@ -1214,7 +1229,10 @@ if __name__ == '__main__':
                 addToConfig=addtoconfig,
                 test=args.test,
                 arguments=arguments,
-                style_loc=args.style_loc)
+                style_loc=args.style_loc,
+                manifest=args.manifest,
+                batch_size=args.batch_size,
+                write_workers=args.write_workers)
     else:
         main(
             args.checkpoint,
@@ -1224,4 +1242,7 @@ if __name__ == '__main__':
             addToConfig=addtoconfig,
             test=args.test,
             arguments=arguments,
-            style_loc=args.style_loc)
+            style_loc=args.style_loc,
+            manifest=args.manifest,
+            batch_size=args.batch_size,
+            write_workers=args.write_workers)
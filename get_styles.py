@@ -12,7 +12,8 @@ from data_loader import getDataLoader
 from evaluators import *
 import math
 from collections import defaultdict
-import pickle
+from concurrent.futures import ThreadPoolExecutor
+from utils.style_store import StyleStore
 
 
 def main(
@@ -26,7 +27,9 @@ def main(
         addToConfig=None,
         test=False,
         verbosity=2,
-        transform_style=False):
+        transform_style=False,
+        num_workers=None,
+        flush_rows=4096):
     assert(saveDir is not None)
     np.random.seed(1234)
     torch.manual_seed(1234)
@@ -50,13 +53,13 @@ def main(
         loaded_iteration = None
 
     train_loc = os.path.join(
-        saveDir, 'train_styles_{}.pkl'.format(loaded_iteration))
+        saveDir, 'train_styles_{}'.format(loaded_iteration))
     if not test:
         val_loc = os.path.join(
-            saveDir, 'val_styles_{}.pkl'.format(loaded_iteration))
+            saveDir, 'val_styles_{}'.format(loaded_iteration))
     else:
         val_loc = os.path.join(
-            saveDir, 'test_styles_{}.pkl'.format(loaded_iteration))
+            saveDir, 'test_styles_{}'.format(loaded_iteration))
 
     config['optimizer_type'] = "none"
     config['trainer']['use_learning_schedule'] = False
@@ -162,115 +165,125 @@ def main(
     #saveFunc = eval(trainer_class+'_printer')
     saveFunc = eval(config['data_loader']['data_set_name'] + '_eval')
 
-    step = 5
+    if index is None:
+        charSpec = trainer.model.char_style_dim > 0
+        if not test:
+            extract_styles(trainer, data_loader, train_loc, 'train',
+                           loaded_iteration, charSpec, gpu, batchSize,
+                           num_workers, flush_rows, transform_style)
+        validName = 'valid' if not test else 'test'
+        extract_styles(trainer, valid_data_loader, val_loc, validName,
+                       loaded_iteration, charSpec, gpu, vBatchSize,
+                       num_workers, flush_rows, transform_style)
+
+
+def clear_model_state(model):
+    # extract_style reuses these if they're set, so they can't carry over to
+    # the next batch
+    for name in ['spaced_label', 'mask', 'gen_mask', 'top_and_bottom',
+                 'counts', 'pred', 'spacing_pred', 'mask_pred', 'gen_spaced',
+                 'spaced_style', 'mu', 'sigma']:
+        setattr(model, name, None)
+
+
+def extract_styles(trainer, data_loader, store_loc, name, iteration, charSpec,
+                   gpu, batch_size, num_workers, flush_rows, transform_style):
+    # Extract the style of every line of data_loader's dataset into the
+    # style store at store_loc, flush_rows at a time. The store records how
+    # many dataset instances are done, so a rerun continues from there (the
+    # dataset isn't shuffled here, so it's the same order).
+    store = StyleStore(store_loc, 'a')
+    if 'iteration' in store.info:
+        assert store.info['iteration'] == iteration, \
+            '{} has styles from iteration {}, remove it to redo'.format(
+                store_loc, store.info['iteration'])
+    if 'done' in store.info and store.info['done']:
+        print('{} already done ({} styles)'.format(store_loc, len(store)))
+        return
+    dataset = data_loader.dataset
+    start = store.info['next'] if 'next' in store.info else 0
+    if start > 0:
+        print('resuming {} at {}/{}'.format(name, start, len(dataset)))
+        dataset = torch.utils.data.Subset(
+            dataset, range(start, len(dataset)))
+    if num_workers is None:
+        num_workers = data_loader.num_workers
+    # the workers load the next batches while the model runs, and pinned
+    # memory lets the copy to the GPU not block
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=False,
+        num_workers=num_workers, collate_fn=data_loader.collate_fn,
+        pin_memory=gpu is not None)
+
+    inference_mode = torch.inference_mode if hasattr(
+        torch, 'inference_mode') else torch.no_grad
+    # the store is written by another thread, one flush at a time
+    writer = ThreadPoolExecutor(1)
+    writing = None
+    styles = []
+    authors = []
+    ids = []
+    num_rows = 0
+    next_index = start
+    with inference_mode():
+        for i, instance in enumerate(loader):
+            print('{}: {}/{}       '.format(name, i, len(loader)), end='\r')
+            image = instance['image']
+            label = instance['label']
+            if gpu is not None:
+                image = image.to(gpu, non_blocking=True)
+                label = label.to(gpu, non_blocking=True)
+            a_batch_size = trainer.a_batch_size if 'a_batch_size' in instance else None
+
+            style = trainer.model.extract_style(image, label, a_batch_size)
+            if transform_style:
+                style = trainer.model.generator.style_emb(style)
+            clear_model_state(trainer.model)
 
-    if data_loader is not None:
-        train_iter = iter(data_loader)
-    if valid_data_loader is not None:
-        valid_iter = iter(valid_data_loader)
-
-    with torch.no_grad():
-
-        if index is None:
-
-            val_metrics_sum = np.zeros(len(metrics))
-            val_metrics_list = defaultdict(lambda: defaultdict(list))
-            val_comb_metrics = defaultdict(list)
-
-            validName = 'valid' if not test else 'test'
-            charSpec = trainer.model.char_style_dim > 0
-
-            train_styles = []
-            train_authors = []
-            if not test:
-                for i, instance in enumerate(data_loader):
-                    print('train: {}/{}       '.format(i,
-                          len(data_loader)), end='\r')
-                    image, label = trainer._to_tensor(instance)
-                    batch_size = label.size(1)
-                    label_lengths = instance['label_lengths']
-                    a_batch_size = trainer.a_batch_size if 'a_batch_size' in instance else None
-
-                    style = trainer.model.extract_style(
-                        image, label, a_batch_size)
-
-                    if transform_style:
-                        style = trainer.model.generator.style_emb(style)
-                    if charSpec:
-                        for b in range(batch_size):
-                            train_styles.append(
-                                (style[0][b].cpu(), style[1][b].cpu(), style[2][b].cpu()))
-                    else:
-                        train_styles.append(style.cpu())
-                    train_authors += instance['author']
-
-                    trainer.model.spaced_label = None
-                    trainer.model.mask = None
-                    trainer.model.gen_mask = None
-                    trainer.model.top_and_bottom = None
-                    trainer.model.counts = None
-                    trainer.model.pred = None
-                    trainer.model.spacing_pred = None
-                    trainer.model.mask_pred = None
-                    trainer.model.gen_spaced = None
-                    trainer.model.spaced_style = None
-                    trainer.model.mu = None
-                    trainer.model.sigma = None
-                if charSpec:
-                    train_styles = [
-                        (s[0].numpy(), s[1].numpy(), s[2].numpy()) for s in train_styles]
-                else:
-                    train_styles = torch.cat(train_styles, dim=0).numpy()
-                train_authors = np.array(train_authors)
-                pickle.dump({'styles': train_styles,
-                            'authors': train_authors}, open(train_loc, 'wb'))
-                print('saved {}'.format(train_loc))
-
-            val_styles = []
-            val_authors = []
-            for i, instance in enumerate(valid_data_loader):
-                print('{}: {}/{}       '.format(validName,
-                      i, len(valid_data_loader)), end='\r')
-                image, label = trainer._to_tensor(instance)
-                batch_size = label.size(1)
-                label_lengths = instance['label_lengths']
-                a_batch_size = trainer.a_batch_size if 'a_batch_size' in instance else None
-
-                style = trainer.model.extract_style(image, label, a_batch_size)
-
-                if transform_style:
-                    style = trainer.model.generator.style_emb(style)
-                if charSpec:
-                    for b in range(batch_size):
-                        val_styles.append(
-                            (style[0][b].cpu(), style[1][b].cpu(), style[2][b].cpu()))
-                else:
-                    val_styles.append(style.cpu())
-
-                val_authors += instance['author']
-
-                trainer.model.spaced_label = None
-                trainer.model.mask = None
-                trainer.model.gen_mask = None
-                trainer.model.top_and_bottom = None
-                trainer.model.counts = None
-                trainer.model.pred = None
-                trainer.model.spacing_pred = None
-                trainer.model.mask_pred = None
-                trainer.model.gen_spaced = None
-                trainer.model.spaced_style = None
-                trainer.model.mu = None
-                trainer.model.sigma = None
             if charSpec:
-                val_styles = [(s[0].numpy(), s[1].numpy(), s[2].numpy())
-                              for s in val_styles]
-                assert(len(val_styles) == len(val_authors))
+                styles.append(tuple(s.cpu().numpy() for s in style))
             else:
-                val_styles = torch.cat(val_styles, dim=0).numpy()
-            val_authors = np.array(val_authors)
-            pickle.dump(
-                {'styles': val_styles, 'authors': val_authors}, open(val_loc, 'wb'))
-            print('saved {}'.format(val_loc))
+                styles.append(style.cpu().numpy())
+            authors += instance['author']
+            if 'name' in instance:
+                # the lines each style was extracted from
+                group = a_batch_size if a_batch_size is not None else 1
+                names = instance['name']
+                ids += [names[b - b % group:b - b % group + group]
+                        for b in range(len(instance['author']))]
+            num_rows += len(instance['author'])
+            next_index = start + min((i + 1) * batch_size,
+                                     len(loader.dataset))
+
+            if num_rows >= flush_rows:
+                writing = flush(writer, writing, store, styles, authors, ids,
+                                charSpec, {'next': next_index,
+                                           'iteration': iteration})
+                styles = []
+                authors = []
+                ids = []
+                num_rows = 0
+    writing = flush(writer, writing, store, styles, authors, ids, charSpec,
+                    {'next': next_index, 'iteration': iteration, 'done': True})
+    writing.result()
+    writer.shutdown()
+    print('saved {} ({} styles)'.format(store_loc, len(store)))
+
+
+def flush(writer, writing, store, styles, authors, ids, charSpec, info):
+    # wait for the previous write and start writing these rows
+    if charSpec:
+        styles = tuple(np.concatenate([s[k] for s in styles], axis=0)
+                       for k in range(3)) if len(styles) > 0 else None
+    else:
+        styles = np.concatenate(styles, axis=0) if len(styles) > 0 else None
+    if writing is not None:
+        writing.result()
+    if styles is None:
+        # nothing new, only the info
+        return writer.submit(store.update_info, info)
+    return writer.submit(store.append, styles, authors,
+                         ids if len(ids) > 0 else None, info)
 
 
 if __name__ == '__main__':
@@ -319,6 +332,10 @@ if __name__ == '__main__':
         action='store_const',
         const=True,
         help="use generator's style embedding function")
+    parser.add_argument('-w', '--workers', default=None, type=int,
+                        help='data loading processes (default: use config)')
+    parser.add_argument('-F', '--flush', default=4096, type=int,
+                        help='styles extracted between writes to the store, which is where a rerun resumes (default: 4096)')
     # parser.add_argument('-E', '--special_eval', default=None, type=str,
     #                    help='what to evaluate (print)')
 
@@ -356,7 +373,9 @@ if __name__ == '__main__':
                 addToConfig=addtoconfig,
                 test=args.test,
                 verbosity=args.verbosity,
-                transform_style=args.transformstyle)
+                transform_style=args.transformstyle,
+                num_workers=args.workers,
+                flush_rows=args.flush)
     else:
         main(
             args.checkpoint,
@@ -369,4 +388,6 @@ if __name__ == '__main__':
             addToConfig=addtoconfig,
             test=args.test,
             verbosity=args.verbosity,
-            transform_style=args.transformstyle)
+            transform_style=args.transformstyle,
+            num_workers=args.workers,
+            flush_rows=args.flush)
@@ -6,7 +6,9 @@ import logging
 import argparse
 import torch
 from collections import defaultdict
+import time
 import numpy as np
+from logger import Logger, read_entries
 from sys import platform as sys_pf
 # if sys_pf == 'darwin':
 #    import matplotlib
@@ -15,14 +17,45 @@ from sys import platform as sys_pf
 logging.basicConfig(level=logging.INFO, format='')
 
 
-def graph(log, plot=True, prefix=None):
-    graphs = defaultdict(lambda: {'iters': [], 'values': []})
-    for index, entry in log.entries.items():
+def load_log(path):
+    # path is a checkpoint or a log file (log.jsonl)
+    # returns the entries, the log file (None if the log is all in the
+    # checkpoint) and where its entries end
+    if path.endswith('.jsonl'):
+        entries, end = read_entries(path)
+        return entries, path, end
+    saved = torch.load(
+        path,
+        map_location=lambda storage,
+        loc: storage)
+    log = saved['logger']
+    print('loaded iteration {}'.format(saved['iteration']))
+    saved = None
+    if log.path is None:
+        return [log.entries[i] for i in sorted(log.entries.keys())], None, 0
+    log_path = log.path
+    if not os.path.exists(log_path):
+        # checkpoint was moved, look next to it
+        log_path = os.path.join(os.path.dirname(path), 'log.jsonl')
+    entries, end = read_entries(log_path, 0, log.size)
+    return entries, log_path, end
+
+
+def collect(entries, graphs=None):
+    if graphs is None:
+        graphs = defaultdict(lambda: {'iters': [], 'values': []})
+    for entry in entries:
         iteration = entry['iteration']
         for metric, value in entry.items():
             if metric != 'iteration':
                 graphs[metric]['iters'].append(iteration)
                 graphs[metric]['values'].append(value)
+    return graphs
+
+
+def graph(entries, plot=True, prefix=None, graphs=None, show=True):
+    if graphs is None:
+        graphs = collect(entries)
 
     print('summed')
     skip = []
@@ -46,12 +79,14 @@ def graph(log, plot=True, prefix=None):
                     prefix is not None and metric[:len(prefix)] == prefix):
                 #print('{} == {}? {}'.format(metric[:len(prefix)],prefix,metric[:len(prefix)]==prefix))
                 plt.figure(i)
+                plt.clf()
                 i += 1
                 plt.plot(data['iters'], data['values'], '.-')
                 plt.xlabel('iterations')
                 plt.ylabel(metric)
                 plt.title(metric)
-        plt.show()
+        if show:
+            plt.show()
     else:
         i = 1
         for metric, data in graphs.items():
@@ -76,24 +111,52 @@ if __name__ == '__main__':
         default=None,
         type=str,
         help='instead of ploting, save a new file with only the log (default: None)')
+    parser.add_argument(
+        '-f',
+        '--follow',
+        default=None,
+        type=float,
+        help='keep reading new entries of a live run every this many seconds (default: None)')
 
     args = parser.parse_args()
 
     assert args.checkpoint is not None
-    saved = torch.load(
-        args.checkpoint,
-        map_location=lambda storage,
-        loc: storage)
-    log = saved['logger']
-    iteration = saved['iteration']
-    print('loaded iteration {}'.format(iteration))
-    saved = None
+    entries, log_path, end = load_log(args.checkpoint)
+    if len(entries) > 0:
+        print('{} entries, last iteration {}'.format(
+            len(entries), entries[-1]['iteration']))
 
-    if args.extract is None:
-        graph(log, args.plot, args.only)
+    if args.follow is not None:
+        # tail the log of a run that's still training
+        assert log_path is not None, 'this log is all in the checkpoint'
+        graphs = collect(entries)
+        if args.plot:
+            import matplotlib.pyplot as plt
+            plt.ion()
+        else:
+            graph(None, False, args.only, graphs=graphs)
+        while True:
+            if args.plot:
+                graph(None, True, args.only, graphs=graphs, show=False)
+                plt.pause(args.follow)
+            else:
+                time.sleep(args.follow)
+            new_entries, end = read_entries(log_path, end)
+            collect(new_entries, graphs)
+            if not args.plot:
+                for entry in new_entries:
+                    print('{}: {}'.format(entry['iteration'], {
+                        k: v for k, v in entry.items()
+                        if k[:3] == 'avg' or k[:3] == 'val'}), flush=True)
+    elif args.extract is None:
+        graph(entries, args.plot, args.only)
     else:
+        # an in-memory log, so the file has everything
+        log = Logger()
+        for entry in entries:
+            log.add_entry(entry)
         new_save = {
-            'iteration': iteration,
+            'iteration': entries[-1]['iteration'] if len(entries) > 0 else None,
             'logger': log
         }
         new_file = args.extract  # args.checkpoint+'.ex'
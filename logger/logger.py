@@ -1,5 +1,31 @@
 # from https://github.com/victoresque/pytorch-template
+import os
 import json
+import numpy as np
+
+
+def _to_json(value):
+    # numpy/torch values that end up in the training log
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def read_entries(path, start=0, end=None):
+    # entries of a log file from byte offset start (up to end), and the offset
+    # after the last complete line, so a live log can be tailed by passing it
+    # back in as start
+    entries = []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read() if end is None else f.read(max(end - start, 0))
+    last = data.rfind(b'\n') + 1  # a line still being written is left out
+    for line in data[:last].splitlines():
+        if len(line) > 0:
+            entries.append(json.loads(line.decode('utf-8')))
+    return entries, start + last
 
 
 class Logger:
@@ -8,13 +34,76 @@ class Logger:
 
     Note:
         Used by BaseTrainer to save training history.
+        Once open()ed, entries are appended to a JSON-lines file as they are
+        added instead of being kept in memory, and a pickled Logger (in a
+        checkpoint) is only the file's path and how much of it was written.
     """
 
-    def __init__(self):
-        self.entries = {}
+    def __init__(self, path=None):
+        self.path = None
+        self.size = 0  # bytes of the file that are this log
+        self.count = 0
+        self._entries = {}
+        self.file = None
+        if path is not None:
+            self.open(path)
+
+    def open(self, path):
+        # Log to path from now on. An in-memory log (new, or from an old
+        # checkpoint) starts the file over with its entries; a log that was
+        # already there (resuming) drops whatever was written after it was
+        # saved, as that's from iterations that will be redone.
+        if self.path is None:
+            with open(path, 'w') as f:
+                for index in sorted(self._entries.keys()):
+                    f.write(json.dumps(
+                        self._entries[index], default=_to_json) + '\n')
+            self.count = len(self._entries)
+            self._entries = {}
+        elif not os.path.exists(path) or os.path.getsize(path) < self.size:
+            print('WARNING: log file {} is missing entries'.format(path))
+            if not os.path.exists(path):
+                open(path, 'w').close()
+        else:
+            with open(path, 'r+') as f:
+                f.truncate(self.size)
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.file = None
 
     def add_entry(self, entry):
-        self.entries[len(self.entries) + 1] = entry
+        if self.path is None:
+            self._entries[len(self._entries) + 1] = entry
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        line = json.dumps(entry, default=_to_json) + '\n'
+        self.file.write(line)
+        self.file.flush()  # so it can be followed while training
+        self.size += len(line.encode('utf-8'))
+        self.count += 1
+
+    @property
+    def entries(self):
+        if self.path is None:
+            return self._entries
+        entries, end = read_entries(self.path, 0, self.size)
+        return {i + 1: entry for i, entry in enumerate(entries)}
+
+    def __getstate__(self):
+        return {'path': self.path,
+                'size': self.size,
+                'count': self.count,
+                '_entries': dict(self._entries)}
+
+    def __setstate__(self, state):
+        if 'entries' in state:
+            # pickled before logs were files
+            state = {'path': None, 'size': 0, 'count': 0,
+                     '_entries': state['entries']}
+        self.__dict__.update(state)
+        self.file = None
 
     def __str__(self):
-        return json.dumps(self.entries, sort_keys=True, indent=4)
+        return json.dumps(self.entries, sort_keys=True,
+                          indent=4, default=_to_json)
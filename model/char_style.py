@@ -3,8 +3,6 @@ from torch import nn
 import torch.nn.functional as F
 from utils.util import getGroupSize
 import copy
-import math
-from collections import defaultdict
 import random
 
 
@@ -333,123 +331,101 @@ class CharStyleEncoder(nn.Module):
 
         # taking max prediction, may want to to both max and 2nd?
         recogPred = torch.argmax(recog, dim=1)
-        fill_styles = [[] for b in range(batch_size)]
-        found_chars_style = {}
-        if self.single_style:
-            b_sum = torch.FloatTensor(batch_size).fill_(0).to(x.device)
-            total_style = torch.FloatTensor(
-                batch_size,
-                self.char_style_dim).fill_(0).to(
-                x.device)
-        for char_n in range(1, self.n_class):
-            locs = recogPred == char_n
-            if locs.any():
-                patches = []
-                b_weight = []
-                for b in range(batch_size):
-                    # x locations of each instance of char_n
-                    horz_cents = locs[b].nonzero()
-                    for horz_cent in horz_cents:
-                        # pad out a window
-                        left = max(0, horz_cent.item() - self.window)
-                        pad_left = left - (horz_cent.item() - self.window)
-                        right = min(
-                            x.size(2) - 1, horz_cent.item() + self.window)
-                        pad_right = (horz_cent.item() + self.window) - right
-                        wind = x[b:b + 1, :, left:right + 1]
-                        if pad_left > 0 or pad_right > 0:
-                            wind = F.pad(wind, (pad_left, pad_right))
-                        assert(wind.size(2) == self.window * 2 + 1)
-                        patches.append(wind)
-                        # keep track of batch in pred score
-                        b_weight.append(
-                            (b, math.exp(recog[b, char_n, horz_cent.item()])))
-                patches = torch.cat(patches, dim=0)
-                char_styles = self.char_extractor[char_n](patches)
 
-                if self.single_style:
-                    for i, (b, score) in enumerate(b_weight):
-                        total_style[b] += score * char_styles[i]
-                        b_sum[b] += score
-                else:
-                    b_sum = defaultdict(lambda: 0)  # [0]*batch_size
+        # a zero-padded window around every predicted (non-blank) character,
+        # taken all at once, then grouped by class (stable, so within a class
+        # they stay ordered by batch then position)
+        locs = (recogPred > 0).nonzero()
+        order = torch.argsort(
+            recogPred[locs[:, 0], locs[:, 1]] * recogPred.numel() +
+            torch.arange(locs.size(0), device=x.device))
+        b_idx = locs[order, 0]
+        horz_cents = locs[order, 1]
+        chars = recogPred[b_idx, horz_cents]
+        windows = F.pad(x, (self.window, self.window)).unfold(
+            2, self.window * 2 + 1, 1)  # batch x channel x width x window
+        patches = windows[b_idx, :, horz_cents]
+        # keep track of batch in pred score
+        scores = torch.exp(recog[b_idx, chars, horz_cents])
+        found_chars, char_counts = torch.unique_consecutive(
+            chars, return_counts=True)
+        found_chars = found_chars.tolist()
+        char_counts = char_counts.tolist()
 
-                    found_chars_style[char_n] = defaultdict(
-                        lambda: torch.FloatTensor(
-                            self.char_style_dim).fill_(0).to(
-                            x.device))
+        char_styles = []
+        start = 0
+        for char_n, count in zip(found_chars, char_counts):
+            char_styles.append(self.char_extractor[char_n](
+                patches[start:start + count]))
+            start += count
+        if len(char_styles) > 0:
+            char_styles = torch.cat(char_styles, dim=0)
+        else:
+            char_styles = x.new_zeros(0, self.char_style_dim)
+        weighted_styles = scores[:, None] * char_styles
 
-                    # perform weighted average over all locations of char_n (by
-                    # batch, of course)
-                    for i, (b, score) in enumerate(b_weight):
-                        # if b in found_chars_style[char_n]
-                        #char_style[b] += score * char_styles[i]
-                        #assert(not torch.isnan(char_style[b]).any())
-                        found_chars_style[char_n][b] += score * char_styles[i]
-                        b_sum[b] += score
-                    bs_of_interest = list(found_chars_style[char_n].keys())
-                    for b in bs_of_interest:
-                        assert(b_sum[b] != 0)
-                        found_chars_style[char_n][b] /= b_sum[b]
-                    # predict all other character styles, from this char_n
-                    # style
-                    char_style = torch.stack(
-                        [found_chars_style[char_n][b] for b in bs_of_interest], dim=0)
-                    fill_pred = self.fill_pred[char_n](char_style)
-                    for i, b in enumerate(bs_of_interest):
-                        fill_styles[b].append(fill_pred[i])
+        if self.single_style:
+            total_style = x.new_zeros(batch_size, self.char_style_dim).index_add(
+                0, b_idx, weighted_styles)
+            b_sum = x.new_zeros(batch_size).index_add(0, b_idx, scores)
+            avg_char_style = torch.where(
+                b_sum[..., None] != 0, total_style / b_sum[..., None], total_style)
+        else:
+            # perform weighted average over all locations of each char (by
+            # batch, of course), rows are char*batch_size+b
+            char_b = chars * batch_size + b_idx
+            num_rows = self.n_class * batch_size
+            found_style = x.new_zeros(num_rows, self.char_style_dim).index_add(
+                0, char_b, weighted_styles)
+            b_sum = x.new_zeros(num_rows).index_add(0, char_b, scores)
+            found = torch.zeros(num_rows, dtype=torch.bool, device=x.device)
+            found[char_b] = True
+            found_style = torch.where(
+                found[:, None], found_style / b_sum.clamp(min=1e-30)[:, None], found_style)
+            found_style = found_style.view(
+                self.n_class, batch_size, self.char_style_dim)
+            found = found.view(self.n_class, batch_size)
 
-        if not self.single_style:
-            # average fill styles across the predictions from each found
-            # character's style
-            fill_bs = []
-            for b in range(batch_size):
-                if len(fill_styles[b]) > 0:
-                    fill_bs.append(
-                        torch.stack(
-                            fill_styles[b],
-                            dim=0).mean(
-                            dim=0))
-                else:
-                    fill_bs.append(
-                        torch.FloatTensor(
-                            self.n_class *
-                            self.char_style_dim).fill_(0).to(
-                            x.device))
-            # this is a pain, we chunk to prevent "inplace operation" in the
-            # following loop
-            all_char_style = [
-                list(
-                    torch.chunk(
-                        styles,
-                        self.n_class,
-                        dim=0)) for styles in fill_bs]
+            # predict all other character styles from each found char's
+            # style, and average those predictions for each batch
+            fill_sum = x.new_zeros(
+                batch_size, self.n_class * self.char_style_dim)
+            fill_count = x.new_zeros(batch_size)
+            for char_n in found_chars:
+                bs_of_interest = found[char_n].nonzero()[:, 0]
+                fill_pred = self.fill_pred[char_n](
+                    found_style[char_n, bs_of_interest])
+                fill_sum = fill_sum.index_add(0, bs_of_interest, fill_pred)
+                fill_count = fill_count.index_add(
+                    0, bs_of_interest, torch.ones_like(bs_of_interest, dtype=x.dtype))
+            all_char_style = torch.where(
+                fill_count[:, None] > 0, fill_sum / fill_count.clamp(min=1)[:, None], fill_sum)
+            all_char_style = all_char_style.view(
+                batch_size, self.n_class, self.char_style_dim)
 
             # substitute in the styles of the characters we actually found
-            for char_n, char_style in found_chars_style.items():
-                for b in char_style:
-                    if self.average_found_char_style > 0:
-                        all_char_style[b][char_n] = char_style[b] * (
-                            1 - self.average_found_char_style) + all_char_style[b][char_n] * (
-                            self.average_found_char_style)
-                    elif self.average_found_char_style < 0:
-                        if self.training:
-                            mix = random.random() * (-self.average_found_char_style)
-                        else:
-                            mix = 0.1
-                        all_char_style[b][char_n] = char_style[b] * \
-                            (1 - mix) + all_char_style[b][char_n] * (mix)
-                    else:
-                        all_char_style[b][char_n] = char_style[b]
-            # stack different characters together (for each batch)
-            all_char_style = [torch.stack(styles, dim=0)
-                              for styles in all_char_style]
-            all_char_style = torch.stack(
-                all_char_style, dim=0)  # stack batch together
+            found = found.t()
+            found_style = found_style.permute(1, 0, 2)
+            if self.average_found_char_style > 0:
+                mix = self.average_found_char_style
+            elif self.average_found_char_style < 0:
+                if self.training:
+                    # drawn per found char, per batch, in (char, batch) order
+                    mix = x.new_zeros(self.n_class, batch_size)
+                    mix[found.t()] = torch.tensor(
+                        [random.random() * (-self.average_found_char_style)
+                         for i in range(int(found.sum()))],
+                        dtype=x.dtype, device=x.device)
+                    mix = mix.t()[..., None]
+                else:
+                    mix = 0.1
+            else:
+                mix = None
+            if mix is not None:
+                found_style = found_style * (1 - mix) + all_char_style * mix
+            all_char_style = torch.where(
+                found[..., None], found_style, all_char_style)
             avg_char_style = all_char_style.sum(dim=1) / self.n_class
-        else:
-            avg_char_style = torch.where(
-                b_sum[..., None] != 0, total_style / b_sum[..., None], total_style)
 
         xr = torch.cat((F.relu(x), recog), dim=1)
         xr = self.prep(xr)
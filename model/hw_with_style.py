@@ -12,82 +12,11 @@ from model.pure_gen import SpacedGenerator
 from model.discriminator_ap import DiscriminatorAP
 from model.char_style import CharStyleEncoder
 from model.count_cnn import CountCNN
+from utils.alignment import correct_pred
 from skimage import draw
 import os
 
 
-def correct_pred(pred, label):
-    # Get optimal alignment
-    # use DTW
-    # introduce blanks at front, back, and inbetween chars
-    label_with_blanks = torch.LongTensor(
-        label.size(0) * 2 + 1, label.size(1)).zero_()
-    label_with_blanks[1::2] = label.cpu()
-    pred_use = pred.cpu().detach()
-
-    batch_size = pred_use.size(1)
-    label_len = label_with_blanks.size(0)
-    pred_len = pred_use.size(0)
-
-    dtw = torch.FloatTensor(
-        pred_len + 1,
-        label_len + 1,
-        batch_size).fill_(
-        float('inf'))
-    dtw[0, 0] = 0
-    w = max(pred_len // 2, abs(pred_len - label_len))
-    for i in range(1, pred_len + 1):
-        dtw[i, max(1, i - w):min(label_len, i + w) + 1] = 0
-    history = torch.IntTensor(pred_len, label_len, batch_size)
-    for i in range(1, pred_len + 1):
-        for j in range(max(1, i - w), min(label_len, i + w) + 1):
-            cost = 1 - \
-                pred_use[i - 1, torch.arange(0, batch_size).long(), label_with_blanks[j - 1, :]]
-            per_batch_min, history[i -
-                                   1, j -
-                                   1] = torch.min(torch.stack((dtw[i -
-                                                                   1, j], dtw[i -
-                                                                              1, j -
-                                                                              1], dtw[i, j -
-                                                                                      1])), dim=0)
-            dtw[i, j] = cost + per_batch_min
-    new_labels = []
-    maxlen = 0
-    for b in range(batch_size):
-        new_label = []
-        i = pred_len - 1
-        j = label_len - 1
-        #accum += allCosts[b,i,j]
-        new_label.append(label_with_blanks[j, b])
-        while(i > 0 or j > 0):
-            if history[i, j, b] == 0:
-                i -= 1
-            elif history[i, j, b] == 1:
-                i -= 1
-                j -= 1
-            elif history[i, j, b] == 2:
-                j -= 1
-            # accum+=allCosts[b,i,j]
-            new_label.append(label_with_blanks[j, b])
-        new_label.reverse()
-        maxlen = max(maxlen, len(new_label))
-        new_label = torch.stack(new_label, dim=0)
-        new_labels.append(new_label)
-
-    new_labels = [F.pad(l, (0, maxlen - l.size(0)), value=0)
-                  for l in new_labels]
-    new_label = torch.LongTensor(maxlen, batch_size)
-    for b, l in enumerate(new_labels):
-        new_label[:l.size(0), b] = l
-
-    # set to one hot at alignment
-    #new_label = self.onehot(new_label)
-    # fuzzy other neighbor preds
-    # TODO
-
-    return new_label.to(label.device)
-
-
 class HWWithStyle(BaseModel):
     def __init__(self, config):
         super(HWWithStyle, self).__init__(config)
@@ -372,36 +301,48 @@ class HWWithStyle(BaseModel):
         return style
 
     def insert_spaces(self, label, label_lengths, counts):
-        max_count = max(math.ceil(counts.max()), 3)
-        lines = []
-        max_line_len = 0
+        # Each character gets a (sampled) number of blanks before it and
+        # (sampled) number of copies of itself, then the line is padded with
+        # blanks. Done for the whole batch at once on counts' device.
+        counts = counts.detach()
+        device = counts.device
+        max_count = max(math.ceil(counts.max().item()), 3)
+        num_chars = label.size(0)
         batch_size = label.size(1)
-        for b in range(batch_size):
-            line = []
-            for i in range(label_lengths[b]):
-                count = round(np.random.normal(
-                    counts[i, b, 0].item(), self.count_std))
-                if self.count_duplicates:
-                    duplicates = round(np.random.normal(
-                        counts[i, b, 1].item(), self.dup_std))
-                else:
-                    duplicates = 1
-                line += [0] * count + [label[i][b]] * duplicates
-            max_line_len = max(max_line_len, len(line))
-            lines.append(line)
-
-        spaced = torch.zeros(
-            max_line_len +
-            max_count,
-            batch_size,
-            self.num_class)
-        padded = []
-        for b in range(batch_size):
-            for i, cls in enumerate(lines[b]):
-                spaced[i, b, cls] = 1
-            for i in range(len(lines[b]), spaced.size(0)):
-                spaced[i, b, 0] = 1
-            padded.append((spaced.size(0) - len(lines[b])) / spaced.size(0))
+        label = label.to(device).long()
+        label_lengths = torch.as_tensor(label_lengths, device=device)
+        valid = (torch.arange(num_chars, device=device)
+                 [:, None] < label_lengths[None, :]).long()
+
+        # rounds half to even, as round() did; negative means none
+        blanks = torch.round(torch.normal(
+            counts[:num_chars, :, 0], self.count_std)).long().clamp(min=0) * valid
+        if self.count_duplicates:
+            duplicates = torch.round(torch.normal(
+                counts[:num_chars, :, 1], self.dup_std)).long().clamp(min=0) * valid
+        else:
+            duplicates = valid
+        # where each character's copies end in its line
+        char_end = torch.cumsum(blanks + duplicates, dim=0)
+        line_lengths = char_end[-1] if num_chars > 0 else torch.zeros(
+            batch_size, dtype=torch.long, device=device)
+        max_line_len = int(line_lengths.max()) if batch_size > 0 else 0
+        width = max_line_len + max_count
+
+        # one entry per character copy
+        duplicates = duplicates.view(-1)
+        copy_char = torch.repeat_interleave(
+            torch.arange(duplicates.size(0), device=device), duplicates)
+        copy_start = torch.cumsum(duplicates, dim=0) - duplicates
+        copy_num = torch.arange(copy_char.size(0), device=device) - \
+            copy_start[copy_char]
+        position = (char_end.view(-1) - duplicates)[copy_char] + copy_num
+
+        classes = torch.zeros(width, batch_size, dtype=torch.long, device=device)
+        classes[position, copy_char % batch_size] = label.view(-1)[copy_char]
+        spaced = torch.zeros(width, batch_size, self.num_class, device=device)
+        spaced.scatter_(2, classes[:, :, None], 1)
+        padded = ((width - line_lengths).float() / width).tolist()
 
         return spaced, padded
 
@@ -422,23 +363,13 @@ class HWWithStyle(BaseModel):
         spacing_style = spacing_style.to(device)
         char_style = char_style.to(device)
         batch_size = spaced.size(1)
-        style = torch.FloatTensor(
-            spaced.size(0),
-            batch_size,
-            self.char_style_dim).to(device)
         text_chars = spaced.argmax(dim=2)
-        # add temporal dim for broadcast
-        spacing_style = spacing_style[None, :, :]
         # Put character styles in appropriate places. Fill in rest with
         # projected global style
-        for b in range(batch_size):
-            lastChar = -1
-            for x in range(0, text_chars.size(0)):
-                if text_chars[x, b] != 0:
-                    charIdx = text_chars[x, b]
-                    style[x, b, :] = char_style[b, charIdx]
-                    style[lastChar +
-                          1:x, b, :] = spacing_style[:, b]  # broadcast
-                    lastChar = x
-            style[lastChar + 1:, b, :] = spacing_style[:, b]
+        batch_idx = torch.arange(batch_size, device=device)[None, :]
+        style = char_style[batch_idx, text_chars]  # Width x Batch x Channel
+        is_char = (text_chars != 0)[:, :, None]
+        # add temporal dim for broadcast
+        style = torch.where(
+            is_char, style, spacing_style[None, :, :].expand_as(style))
         return (g_style, style, char_style)
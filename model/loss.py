@@ -40,5 +40,7 @@ def AdaptiveHingeLoss(input, target, threshold):
 
 
 def CTCLoss(input, target, input_len, target_len):
-    ret = F.ctc_loss(input, target, input_len, target_len)
+    # always fp32, also under autocast
+    with torch.autocast(device_type=input.device.type, enabled=False):
+        ret = F.ctc_loss(input.float(), target, input_len, target_len)
     return torch.where(torch.isinf(ret), torch.zeros_like(ret), ret)
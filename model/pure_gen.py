@@ -192,7 +192,10 @@ class Blur(nn.Module):
                 channel, 1, 1, 1))
 
     def forward(self, input):
-        return blur(input, self.weight, self.weight_flip)
+        # the blur's custom autograd functions run in fp32 (their backward
+        # isn't autocast), also when training with mixed precision
+        with torch.autocast(device_type=input.device.type, enabled=False):
+            return blur(input.float(), self.weight, self.weight_flip)
         # return F.conv2d(input, self.weight, padding=1, groups=input.shape[1])
 
 
@@ -291,6 +294,8 @@ class EqualLR:
         self.name = name
 
     def compute_weight(self, module):
+        # the fp32 parameter is scaled in fp32 (autocast only casts it for
+        # the layer's op)
         weight = getattr(module, self.name + '_orig')
         fan_in = weight.data.size(1) * weight.data[0][0].numel()
 
@@ -0,0 +1,48 @@
+import json
+import argparse
+from datasets import author_hw_dataset
+from datasets import author_rimeslines_dataset
+from datasets import author_best_dataset
+from utils.line_store import pack_lines
+
+# One-time packing of a dataset's lines (cropped and height-normalized) into a
+# memory-mapped line store. Set "line_store" in the config's data_loader to the
+# output path to use it.
+# python pack_lines.py -c configs/cf_IAM_hwr_cnnOnly_batchnorm_aug.json -o ../data/IAM/lines
+
+DATASETS = {
+    'AuthorHWDataset': author_hw_dataset.AuthorHWDataset,
+    'AuthorRIMESLinesDataset': author_rimeslines_dataset.AuthorRIMESLinesDataset,
+    'AuthorBESTDataset': author_best_dataset.AuthorBESTDataset,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pack the lines of a dataset into a line store')
+    parser.add_argument('-c', '--config', default=None, type=str,
+                        help='config file path (default: None)')
+    parser.add_argument('-o', '--out', default=None, type=str,
+                        help='path of line store to write (.bin and .json are appended)')
+    parser.add_argument('-s', '--splits', default='train,valid,test', type=str,
+                        help='splits to pack (default: train,valid,test)')
+    args = parser.parse_args()
+    assert args.config is not None and args.out is not None
+
+    config = json.load(open(args.config))
+    data_config = config['data_loader']
+    # we only need the line lists, not anything derived from the images
+    for key in ['line_store', 'fg_masks_dir', 'style_loc', 'spaced_loc']:
+        data_config.pop(key, None)
+    setObj = DATASETS[data_config['data_set_name']]
+
+    sources = []
+    for split in args.splits.split(','):
+        dataset = setObj(
+            dirPath=data_config['data_dir'],
+            split=split,
+            config=data_config)
+        sources += dataset.line_sources()
+        print('{}: {} lines'.format(split, len(dataset.line_sources())))
+
+    max_width = data_config['max_width'] if 'max_width' in data_config else 3000
+    pack_lines(args.out, sources, data_config['img_height'], max_width)
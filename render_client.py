@@ -0,0 +1,96 @@
+import json
+import time
+import random
+import argparse
+import urllib.request
+import urllib.error
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Load test for render_server.py: sends num_requests render requests from
+# concurrency threads and reports latency percentiles and lines/sec.
+
+TEXTS = ['The quick brown fox jumps over the lazy dog.',
+         'Hello world',
+         'A line of handwriting',
+         'Pack my box with five dozen liquor jugs.',
+         'short',
+         'Sphinx of black quartz, judge my vow.']
+
+
+def get_authors(url):
+    with urllib.request.urlopen(url + '/authors') as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def render(url, job):
+    # (seconds, bytes of PNG, or None if it failed)
+    body = json.dumps(job).encode('utf-8')
+    request = urllib.request.Request(
+        url + '/render', data=body,
+        headers={'Content-Type': 'application/json'})
+    start = time.time()
+    try:
+        with urllib.request.urlopen(request) as response:
+            png = response.read()
+    except urllib.error.HTTPError as e:
+        print('{}: {}'.format(e.code, e.read().decode('utf-8')))
+        return time.time() - start, None
+    return time.time() - start, len(png)
+
+
+def main(url, num_requests, concurrency, texts, out):
+    authors = get_authors(url)
+    jobs = []
+    for i in range(num_requests):
+        job = {'text': random.choice(texts)}
+        if len(authors) > 0:
+            job['author'] = random.choice(authors)
+        jobs.append(job)
+
+    start = time.time()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda job: render(url, job), jobs))
+    elapsed = time.time() - start
+
+    failed = sum([r[1] is None for r in results])
+    latencies = np.array([r[0] for r in results if r[1] is not None])
+    if len(latencies) == 0:
+        print('all {} requests failed'.format(num_requests))
+        return
+    print('{} lines ({} failed), {} concurrent: {:.1f} lines/sec'.format(
+        num_requests, failed, concurrency, len(latencies) / elapsed))
+    print('latency p50 {:.3f}s  p90 {:.3f}s  p99 {:.3f}s  max {:.3f}s'.format(
+        *np.percentile(latencies, [50, 90, 99, 100])))
+    if out is not None:
+        with open(out, 'a') as f:
+            f.write(json.dumps({'requests': num_requests,
+                                'concurrency': concurrency,
+                                'failed': failed,
+                                'lines_per_sec': len(latencies) / elapsed,
+                                'p50': float(np.percentile(latencies, 50)),
+                                'p99': float(np.percentile(latencies, 99))}) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test for render_server.py')
+    parser.add_argument('-u', '--url', default='http://127.0.0.1:8008', type=str,
+                        help='server (default: http://127.0.0.1:8008)')
+    parser.add_argument('-n', '--num_requests', default=200, type=int,
+                        help='requests to send (default: 200)')
+    parser.add_argument('-c', '--concurrency', default=16, type=int,
+                        help='requests in flight at once (default: 16)')
+    parser.add_argument('-t', '--textfile', default=None, type=str,
+                        help='texts to render, one per line (default: a few pangrams)')
+    parser.add_argument('-o', '--out', default=None, type=str,
+                        help='append the results as a JSON line to this file')
+
+    args = parser.parse_args()
+    texts = TEXTS
+    if args.textfile is not None:
+        with open(args.textfile, encoding='utf-8') as f:
+            texts = [line.strip() for line in f if len(line.strip()) > 0]
+    main(args.url.rstrip('/'), args.num_requests,
+         args.concurrency, texts, args.out)
@@ -0,0 +1,282 @@
+import os
+import json
+import math
+import time
+import queue
+import logging
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+import numpy as np
+import cv2
+from model import *
+from utils import string_utils
+from generate import load_styles, render_batch, sample_style
+
+
+# Keeps a generator loaded and renders lines of text over HTTP.
+#   POST /render   body is a job as in generate.py's manifests, e.g.
+#                  {"text": "...", "author": "a01"}, {"text": "...",
+#                  "authors": ["a01", "b02"], "mix": 0.3} or {"text": "..."}
+#                  (random style); the response is the PNG
+#   GET /authors   JSON list of the authors with styles
+# Requests are queued and one thread renders them in batches: it takes the
+# oldest request and then whatever else arrives until the batch is full or
+# the oldest has waited max_latency, so under load the batches grow and when
+# idle a request isn't held back longer than that.
+# render_client.py is a load test for it.
+
+logging.basicConfig(level=logging.INFO, format='')
+
+
+def load_model(checkpoint_path, gpu=None):
+    checkpoint = torch.load(
+        checkpoint_path,
+        map_location=lambda storage,
+        location: storage)
+    print('loaded iteration {}'.format(checkpoint['iteration']))
+    config = checkpoint['config']
+    for key in config.keys():
+        if 'pretrained' in key:
+            config[key] = None
+    config['model']['RUN'] = True
+    if 'state_dict' in checkpoint:
+        # HACK fix
+        keys = list(checkpoint['state_dict'].keys())
+        for key in keys:
+            if 'style_from_normal' in key:  # HACK
+                del checkpoint['state_dict'][key]
+        model = eval(config['arch'])(config['model'])
+        model.load_state_dict(checkpoint['state_dict'])
+    else:
+        model = checkpoint['model']
+    model.eval()
+    if gpu is not None:
+        model = model.to(gpu)
+    model.count_std = 0
+    model.dup_std = 0
+
+    char_set_path = config['data_loader']['char_file']
+    if char_set_path == '../data/RIMES/characterset_lines.json':
+        char_set_path = 'data/RIMES_characterset_lines.json'
+    with open(char_set_path) as f:
+        char_set = json.load(f)
+    return model, char_set['char_to_idx']
+
+
+class Renderer:
+    def __init__(self, model, char_to_idx, styles, gpu=None,
+                 max_batch=32, max_latency=0.05):
+        self.model = model
+        self.char_to_idx = char_to_idx
+        self.styles = styles
+        self.gpu = gpu
+        self.charSpec = model.char_style_dim > 0
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def check(self, job):
+        # why a job can't be rendered, or None
+        if 'text' not in job or not isinstance(job['text'], str):
+            return 'no "text"'
+        if len(string_utils.str2label_single(
+                job['text'], self.char_to_idx)) == 0:
+            return 'no known characters in text'
+        if 'author' in job and 'authors' in job:
+            return 'give "author" or "authors", not both'
+        if 'index' in job and 'author' not in job:
+            return '"index" needs "author"'
+        if 'mix' in job and 'authors' not in job:
+            return '"mix" needs "authors"'
+        if 'author' in job and not isinstance(job['author'], str):
+            return '"author" must be a string'
+        if 'authors' in job and (
+                not isinstance(job['authors'], list) or
+                len(job['authors']) != 2 or
+                not all(isinstance(a, str) for a in job['authors'])):
+            return '"authors" must be a list of two strings'
+        if 'mix' in job and (
+                not isinstance(job['mix'], (int, float)) or
+                isinstance(job['mix'], bool) or
+                not math.isfinite(job['mix'])):
+            return '"mix" must be a number'
+        if self.styles is None:
+            if not self.model.vae or 'author' in job or 'authors' in job:
+                return 'the server has no styles (start it with -s)'
+            return None
+        for author in ([job['author']] if 'author' in job else []) + \
+                (job['authors'] if 'authors' in job else []):
+            if author not in self.styles or len(self.styles[author]) == 0:
+                return 'unknown author {}'.format(author)
+        if 'index' in job and (
+                not isinstance(job['index'], int) or
+                isinstance(job['index'], bool) or
+                not 0 <= job['index'] < len(self.styles[job['author']])):
+            return '"index" must be an integer from 0 to {}'.format(
+                len(self.styles[job['author']]) - 1)
+        return None
+
+    def render(self, job):
+        # Future for the job's PNG bytes
+        future = Future()
+        self.requests.put((job, future, time.time()))
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = batch[0][2] + self.max_latency
+        while len(batch) < self.max_batch:
+            wait = deadline - time.time()
+            try:
+                if wait > 0:
+                    batch.append(self.requests.get(timeout=wait))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        inference_mode = torch.inference_mode if hasattr(
+            torch, 'inference_mode') else torch.no_grad
+        while True:
+            batch = self._next_batch()
+            # a job whose style can't be sampled fails on its own, not the
+            # batch it's in
+            jobs = []
+            futures = []
+            style_list = []
+            for job, future, t in batch:
+                try:
+                    style_list.append(sample_style(
+                        self.model, self.styles, job, self.charSpec))
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                jobs.append(job)
+                futures.append(future)
+            if len(jobs) == 0:
+                continue
+            try:
+                with inference_mode():
+                    images = render_batch(
+                        self.model, jobs, self.styles, self.char_to_idx,
+                        self.gpu, self.charSpec, style_list)
+                for future, image in zip(futures, images):
+                    ok, png = cv2.imencode('.png', image)
+                    future.set_result(png.tobytes())
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def make_handler(renderer, authors):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, code, message):
+            self._send(code, json.dumps(
+                {'error': message}).encode('utf-8'), 'application/json')
+
+        def do_GET(self):
+            if self.path == '/authors':
+                self._send(200, json.dumps(authors).encode('utf-8'),
+                           'application/json')
+            else:
+                self._error(404, 'unknown path')
+
+        def do_POST(self):
+            if self.path != '/render':
+                self._error(404, 'unknown path')
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                job = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError:
+                self._error(400, 'body must be a JSON job')
+                return
+            problem = renderer.check(job) if isinstance(
+                job, dict) else 'body must be a JSON object'
+            if problem is not None:
+                self._error(400, problem)
+                return
+            try:
+                png = renderer.render(job).result()
+            except Exception as e:
+                self._error(500, str(e))
+                return
+            self._send(200, png, 'image/png')
+
+        def log_message(self, format, *args):
+            pass  # one line per request is too much under load
+
+    return Handler
+
+
+def main(checkpoint, style_loc, gpu, host, port, max_batch, max_latency):
+    model, char_to_idx = load_model(checkpoint, gpu)
+    if style_loc is not None:
+        styles, authors = load_styles(style_loc)
+    else:
+        styles, authors = None, []
+    renderer = Renderer(model, char_to_idx, styles, gpu,
+                        max_batch, max_latency)
+    server = ThreadingHTTPServer(
+        (host, port), make_handler(renderer, sorted(authors)))
+    server.daemon_threads = True
+    print('serving on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Server rendering handwriting lines with a trained model')
+    parser.add_argument('-c', '--checkpoint', default=None, type=str,
+                        help='path to training snapshot (default: None)')
+    parser.add_argument(
+        '-s',
+        '--style_loc',
+        default=None,
+        type=str,
+        help='location of pkl of styles, generated with get_styles.py')
+    parser.add_argument('-g', '--gpu', default=None, type=int,
+                        help='gpu number (default: cpu only)')
+    parser.add_argument('-H', '--host', default='127.0.0.1', type=str,
+                        help='address to serve on (default: 127.0.0.1)')
+    parser.add_argument('-p', '--port', default=8008, type=int,
+                        help='port to serve on (default: 8008)')
+    parser.add_argument('-b', '--max_batch', default=32, type=int,
+                        help='most lines rendered together (default: 32)')
+    parser.add_argument(
+        '-l',
+        '--max_latency',
+        default=0.05,
+        type=float,
+        help='seconds a request may wait for others to batch with (default: 0.05)')
+
+    args = parser.parse_args()
+    if args.checkpoint is None:
+        print('Must provide checkpoint (with -c)')
+        exit()
+    if args.gpu is not None:
+        with torch.cuda.device(args.gpu):
+            main(args.checkpoint, args.style_loc, args.gpu, args.host,
+                 args.port, args.max_batch, args.max_latency)
+    else:
+        main(args.checkpoint, args.style_loc, args.gpu, args.host,
+             args.port, args.max_batch, args.max_latency)
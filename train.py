@@ -12,6 +12,7 @@ from model.metric import *
 from data_loader import getDataLoader
 from trainer import *
 from logger import Logger
+from utils import distributed
 
 
 logging.basicConfig(level=logging.INFO, format='')
@@ -74,11 +75,17 @@ def main(config, resume):
                            train_logger=train_logger)
     if config['trainer']['class'] == 'HWRWithSynthTrainer':
         trainer.gen = gen_model
+    # metrics go to a JSON-lines file as they're logged; checkpoints only
+    # reference it (graph.py reads it)
+    if distributed.is_main():
+        trainer.train_logger.open(
+            os.path.join(trainer.checkpoint_dir, 'log.jsonl'))
 
     name = config['name']
 
     def handleSIGINT(sig, frame):
-        trainer.save()
+        if distributed.is_main():
+            trainer.save()
         sys.exit(0)
     signal.signal(signal.SIGINT, handleSIGINT)
 
@@ -86,6 +93,19 @@ def main(config, resume):
     trainer.train()
 
 
+def main_distributed(config, resume):
+    # one of the processes of a data-parallel run, each on its own GPU (if
+    # using CUDA)
+    assert 'class' in config['trainer'] and config['trainer']['class'] == 'HWWithStyleTrainer', \
+        'only HWWithStyleTrainer syncs its gradients for data-parallel training'
+    if config['cuda']:
+        config['gpu'] += distributed.get_rank()
+        with torch.cuda.device(config['gpu']):
+            main(config, resume)
+    else:
+        main(config, resume)
+
+
 if __name__ == '__main__':
     logger = logging.getLogger()
 
@@ -102,6 +122,14 @@ if __name__ == '__main__':
         help='path to checkpoint that may or may not exist (default: None)')
     parser.add_argument('-g', '--gpu', default=None, type=int,
                         help='gpu to use (overrides config) (default: None)')
+    parser.add_argument(
+        '-w',
+        '--world_size',
+        default=None,
+        type=int,
+        help='train data-parallel in this many local processes (gloo on CPU, one GPU each with CUDA, starting at --gpu) (default: 1, or WORLD_SIZE from torchrun)')
+    parser.add_argument('-p', '--port', default=29500, type=int,
+                        help='port for the processes of --world_size to meet on (default: 29500)')
     # parser.add_argument('-m', '--merged', default=False, action='store_const', const=True,
     #                    help='Use combine train and valid sets.')
 
@@ -144,7 +172,15 @@ if __name__ == '__main__':
     if args.gpu is not None:
         config['gpu'] = args.gpu
         print('override gpu to ' + str(config['gpu']))
-    if config['cuda']:
+    backend = 'nccl' if config['cuda'] else 'gloo'
+    # minutes a rank may wait for the others (e.g. while rank 0 validates)
+    timeout = config['trainer']['distributed_timeout'] if 'distributed_timeout' in config['trainer'] else distributed.TIMEOUT_MINUTES
+    if args.world_size is not None and args.world_size > 1:
+        distributed.launch(main_distributed, args.world_size,
+                           (config, args.resume), backend, args.port, timeout)
+    elif distributed.init_from_env(backend, timeout):
+        main_distributed(config, args.resume)
+    elif config['cuda']:
         with torch.cuda.device(config['gpu']):
             main(config, args.resume)
     else:
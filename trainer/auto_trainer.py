@@ -5,6 +5,7 @@ import torch.optim as optim
 from base import BaseTrainer
 import timeit
 from utils import util, string_utils, error_rates
+from utils.batch_augmentation import augment_batch
 from collections import defaultdict
 import random
 import json
@@ -60,6 +61,18 @@ class AutoTrainer(BaseTrainer):
         for k, v in char_set['idx_to_char'].items():
             self.idx_to_char[int(k)] = v
 
+    def _augment(self, instance):
+        # augmentation the dataset left for after collating
+        # ("batch_augmentation", see utils/batch_augmentation.py)
+        if 'aug_params' not in instance:
+            return instance
+        data_config = self.config['data_loader']
+        return augment_batch(
+            instance,
+            self.gpu if self.with_cuda else None,
+            data_config['mask_post'] if 'mask_post' in data_config else [],
+            data_config['mask_random'] if 'mask_random' in data_config else False)
+
     def _to_tensor(self, instance):
         image = instance['image']
         label = instance['label']
@@ -118,6 +131,7 @@ class AutoTrainer(BaseTrainer):
             except StopIteration:
                 self.data_loader_iter = iter(self.data_loader)
                 instance = self.data_loader_iter.next()
+            instance = self._augment(instance)
         # toc=timeit.default_timer()
         ##print('data: '+str(toc-tic))
 
@@ -218,6 +232,7 @@ class AutoTrainer(BaseTrainer):
         with torch.no_grad():
             losses = defaultdict(lambda: 0)
             for batch_idx, instance in enumerate(self.valid_data_loader):
+                instance = self._augment(instance)
                 if not self.logged:
                     print('validate: {}/{}'.format(batch_idx,
                           len(self.valid_data_loader)), end='\r')
@@ -6,13 +6,18 @@ from torch import autograd
 from base import BaseTrainer
 import timeit
 from utils import util, string_utils, error_rates
+from utils.batch_augmentation import augment_batch
 from data_loader import getDataLoader
+from data_loader.demand_loader import DemandLoader
 from collections import defaultdict
 import random
 import json
 import os
 from datasets.hw_dataset import PADDING_CONSTANT
 from model.hw_with_style import correct_pred
+from utils.alignment import count_targets
+from utils.grad_balance import GradientBalancer
+from utils import distributed
 from datasets.text_data import TextData
 from model.autoencoder import Encoder, EncoderSm, Encoder2, Encoder3, Encoder32
 import cv2
@@ -61,9 +66,17 @@ class HWWithStyleTrainer(BaseTrainer):
         if data_loader is not None:
             self.batch_size = data_loader.batch_size
             self.data_loader = data_loader
+            self.epoch = 0
             if 'refresh_data' in dir(self.data_loader.dataset):
                 self.data_loader.dataset.refresh_data(None, None, self.logged)
-            self.data_loader_iter = iter(data_loader)
+            # with a curriculum, only fetch the image batches the next
+            # image_lookahead iterations will use
+            self.image_lookahead = config['trainer']['image_lookahead'] if 'image_lookahead' in config['trainer'] else 0
+            if self.curriculum and self.image_lookahead > 0:
+                self.data_loader_iter = DemandLoader(
+                    data_loader, self._refresh_data, self.image_lookahead)
+            else:
+                self.data_loader_iter = iter(data_loader)
         if self.val_step < 0:
             self.valid_data_loader = None
             print('Set valid_data_loader to None')
@@ -110,19 +123,43 @@ class HWWithStyleTrainer(BaseTrainer):
                     max_len=text_data_max_len,
                     words=text_words,
                     characterBalance=characterBalance) if 'text_data' in config['trainer'] else None
+                # make the text-only batches in the background
+                text_data_workers = config['trainer']['text_data_workers'] if 'text_data_workers' in config['trainer'] else 0
+                if self.text_data is not None and text_data_workers > 0:
+                    self.text_data.prefetch(text_data_workers)
 
         # balance the CTC loss with others as in
         # https://arxiv.org/pdf/1903.00277.pdf
         self.balance_loss = config['trainer']['balance_loss'] if 'balance_loss' in config['trainer'] else False
         if self.balance_loss:
-            self.parameters = list(model.parameters())
+            self.balancer = GradientBalancer(
+                [param for name, param in model.named_parameters()
+                 if param.requires_grad and not ('hwr' in name and self.hwr_frozen)])
             self.balance_var_x = config['trainer']['balance_var_x'] if 'balance_var_x' in config['trainer'] else None
             if self.balance_loss.startswith('sign_preserve_x'):
                 self.balance_x = float(
                     self.balance_loss[self.balance_loss.find('x') + 1:])
-            # this will hold the gradients for previous training steps if
+            # the balancer holds the gradients for previous training steps if
             # "no-step" is specified
-            self.saved_grads = []
+
+        # gradient accumulation, per lesson element (see _accumulate_steps)
+        self.accumulate = config['trainer']['accumulate'] if 'accumulate' in config['trainer'] else 1
+
+        # mixed precision: "amp": "fp16" (GPU), "bf16", or true (fp16 on GPU,
+        # bf16 on CPU). fp16 losses are scaled with one GradScaler shared by
+        # all the optimizers (it tracks unscaling/infs per optimizer), so
+        # gradients kept for balance_loss are all at the same scale.
+        amp = config['trainer']['amp'] if 'amp' in config['trainer'] else False
+        self.amp_device = 'cuda' if self.gpu is not None else 'cpu'
+        if amp is True:
+            amp = 'fp16' if self.amp_device == 'cuda' else 'bf16'
+        if amp == 'fp16' and self.amp_device == 'cpu':
+            print('fp16 autocast needs a GPU, using bf16')
+            amp = 'bf16'
+        self.amp_dtype = {'fp16': torch.float16,
+                          'bf16': torch.bfloat16}[amp] if amp else None
+        self.scaler = torch.cuda.amp.GradScaler(
+            enabled=self.amp_dtype == torch.float16)
 
         self.style_detach = config['trainer']['detach_style'] if 'detach_style' in config['trainer'] else (
             config['trainer']['style_detach'] if 'style_detach' in config['trainer'] else False)
@@ -198,6 +235,73 @@ class HWWithStyleTrainer(BaseTrainer):
 
         self.casesensitive = config['trainer']['casesensitive'] if 'casesensitive' in config['trainer'] else True
 
+    def _autocast(self):
+        return torch.autocast(device_type=self.amp_device,
+                              dtype=self.amp_dtype,
+                              enabled=self.amp_dtype is not None)
+
+    def _to_float(self, got):
+        # outputs for printing, back from fp16/bf16
+        return {k: v.float() if isinstance(v, torch.Tensor) else v
+                for k, v in got.items()}
+
+    def _accumulate_steps(self, lesson):
+        # micro-batches per optimizer step, "accumulate": n or
+        # {lesson element: n, ..., "default": n} (most of those in the lesson)
+        if not isinstance(self.accumulate, dict):
+            return self.accumulate
+        steps = [n for name, n in self.accumulate.items()
+                 if lesson is not None and name in lesson]
+        if len(steps) > 0:
+            return max(steps)
+        return self.accumulate['default'] if 'default' in self.accumulate else 1
+
+    def _get_instance(self, lesson):
+        if self.curriculum and not self._needs_images(lesson):
+            return self.text_data.getInstance()
+        try:
+            instance = self.data_loader_iter.next()
+        except StopIteration:
+            self._refresh_data()
+            self.data_loader_iter = iter(self.data_loader)
+            instance = self.data_loader_iter.next()
+        return self._augment(instance)
+
+    def _needs_images(self, lesson):
+        # text-only lessons are run on TextData, if there is one
+        return not (all([l[:3] == 'gen' or l == 'no-step' for l in lesson])
+                    and self.text_data is not None)
+
+    def _refresh_data(self):
+        # end of an epoch
+        if 'refresh_data' in dir(self.data_loader.dataset):
+            self.data_loader.dataset.refresh_data(None, None, self.logged)
+        self.epoch += 1
+        distributed.set_epoch(self.data_loader, self.epoch)
+
+    def _sync_grads(self, lesson):
+        # distributed: every process steps with the gradients averaged over
+        # all of them (balance_loss's saved ones too, before they're balanced)
+        if not self.distributed or (lesson is not None and "no-step" in lesson):
+            return
+        if self.balance_loss:
+            self.balancer.all_reduce()
+        else:
+            distributed.average_gradients(
+                [p for p in self.model.parameters() if p.requires_grad])
+
+    def _augment(self, instance):
+        # augmentation the dataset left for after collating
+        # ("batch_augmentation", see utils/batch_augmentation.py)
+        if 'aug_params' not in instance:
+            return instance
+        data_config = self.config['data_loader']
+        return augment_batch(
+            instance,
+            self.gpu if self.with_cuda else None,
+            data_config['mask_post'] if 'mask_post' in data_config else [],
+            data_config['mask_random'] if 'mask_random' in data_config else False)
+
     def _to_tensor(self, instance):
         image = instance['image']
         label = instance['label']
@@ -243,150 +347,153 @@ class HWWithStyleTrainer(BaseTrainer):
         self.model.train()
         if self.curriculum:
             lesson = self.curriculum.getLesson(iteration)
-        if self.curriculum and all(
-                [l[:3] == 'gen' or l == 'no-step' for l in lesson]) and self.text_data is not None:
-            instance = self.text_data.getInstance()
+            if isinstance(self.data_loader_iter, DemandLoader):
+                upcoming = [self.curriculum.peekLesson(i) for i in range(
+                    iteration + 1, iteration + 1 + self.image_lookahead)]
+                self.data_loader_iter.set_demand(sum(
+                    [self._accumulate_steps(l) for l in upcoming if self._needs_images(l)]))
         else:
-            try:
-                instance = self.data_loader_iter.next()
-            except StopIteration:
-                if 'refresh_data' in dir(self.data_loader.dataset):
-                    self.data_loader.dataset.refresh_data(
-                        None, None, self.logged)
-                self.data_loader_iter = iter(self.data_loader)
-                instance = self.data_loader_iter.next()
+            lesson = None
+        accumulate = self._accumulate_steps(lesson)
 
         self.optimizer.zero_grad()
         if self.curriculum:
             if any(['disc' in l for l in lesson]):
                 self.optimizer_discriminator.zero_grad()
 
-        if self.curriculum:
-            # Do GAN training
-            if all([l == 0 for l in instance['label_lengths']]):
-                return {}
-
-            if (self.iter_to_print <= 0 or self.print_next_gen) and 'gen' in lesson:
-                losses, got = self.run_gen(
-                    instance, lesson, get=['gen', 'disc'])
-                self.print_images(
-                    got['gen'],
-                    instance['gt'],
-                    got['disc'],
-                    typ='gen')
-                if self.iter_to_print > 0:
-                    self.print_next_gen = False
-                else:
-                    self.print_next_auto = True
-                    self.iter_to_print = self.print_every
-
-            elif (self.iter_to_print <= 0 or self.print_next_auto) and 'auto' in lesson:
-                losses, got = self.run_gen(instance, lesson, get=['recon'])
-                self.print_images(
-                    got['recon'],
-                    instance['gt'],
-                    typ='recon',
-                    gtImages=instance['image'])
-                if self.iter_to_print > 0:
-                    self.print_next_auto = False
+        # The gradients of accumulate micro-batches are summed (each loss is
+        # divided by accumulate) before the step. For balance_loss, each
+        # balanced loss keeps one saved slot that all the micro-batches add
+        # to, with the other losses' gradients stashed meanwhile.
+        all_losses = defaultdict(float)
+        loss_item = 0
+        balance_slots = {}
+        ran = 0
+        for micro in range(accumulate):
+            instance = self._get_instance(lesson)
+
+            if self.curriculum:
+                # Do GAN training
+                while all([l == 0 for l in instance['label_lengths']]):
+                    # refetched rather than skipped: each micro-batch's
+                    # losses are divided by accumulate, and all the
+                    # processes have to run the same passes (the style pool
+                    # is gathered from each of them)
+                    instance = self._get_instance(lesson)
+
+                if micro == 0 and (self.iter_to_print <= 0 or self.print_next_gen) and 'gen' in lesson:
+                    with self._autocast():
+                        losses, got = self.run_gen(
+                            instance, lesson, get=['gen', 'disc'])
+                    got = self._to_float(got)
+                    self.print_images(
+                        got['gen'],
+                        instance['gt'],
+                        got['disc'],
+                        typ='gen')
+                    if self.iter_to_print > 0:
+                        self.print_next_gen = False
+                    else:
+                        self.print_next_auto = True
+                        self.iter_to_print = self.print_every
+
+                elif micro == 0 and (self.iter_to_print <= 0 or self.print_next_auto) and 'auto' in lesson:
+                    with self._autocast():
+                        losses, got = self.run_gen(
+                            instance, lesson, get=['recon'])
+                    got = self._to_float(got)
+                    self.print_images(
+                        got['recon'],
+                        instance['gt'],
+                        typ='recon',
+                        gtImages=instance['image'])
+                    if self.iter_to_print > 0:
+                        self.print_next_auto = False
+                    else:
+                        self.print_next_gen = True
+                        self.iter_to_print = self.print_every
                 else:
-                    self.print_next_gen = True
-                    self.iter_to_print = self.print_every
+                    with self._autocast():
+                        losses = self.run_gen(instance, lesson)
+                    if micro == 0:
+                        self.iter_to_print -= 1
+                pred = None
             else:
-                losses = self.run_gen(instance, lesson)
-                self.iter_to_print -= 1
-            pred = None
-        else:
-            # Do HWR training
-            pred, losses = self.run_hwr(instance)
-            recon = None
-
-        if losses is None:
-            return {}
-
-        loss = 0
-        recogLoss = 0
-        autoGenLoss = 0
-        for name in losses.keys():
-            losses[name] *= self.lossWeights[name[:-4]]
-            if self.balance_loss and 'generator' in name and 'auto-gen' in lesson:
-                autoGenLoss += losses[name]
-            elif self.balance_loss and 'Recog' in name:
-                recogLoss += losses[name]
+                # Do HWR training
+                with self._autocast():
+                    pred, losses = self.run_hwr(instance)
+                pred = pred.float()
+                recon = None
+
+            if losses is None:
+                continue
+            ran += 1
+            gt = instance['gt']
+
+            loss = 0
+            recogLoss = 0
+            autoGenLoss = 0
+            for name in losses.keys():
+                losses[name] *= self.lossWeights[name[:-4]] / accumulate
+                if self.balance_loss and 'generator' in name and 'auto-gen' in lesson:
+                    autoGenLoss += losses[name]
+                elif self.balance_loss and 'Recog' in name:
+                    recogLoss += losses[name]
+                else:
+                    loss += losses[name]
+                all_losses[name] += losses[name].item()
+            if (loss != 0 and (torch.isnan(loss) or torch.isinf(loss))):
+                print(losses)
+            assert(loss == 0 or (not torch.isnan(loss) and not torch.isinf(loss)))
+
+            if pred is not None:
+                pred = pred.detach().cpu().numpy()
+            if type(loss) is not int:
+                loss_item += loss.item()
+
+            if self.balance_loss:
+                if micro > 0:
+                    self.balancer.stash()
+                if type(autoGenLoss) is not int:
+                    loss_item += autoGenLoss.item()
+                    self.scaler.scale(autoGenLoss).backward(retain_graph=True)
+                    balance_slots['autoGen'] = self.balancer.save(
+                        balance_slots.get('autoGen'))
+                if type(recogLoss) is not int:
+                    loss_item += recogLoss.item()
+                    self.scaler.scale(recogLoss).backward(retain_graph=True)
+                    balance_slots['recog'] = self.balancer.save(
+                        balance_slots.get('recog'))
+                if micro > 0:
+                    self.balancer.unstash()
             else:
-                loss += losses[name]
-            losses[name] = losses[name].item()
-        if (loss != 0 and (torch.isnan(loss) or torch.isinf(loss))):
-            print(losses)
-        assert(loss == 0 or (not torch.isnan(loss) and not torch.isinf(loss)))
+                loss += recogLoss + autoGenLoss
 
-        if pred is not None:
-            pred = pred.detach().cpu().numpy()
-        if type(loss) is not int:
-            loss_item = loss.item()
-        else:
-            loss_item = loss
+            if type(loss) is not int:
+                self.scaler.scale(loss).backward()
 
-        if self.balance_loss:
-            if type(autoGenLoss) is not int:
-                saved_grad = []
-                loss_item += autoGenLoss.item()
-                autoGenLoss.backward(retain_graph=True)
-                for p in self.parameters:
-                    if p.grad is None:
-                        saved_grad.append(None)
-                    else:
-                        saved_grad.append(p.grad.clone())
-                        p.grad.zero_()
-                self.saved_grads.append(saved_grad)
-            if type(recogLoss) is not int:
-                saved_grad = []
-                loss_item += recogLoss.item()
-                recogLoss.backward(retain_graph=True)
-                for p in self.parameters:
-                    if p.grad is None:
-                        saved_grad.append(None)
-                    else:
-                        saved_grad.append(p.grad.clone())
-                        p.grad.zero_()
-                self.saved_grads.append(saved_grad)
-        else:
-            loss += recogLoss + autoGenLoss
+        if ran == 0:
+            return {}
+        if ran < accumulate:
+            # the micro-batches that gave no losses don't count in the mean
+            scale = accumulate / ran
+            for p in self.model.parameters():
+                if p.grad is not None:
+                    p.grad.mul_(scale)
+            if self.balance_loss:
+                for slot in balance_slots.values():
+                    self.balancer.buffers[slot].mul_(scale)
+            for name in all_losses:
+                all_losses[name] *= scale
+            loss_item *= scale
+        losses = dict(all_losses)
 
-        if type(loss) is not int:
-            loss.backward()
+        self._sync_grads(lesson)
 
         if self.balance_loss and "no-step" in lesson:
-            saved_grad = []
-            for p in self.parameters:
-                if p.grad is None:
-                    saved_grad.append(None)
-                else:
-                    saved_grad.append(p.grad.clone())
-                    p.grad.zero_()
-            self.saved_grads.append(saved_grad)
-
-        elif self.balance_loss and len(self.saved_grads) > 0:
-            abmean_Ds = []
-            nonzero_sum = 0.0
-            nonzero_count = 0
-            for p in self.parameters:
-                if p.grad is not None:
-                    abmean_D = torch.abs(p.grad).mean()
-                    abmean_Ds.append(abmean_D)
-                    if abmean_D != 0:
-                        nonzero_sum += abmean_D
-                        nonzero_count += 1
-                else:
-                    abmean_Ds.append(None)
-
-            # in case of zero mean
-            if nonzero_count > 0:
-                nonzero = nonzero_sum / nonzero_count
-                for i in range(len(abmean_Ds)):
-                    if abmean_Ds[i] == 0.0:
-                        abmean_Ds[i] = nonzero
+            self.balancer.save()
 
+        elif self.balance_loss and len(self.balancer) > 0:
             # get the right multipliers for this iteration
             for iterT, mult in self.balance_var_x.items():
                 if int(iterT) <= iteration:
@@ -394,34 +501,32 @@ class HWWithStyleTrainer(BaseTrainer):
                     if type(multipliers) is not list:
                         multipliers = [multipliers]
 
-            # actually change the grandients
-            for gi, saved_grad in enumerate(self.saved_grads):
-                x = multipliers[gi]
-                for i, (R, p) in enumerate(zip(saved_grad, self.parameters)):
-                    if R is not None:
-                        assert(not torch.isnan(p.grad).any())
-                        abmean_R = torch.abs(R).mean()
-                        if abmean_R != 0:
-                            p.grad += x * R * (abmean_Ds[i] / abmean_R)
-            self.saved_grads = []
+            # actually change the grandients (scaled fp16 gradients may have
+            # overflowed, the scaler then skips the step)
+            self.balancer.apply(
+                multipliers, check_nan=not self.scaler.is_enabled())
 
         if self.curriculum and 'no-step' not in lesson:
             # Do an optimizer step with accumulated+balanced grandients
+            if 'disc' in lesson or 'auto-disc' in lesson:
+                optimizer = self.optimizer_discriminator
+            else:
+                optimizer = self.optimizer
+            self.scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_value_(self.model.parameters(), 2)
             for m in self.model.parameters():
                 assert(not torch.isnan(m).any())
 
-            if 'disc' in lesson or 'auto-disc' in lesson:
-                self.optimizer_discriminator.step()
-            else:
-                self.optimizer.step()
+            self.scaler.step(optimizer)
+            self.scaler.update()
         elif not self.curriculum:
             # HWR pre-training optimizer step
-            self.optimizer.step()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
 
         loss = loss_item
 
-        gt = instance['gt']
+        # CER of the last micro-batch
         if pred is not None:
             cer, wer, pred_str = self.getCER(gt, pred)
         else:
@@ -429,6 +534,12 @@ class HWWithStyleTrainer(BaseTrainer):
             wer = 0
 
         metrics = {}
+        if self.amp_device == 'cuda':
+            # peak memory of the iteration, to compare amp with fp32 runs (as
+            # sec_per_iter does throughput)
+            metrics['max_mem_MB'] = torch.cuda.max_memory_allocated(
+                self.gpu) / (1024 * 1024)
+            torch.cuda.reset_peak_memory_stats(self.gpu)
 
         log = {
             'loss': loss,
@@ -479,6 +590,7 @@ class HWWithStyleTrainer(BaseTrainer):
         with torch.no_grad():
             losses = defaultdict(lambda: 0)
             for batch_idx, instance in enumerate(self.valid_data_loader):
+                instance = self._augment(instance)
                 if not self.logged:
                     print('validate: {}/{}'.format(batch_idx,
                           len(self.valid_data_loader)), end='\r')
@@ -571,8 +683,11 @@ class HWWithStyleTrainer(BaseTrainer):
                         style, **self.loss_params['styleReg'])
 
             if self.interpolate_gen_styles and 'eval' not in lesson and 'valid' not in lesson:
-                for i in range(0, batch_size, a_batch_size):
-                    self.prev_styles.append(style[i].detach().cpu())
+                # (from every process when distributed)
+                new_styles = distributed.all_gather(
+                    style[0:batch_size:a_batch_size].detach()).cpu()
+                for i in range(new_styles.size(0)):
+                    self.prev_styles.append(new_styles[i])
                 self.prev_styles = self.prev_styles[-self.prev_styles_size:]
         else:
             style = None
@@ -704,52 +819,12 @@ class HWWithStyleTrainer(BaseTrainer):
                 style_d = style
             self.model.counts = self.model.spacer(label_onehot, style_d)
             index_spaced = spaced_label_m.argmax(dim=2)
-            if self.model.count_duplicates:
-                gt_counts = torch.FloatTensor(
-                    label.size(0), batch_size, 2).fill_(0)
-                for b in range(batch_size):
-                    c = 0  # blanks
-                    d = 0  # repeated char
-                    pos = 0
-                    last = 0
-                    for i in range(index_spaced.size(0)):
-                        index = index_spaced[i, b].item()
-                        if index == 0 and last == 0:
-                            c += 1
-                        elif last == 0 or last == index:
-                            d += 1
-                            last = index
-                        else:
-                            assert(label[pos, b].item() == last)
-                            gt_counts[pos, b, 0] = c
-                            gt_counts[pos, b, 1] = d
-                            if index == 0:
-                                c = 1
-                                d = 0
-                            else:
-                                c = 0
-                                d = 1
-                            pos += 1
-                            last = index
-                    self.model.counts[pos:] = 0
-            else:
-                gt_counts = torch.FloatTensor(
-                    label.size(0), batch_size, 1).fill_(0)
-                for b in range(batch_size):
-                    c = 0
-                    pos = 0
-                    last = -1
-                    for i in range(index_spaced.size(0)):
-                        index = index_spaced[i, b]
-                        if index == 0 or index == last:
-                            c += 1
-                        else:
-                            assert(label[pos, b].item() == index.item())
-                            gt_counts[pos, b, 0] = c
-                            c = 0
-                            pos += 1
-                        last = index
-                    self.model.counts[pos:] = 0
+            gt_counts, gt_chars, num_found = count_targets(
+                index_spaced, label.size(0), self.model.count_duplicates)
+            found = torch.arange(label.size(0), device=num_found.device)[
+                :, None] < num_found[None, :]
+            assert (gt_chars == label.to(gt_chars.device).long() * found).all()
+            self.model.counts[int(num_found.min()):] = 0
 
             assert not torch.isinf(self.model.counts).any()
             gt_counts = gt_counts.to(self.model.counts.device)
@@ -963,76 +1038,7 @@ class HWWithStyleTrainer(BaseTrainer):
         return cer, wer, pred_strs
 
     def correct_pred(self, pred, label):
-        # Get optimal alignment
-        # use DTW
-        # introduce blanks at front, back, and inbetween chars
-        label_with_blanks = torch.LongTensor(
-            label.size(0) * 2 + 1, label.size(1)).zero_()
-        label_with_blanks[1::2] = label.cpu()
-        pred_use = pred.cpu().detach()
-
-        batch_size = pred_use.size(1)
-        label_len = label_with_blanks.size(0)
-        pred_len = pred_use.size(0)
-
-        dtw = torch.FloatTensor(
-            pred_len + 1,
-            label_len + 1,
-            batch_size).fill_(
-            float('inf'))
-        dtw[0, 0] = 0
-        w = max(pred_len // 2, abs(pred_len - label_len))
-        for i in range(1, pred_len + 1):
-            dtw[i, max(1, i - w):min(label_len, i + w) + 1] = 0
-        history = torch.IntTensor(pred_len, label_len, batch_size)
-        for i in range(1, pred_len + 1):
-            for j in range(max(1, i - w), min(label_len, i + w) + 1):
-                cost = 1 - \
-                    pred_use[i - 1, torch.arange(0, batch_size).long(),
-                             label_with_blanks[j - 1, :]]
-                per_batch_min, history[i -
-                                       1, j -
-                                       1] = torch.min(torch.stack((dtw[i -
-                                                                       1, j], dtw[i -
-                                                                                  1, j -
-                                                                                  1], dtw[i, j -
-                                                                                          1])), dim=0)
-                dtw[i, j] = cost + per_batch_min
-        new_labels = []
-        maxlen = 0
-        for b in range(batch_size):
-            new_label = []
-            i = pred_len - 1
-            j = label_len - 1
-            #accum += allCosts[b,i,j]
-            new_label.append(label_with_blanks[j, b])
-            while(i > 0 or j > 0):
-                if history[i, j, b] == 0:
-                    i -= 1
-                elif history[i, j, b] == 1:
-                    i -= 1
-                    j -= 1
-                elif history[i, j, b] == 2:
-                    j -= 1
-                # accum+=allCosts[b,i,j]
-                new_label.append(label_with_blanks[j, b])
-            new_label.reverse()
-            maxlen = max(maxlen, len(new_label))
-            new_label = torch.stack(new_label, dim=0)
-            new_labels.append(new_label)
-
-        new_labels = [F.pad(l, (0, maxlen - l.size(0)), value=0)
-                      for l in new_labels]
-        new_label = torch.LongTensor(maxlen, batch_size)
-        for b, l in enumerate(new_labels):
-            new_label[:l.size(0), b] = l
-
-        # set to one hot at alignment
-        #new_label = self.onehot(new_label)
-        # fuzzy other neighbor preds
-        # TODO
-
-        return new_label.to(label.device)
+        return correct_pred(pred, label)
 
     def get_style_gen(self, batch_size, device):
         if (self.interpolate_gen_styles and (len(self.prev_styles) > 0 or len(self.prev_g_styles) > 0)) and (
@@ -1059,7 +1065,7 @@ class HWWithStyleTrainer(BaseTrainer):
         return style_gen
 
     def print_images(self, images, text, disc=None, typ='gen', gtImages=None):
-        if self.print_dir is not None:
+        if self.print_dir is not None and self.is_main:
             images = 1 - images.detach()
             nrow = max(1, 2048 // images.size(3))
             if self.iteration - \
@@ -9,6 +9,7 @@ import random
 from collections import defaultdict
 from glob import iglob
 import os
+from utils.style_store import StyleStore
 
 #sns.set(style='white', context='poster', rc={'figure.figsize':(14,10)})
 np.random.seed(42)
@@ -32,25 +33,30 @@ else:
 addGaus = sys.argv[3] == 'add' if len(sys.argv) > 3 else False
 
 style_loc = sys.argv[1]
-if style_loc[-1] != '*':
-    style_loc += '*'
-styles = []
-authors = []
-for loc in iglob(style_loc):
-    with open(loc, 'rb') as f:
-        data = pickle.load(f)
-    s = data['styles']
-    if isinstance(s, list):
-        new_s = []
-        for style in s:
-            style = np.concatenate([style[0], style[1], style[2].flatten()])
-            new_s.append(style)
-        s = np.stack(new_s, axis=0)
-    if len(s.shape) == 4:
-        s = s[:, :, 0, 0]
-    styles.append(s)
-
-    authors += list(data['authors'])
+if StyleStore.is_store(style_loc):
+    store = StyleStore(style_loc)
+    styles = [store.matrix()]
+    authors = list(store.row_authors())
+else:
+    if style_loc[-1] != '*':
+        style_loc += '*'
+    styles = []
+    authors = []
+    for loc in iglob(style_loc):
+        with open(loc, 'rb') as f:
+            data = pickle.load(f)
+        s = data['styles']
+        if isinstance(s, list):
+            new_s = []
+            for style in s:
+                style = np.concatenate([style[0], style[1], style[2].flatten()])
+                new_s.append(style)
+            s = np.stack(new_s, axis=0)
+        if len(s.shape) == 4:
+            s = s[:, :, 0, 0]
+        styles.append(s)
+
+        authors += list(data['authors'])
 if addGaus:
     styles.append(np.random.normal(size=(100, styles[0].shape[1])))
 styles = np.concatenate(styles, axis=0)
@@ -0,0 +1,168 @@
+import torch
+
+
+# Shared DTW alignment of an HWR prediction to its (blank-padded) label.
+# The table is filled one anti-diagonal at a time (every cell on a diagonal
+# only depends on the previous two), so the Python loop is over
+# pred_len+label_len diagonals instead of pred_len*label_len cells, and all
+# batch elements are backtracked together. Everything stays on pred's device.
+
+
+def _label_with_blanks(label, device):
+    # introduce blanks at front, back, and inbetween chars
+    label_with_blanks = torch.zeros(
+        label.size(0) * 2 + 1,
+        label.size(1),
+        dtype=torch.long,
+        device=device)
+    label_with_blanks[1::2] = label.to(device).long()
+    return label_with_blanks
+
+
+def dtw_history(cost, w):
+    # cost is Batch x pred_len x label_len
+    # returns the backpointers (0=up, 1=diagonal, 2=left) of the banded DTW
+    # as pred_len+1 x label_len+1 x Batch (row/col 0 are the start borders)
+    batch_size, pred_len, label_len = cost.size()
+    device = cost.device
+    dtw = torch.full(
+        (pred_len + 1, label_len + 1, batch_size),
+        float('inf'),
+        dtype=cost.dtype,
+        device=device)
+    dtw[0, 0] = 0
+    history = torch.zeros(
+        pred_len + 1,
+        label_len + 1,
+        batch_size,
+        dtype=torch.uint8,
+        device=device)
+    cost = cost.permute(1, 2, 0)  # pred_len x label_len x Batch
+    for d in range(2, pred_len + label_len + 1):
+        # cells (i,j) with i+j==d that are inside the band |i-j|<=w
+        i_lo = max(1, d - label_len, (d - w + 1) // 2)
+        i_hi = min(pred_len, d - 1, (d + w) // 2)
+        if i_lo > i_hi:
+            continue
+        i = torch.arange(i_lo, i_hi + 1, device=device)
+        j = d - i
+        per_batch_min, came_from = torch.min(torch.stack(
+            (dtw[i - 1, j], dtw[i - 1, j - 1], dtw[i, j - 1])), dim=0)
+        history[i, j] = came_from.to(history.dtype)
+        dtw[i, j] = cost[i - 1, j - 1] + per_batch_min
+    return history
+
+
+def backtrack(history, label_with_blanks):
+    # Follow the backpointers from the end for every batch element at once.
+    # Finished elements sit at (0,0), so a fixed number of steps is run
+    # (the longest possible path) and nothing needs to sync with the host.
+    pred_len = history.size(0) - 1
+    label_len = history.size(1) - 1
+    batch_size = history.size(2)
+    device = history.device
+    b_index = torch.arange(batch_size, device=device)
+    i = torch.full((batch_size,), pred_len - 1, dtype=torch.long, device=device)
+    j = torch.full((batch_size,), label_len - 1, dtype=torch.long, device=device)
+    max_steps = pred_len + label_len - 2
+    path = torch.zeros(
+        max_steps + 1,
+        batch_size,
+        dtype=torch.long,
+        device=device)
+    path[0] = label_with_blanks[j, b_index]
+    lengths = torch.ones(batch_size, dtype=torch.long, device=device)
+    for step in range(1, max_steps + 1):
+        active = (i > 0) | (j > 0)
+        h = history[i + 1, j + 1, b_index].long()
+        i = i - (active & (h != 2)).long()
+        j = j - (active & (h != 0)).long()
+        path[step] = label_with_blanks[j, b_index]
+        lengths += active.long()
+
+    # reverse each path (they have different lengths) and pad with blanks
+    maxlen = int(lengths.max())
+    k = torch.arange(maxlen, device=device)[:, None]
+    src = (lengths[None, :] - 1 - k).clamp(min=0)
+    new_label = path.gather(0, src)
+    new_label[k.expand(-1, batch_size) >= lengths[None, :]] = 0
+    return new_label
+
+
+def correct_pred(pred, label):
+    # Get optimal alignment
+    # use DTW
+    pred_use = pred.detach()
+    device = pred_use.device
+    label_with_blanks = _label_with_blanks(label, device)
+
+    batch_size = pred_use.size(1)
+    label_len = label_with_blanks.size(0)
+    pred_len = pred_use.size(0)
+    w = max(pred_len // 2, abs(pred_len - label_len))
+
+    # cost[b,i,j] = 1 - pred[i,b,label_with_blanks[j,b]]
+    cost = 1 - torch.gather(
+        pred_use.permute(1, 0, 2),
+        2,
+        label_with_blanks.t()[:, None, :].expand(batch_size, pred_len, label_len))
+
+    history = dtw_history(cost, w)
+    new_label = backtrack(history, label_with_blanks)
+
+    return new_label.to(label.device)
+
+
+def _rank_table(is_event, frame, size):
+    # size x Batch table of the frame of each event (in order) per batch
+    # element, -1 past the last one
+    batch_size = is_event.size(1)
+    device = is_event.device
+    rank = is_event.long().cumsum(dim=0) - 1
+    b_index = torch.arange(batch_size, device=device)[None, :].expand_as(rank)
+    table = torch.full((size, batch_size), -1, dtype=torch.long, device=device)
+    table[rank[is_event], b_index[is_event]] = frame[is_event]
+    return table
+
+
+def count_targets(index_spaced, label_len, count_duplicates):
+    # Spacer ground truth from an aligned label (Width x Batch of class
+    # indices, 0 is blank), for every batch element at once.
+    # Returns label_len x Batch x (2 or 1) counts and, per batch element, the
+    # number of characters given counts (chars and number_of_chars_found).
+    #   count_duplicates: for each run of a character, the blanks before it
+    #     and the run's length. A run still going at the end isn't counted.
+    #   otherwise: for each character, the frames (blanks or repeats) between
+    #     the previous character's first frame and its own
+    width, batch_size = index_spaced.size()
+    device = index_spaced.device
+    index_spaced = index_spaced.long()
+    frame = torch.arange(width, device=device)[:, None].expand(-1, batch_size)
+    is_char = index_spaced != 0
+    prev = torch.cat((torch.zeros_like(index_spaced[:1]), index_spaced[:-1]))
+    run_start = is_char & (index_spaced != prev)
+    num_runs = run_start.long().sum(dim=0)
+    size = max(int(num_runs.max()) if batch_size > 0 else 0, label_len)
+    starts = _rank_table(run_start, frame, size)
+    start_frame = starts.clamp(min=0)
+    chars = index_spaced.gather(0, start_frame)
+    gt_counts = torch.zeros(label_len, batch_size, 2 if count_duplicates else 1,
+                            device=device)
+    if count_duplicates:
+        nxt = torch.cat((index_spaced[1:], torch.zeros_like(index_spaced[:1])))
+        run_end = is_char & (index_spaced != nxt)
+        ends = _rank_table(run_end, frame, size)
+        # the run ending on the last frame never gets closed
+        found = (ends >= 0) & (ends < width - 1)
+        prev_end = torch.cat((torch.full_like(ends[:1], -1), ends[:-1]))
+        blanks = starts - prev_end - 1
+        dups = ends - starts + 1
+        counts = torch.stack((blanks, dups), dim=2)
+    else:
+        found = starts >= 0
+        prev_start = torch.cat((torch.full_like(starts[:1], -1), starts[:-1]))
+        counts = (starts - prev_start - 1)[:, :, None]
+    num_found = found.long().sum(dim=0)
+    assert int(num_found.max() if batch_size > 0 else 0) <= label_len
+    gt_counts[:] = (counts * found[:, :, None])[:label_len].float()
+    return gt_counts, chars[:label_len] * found[:label_len], num_found
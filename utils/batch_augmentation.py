@@ -0,0 +1,184 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from utils.util import makeMask
+
+# Post-collate versions of augmentation.affine_trans and
+# augmentation.change_thickness, run on a whole padded batch with torch ops
+# (on the GPU if the batch is there) instead of per line in the DataLoader
+# workers.
+# With "batch_augmentation": true in the data_loader config, the author
+# datasets still draw the random parameters in __getitem__ exactly as before
+# (one skew/strech and one set of stroke parameters per author group), but
+# instead of applying them they return them, with each line's width, as
+# instance['aug_params']. The trainer then calls augment_batch().
+# Images are in the datasets' range (1 - pixel/128, so ink is 1).
+
+WHITE = 1 - 255 / 128.0
+
+
+def _column_mask(widths, width):
+    # Batch x 1 x 1 x width, true on each line's real (unpadded) columns
+    x = torch.arange(width, device=widths.device)
+    return (x[None, :] < widths[:, None])[:, None, None, :]
+
+
+def affine_batch(images, widths, skew, strech, pad_value, fg_mask=None):
+    # skew and strech are per line; same transform as affine_trans:
+    # x' = strech*x + tan(skew)*(y - h/2), new width int(width*strech)
+    batch_size, channels, height, width = images.size()
+    device = images.device
+    skew = skew.to(device).double()
+    strech = strech.to(device).double()
+    new_widths = (widths.double() * strech).floor().long()
+    out_width = max(int(new_widths.max()), 1)
+
+    m = torch.tan(skew)[:, None, None]
+    x = torch.arange(out_width, device=device, dtype=torch.double)[
+        None, None, :]
+    y = torch.arange(height, device=device, dtype=torch.double)[
+        None, :, None]
+    # inverse map, output pixel -> source pixel
+    src_x = (x - m * y + (height / 2) * m) / strech[:, None, None]
+    src_y = y.expand(batch_size, height, out_width)
+    grid = torch.stack((src_x * (2.0 / max(width - 1, 1)) - 1,
+                        src_y * (2.0 / max(height - 1, 1)) - 1), dim=3)
+    grid = grid.to(images.dtype)
+
+    valid = _column_mask(widths, width)
+    out_valid = _column_mask(new_widths, out_width)
+    # outside each line is white, as warpAffine's borderValue=255
+    images = torch.where(valid, images, torch.full_like(images, WHITE))
+    warped = F.grid_sample(images - WHITE, grid, mode='bilinear',
+                           padding_mode='zeros', align_corners=True) + WHITE
+    warped = torch.where(out_valid, warped,
+                         torch.full_like(warped, pad_value))
+    if fg_mask is not None:
+        fg_mask = fg_mask.to(device)
+        fg_mask = torch.where(valid, fg_mask, torch.zeros_like(fg_mask))
+        fg_mask = F.grid_sample(fg_mask, grid, mode='bilinear',
+                                padding_mode='zeros', align_corners=True)
+    return warped, new_widths, fg_mask
+
+
+def otsu_threshold(pixels, valid):
+    # per image Otsu threshold of 0-255 pixel values, counting only valid ones
+    batch_size = pixels.size(0)
+    hist = torch.zeros(batch_size, 256, device=pixels.device)
+    hist.scatter_add_(1, pixels.long().view(batch_size, -1),
+                      valid.expand_as(pixels).float().reshape(batch_size, -1))
+    levels = torch.arange(256, device=pixels.device, dtype=torch.float)
+    w0 = hist.cumsum(1)
+    sum0 = (hist * levels).cumsum(1)
+    total = w0[:, -1:]
+    w1 = total - w0
+    mu0 = sum0 / w0.clamp(min=1)
+    mu1 = (sum0[:, -1:] - sum0) / w1.clamp(min=1)
+    between = w0 * w1 * (mu0 - mu1)**2
+    return between.argmax(dim=1).float()
+
+
+def _offset_conv(x, kernel, pad_mode='constant', value=0):
+    # correlate with a kernel anchored at its center (kernel_size//2), as
+    # OpenCV does, also for even sizes
+    k_h, k_w = kernel.size()
+    a_y = k_h // 2
+    a_x = k_w // 2
+    x = F.pad(x, (a_x, k_w - 1 - a_x, a_y, k_h - 1 - a_y), mode=pad_mode,
+              **({'value': value} if pad_mode == 'constant' else {}))
+    return F.conv2d(x, kernel[None, None].to(x.dtype))
+
+
+def change_thickness_batch(images, widths, size, fg_shade,
+                           bg_shade, blur_size, noise_sigma, pad_value):
+    # per line: Otsu binarize, dilate (size>0) or erode (size<0) with an
+    # ellipse of |size|, shade, box blur and Gaussian noise
+    batch_size = images.size(0)
+    device = images.device
+    valid = _column_mask(widths, images.size(3))
+    pixels = ((1 - images) * 128).round().clamp(0, 255)
+    thresh = otsu_threshold(pixels, valid)
+    ink = ((pixels <= thresh[:, None, None, None]) & valid).float()
+
+    size = size.tolist()
+    for s in set(size):
+        rad = abs(s)
+        if rad <= 1:
+            continue
+        group = [b for b in range(batch_size) if size[b] == s]
+        kernel = torch.from_numpy(cv2.getStructuringElement(
+            cv2.MORPH_ELLIPSE, (rad, rad)).astype(np.float32)).to(device)
+        g_ink = ink[group]
+        if s > 0:
+            ink[group] = (_offset_conv(g_ink, kernel) > 0).float()
+        else:
+            # outside the line counts as ink, like erode's default border
+            g_valid = valid[group]
+            outside = 1 - torch.where(g_valid, g_ink, torch.ones_like(g_ink))
+            eroded = 1 - (_offset_conv(outside, kernel) > 0).float()
+            eroded = eroded * g_valid.float()
+            # don't erode away the whole line
+            keep = eroded.sum(dim=(1, 2, 3)) < 0.1 * g_ink.sum(dim=(1, 2, 3))
+            ink[group] = torch.where(
+                keep[:, None, None, None], g_ink, eroded)
+
+    fg_shade = fg_shade.to(device).float()[:, None, None, None]
+    bg_shade = bg_shade.to(device).float()[:, None, None, None]
+    new_img = ink * (fg_shade - bg_shade) + bg_shade
+    new_img = torch.where(valid, new_img, bg_shade.expand_as(new_img))
+
+    blur_size = blur_size.tolist()
+    for k in set(blur_size):
+        if k <= 1:
+            continue
+        group = [b for b in range(batch_size) if blur_size[b] == k]
+        kernel = torch.full((k, k), 1.0 / (k * k), device=device)
+        new_img[group] = _offset_conv(new_img[group], kernel, 'reflect')
+
+    noise_sigma = noise_sigma.to(device).float()[:, None, None, None]
+    new_img = new_img + torch.randn_like(new_img) * noise_sigma
+    new_img = new_img.clamp(0, 1) * 2 - 1.0
+    return torch.where(valid, new_img, torch.full_like(new_img, pad_value))
+
+
+def augment_batch(instance, device=None, mask_post=[], mask_random=False):
+    # apply the augmentation a dataset deferred (instance['aug_params'])
+    params = instance.pop('aug_params', None)
+    if params is None:
+        return instance
+    image = instance['image']
+    if device is not None:
+        image = image.to(device)
+    params = {k: torch.from_numpy(np.asarray(v)) for k, v in params.items()}
+    widths = params['width'].to(image.device).long()
+    pad_value = float(params['padding'][0])
+
+    if 'skew' in params:
+        fg_mask = instance['fg_mask'] if 'fg_mask' in instance else None
+        image, widths, fg_mask = affine_batch(
+            image, widths, params['skew'], params['strech'], pad_value, fg_mask)
+        instance['image'] = image
+        if fg_mask is not None:
+            instance['fg_mask'] = fg_mask
+        if instance['mask'] is not None:
+            # the masks were made from the unaugmented lines
+            mask, top_and_bottom, center_line = makeMask(
+                image.cpu(), mask_post, mask_random)
+            instance['mask'] = mask
+            instance['top_and_bottom'] = top_and_bottom
+            instance['center_line'] = center_line
+    else:
+        instance['image'] = image
+
+    if 'thickness_change' in params:
+        instance['changed_image'] = change_thickness_batch(
+            image,
+            widths,
+            params['thickness_change'],
+            params['fg_shade'],
+            params['bg_shade'],
+            params['blur_size'],
+            params['noise_sigma'],
+            pad_value)
+    return instance
@@ -0,0 +1,106 @@
+import os
+import atexit
+import shutil
+import threading
+import traceback
+import queue
+import torch
+
+
+# Writes checkpoints from a background thread so training only waits for the
+# state to be copied (to the CPU), not for torch.save.
+# Every file is written to a temporary name in the same directory and then
+# renamed, so a checkpoint on disk is always complete (a crash mid-save leaves
+# the previous one). Extra names for the same checkpoint (checkpoint-latest,
+# the alt_save archive) are hard links when possible, else copies, and are
+# also swapped in with a rename.
+# At most max_in_flight saves are pending; submitting another waits for the
+# oldest. max_in_flight=0 writes in the calling thread.
+
+
+def snapshot(obj):
+    # copy of a (nested) state with every tensor copied to the CPU, so
+    # training can keep changing the originals
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        copied = type(obj)((k, snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # state_dict versions
+            copied._metadata = obj._metadata
+        return copied
+    elif isinstance(obj, list):
+        return [snapshot(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(snapshot(v) for v in obj)
+    return obj
+
+
+def _tmp_name(path):
+    return '{}.{}.tmp'.format(path, os.getpid())
+
+
+def atomic_save(state, path):
+    tmp_path = _tmp_name(path)
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_link(src, dst):
+    # dst becomes the same checkpoint as src (hard link, copy if that fails)
+    tmp_path = _tmp_name(dst)
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class CheckpointWriter:
+    def __init__(self, max_in_flight=2):
+        self.max_in_flight = max_in_flight
+        if max_in_flight > 0:
+            self.slots = threading.Semaphore(max_in_flight)
+            self.jobs = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            # don't lose pending saves when the program exits
+            atexit.register(self.wait)
+
+    def _write(self, state, path, links, rename):
+        atomic_save(state, path)
+        for link in links:
+            atomic_link(path, link)
+        if rename is not None:
+            os.replace(path, rename)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self._write(*job)
+            except Exception:
+                print('Error writing checkpoint {}'.format(job[1]))
+                traceback.print_exc()
+            finally:
+                self.jobs.task_done()
+                self.slots.release()
+
+    def save(self, state, path, links=[], rename=None):
+        # Write state to path, then point each of links at it and finally
+        # rename path to rename (if given).
+        # state must already be a snapshot (see snapshot()).
+        if self.max_in_flight <= 0:
+            self._write(state, path, links, rename)
+            return
+        self.slots.acquire()
+        self.jobs.put((state, path, list(links), rename))
+
+    def wait(self):
+        # block until every submitted checkpoint is on disk
+        if self.max_in_flight > 0:
+            self.jobs.join()
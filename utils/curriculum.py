@@ -57,6 +57,15 @@ class Curriculum:
 
         return self.current_lessons[iteration % len(self.current_lessons)]
 
+    def peekLesson(self, iteration):
+        # the lesson of a later iteration, without moving the curriculum on
+        lessons = getattr(self, 'current_lessons', None)
+        for start, stage_lessons in reversed(self.lessons):
+            if iteration < start:
+                break
+            lessons = stage_lessons
+        return lessons[iteration % len(lessons)]
+
     def getValid(self):
         return self.valid
 
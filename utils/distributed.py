@@ -0,0 +1,161 @@
+import os
+import sys
+import logging
+import datetime
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+# Data-parallel training over several processes (python train.py -w N, or
+# with torchrun, which sets RANK/WORLD_SIZE/MASTER_ADDR/MASTER_PORT).
+# Each process loads its own share of the data (a DistributedSampler, or the
+# width bucket sampler split by rank) and runs the full iteration. Rather than
+# wrapping the model in DistributedDataParallel, whose hooks all-reduce at
+# every backward, the trainer averages the gradients once, right before the
+# optimizer step: an iteration can have several backward passes (balance_loss
+# saves gradients per loss, gradient accumulation, "no-step" lessons), and
+# balance_loss has to rescale the averaged gradients, not each process's, or
+# the processes would step differently. Everything (current gradients and the
+# balancer's saved ones) goes in one flat all_reduce.
+# The model is broadcast from rank 0 at the start, so every process then
+# stays identical. Only rank 0 prints, logs, validates and saves checkpoints.
+# Uses gloo on CPU (so it runs without GPUs) and nccl with CUDA, one GPU per
+# process starting at config['gpu'].
+# While rank 0 validates, the other ranks wait in their next collective, so
+# the process group's timeout has to outlast a validation pass; it is
+# config['trainer']['distributed_timeout'] minutes (default TIMEOUT_MINUTES;
+# nccl's own default is much shorter).
+
+TIMEOUT_MINUTES = 180
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    return get_rank() == 0
+
+
+def init(rank, world_size, backend='gloo', port=None,
+         timeout=TIMEOUT_MINUTES):
+    if port is not None:
+        os.environ['MASTER_ADDR'] = os.environ.get('MASTER_ADDR', '127.0.0.1')
+        os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group(backend, rank=rank, world_size=world_size,
+                            timeout=datetime.timedelta(minutes=timeout))
+    # the same default seed in every process would give every process the
+    # same noise/dropout (the samplers have their own, shared, seed)
+    torch.manual_seed(torch.initial_seed() + rank)
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+        logging.getLogger().setLevel(logging.WARNING)
+
+
+def _worker(rank, world_size, backend, port, timeout, fn, args):
+    init(rank, world_size, backend, port, timeout)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, world_size, args=(), backend='gloo', port=29500,
+           timeout=TIMEOUT_MINUTES):
+    # run fn(*args) in world_size local processes
+    mp.spawn(_worker, args=(world_size, backend, port, timeout, fn, args),
+             nprocs=world_size, join=True)
+
+
+def init_from_env(backend='gloo', timeout=TIMEOUT_MINUTES):
+    # started by torchrun (or similar); returns whether this is a distributed
+    # run
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    init(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), backend,
+         timeout=timeout)
+    return True
+
+
+def broadcast_model(model):
+    # every process starts from rank 0's parameters (and buffers)
+    if not is_distributed():
+        return
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+
+def all_max(value, device=None):
+    if not is_distributed():
+        return value
+    t = torch.tensor([value], dtype=torch.long, device=device)
+    dist.all_reduce(t, op=dist.ReduceOp.MAX)
+    return int(t.item())
+
+
+def all_gather(tensor):
+    # concatenation (dim 0) of every process's tensor, which may have
+    # different first dimensions
+    if not is_distributed():
+        return tensor
+    world_size = get_world_size()
+    sizes = [torch.zeros(1, dtype=torch.long, device=tensor.device)
+             for r in range(world_size)]
+    dist.all_gather(sizes, torch.tensor(
+        [tensor.size(0)], dtype=torch.long, device=tensor.device))
+    sizes = [int(s.item()) for s in sizes]
+    max_size = max(sizes)
+    padded = tensor.new_zeros((max_size,) + tensor.size()[1:])
+    padded[:tensor.size(0)] = tensor
+    gathered = [torch.empty_like(padded) for r in range(world_size)]
+    dist.all_gather(gathered, padded.contiguous())
+    return torch.cat([g[:s] for g, s in zip(gathered, sizes)], dim=0)
+
+
+def average_gradients(parameters, buffers=[]):
+    # Average the parameters' gradients (and the flat tensors in buffers)
+    # over the processes, in a single all_reduce. A parameter gets a
+    # gradient if any process has one for it.
+    if not is_distributed():
+        return
+    parameters = list(parameters)
+    if len(parameters) == 0 and len(buffers) == 0:
+        return
+    ref = parameters[0] if len(parameters) > 0 else buffers[0]
+    has_grad = torch.tensor([p.grad is not None for p in parameters],
+                            dtype=ref.dtype, device=ref.device)
+    flat = torch.cat(
+        [p.grad.reshape(-1) if p.grad is not None
+         else torch.zeros(p.numel(), dtype=ref.dtype, device=ref.device)
+         for p in parameters] +
+        [b.reshape(-1) for b in buffers] + [has_grad])
+    dist.all_reduce(flat)
+    values = flat[:flat.numel() - len(parameters)]
+    values /= get_world_size()
+    any_grad = (flat[values.numel():] > 0).tolist()
+
+    values = values.split([p.numel() for p in parameters] +
+                          [b.numel() for b in buffers])
+    for p, value, got in zip(parameters, values, any_grad):
+        if p.grad is not None:
+            p.grad.copy_(value.view_as(p.grad))
+        elif got:
+            p.grad = value.view_as(p).clone()
+    for b, value in zip(buffers, values[len(parameters):]):
+        b.copy_(value.view_as(b))
+
+
+def set_epoch(data_loader, epoch):
+    # reshuffle the processes' shares of the data
+    for sampler in [data_loader.sampler, data_loader.batch_sampler]:
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
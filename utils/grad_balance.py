@@ -0,0 +1,148 @@
+import torch
+from utils import distributed
+
+
+# Gradient balancing for "balance_loss" (https://arxiv.org/pdf/1903.00277.pdf)
+# The gradients of the losses being balanced (and of "no-step" iterations) are
+# saved, and at the next optimizer step each saved gradient is added to the
+# current one, rescaled per parameter to have the current gradient's mean
+# absolute value (times a multiplier).
+# Saved gradients are copied into flat buffers allocated once and reused, and
+# the per parameter reductions and rescaling use torch._foreach_* ops, so a
+# step is a handful of multi-tensor kernels instead of several per parameter.
+# Parameters that can't change (requires_grad off, or the HWR when it's
+# frozen) are left out.
+# In distributed training, all_reduce() averages the current and saved
+# gradients over the processes before apply(), so they all rescale the same
+# (averaged) gradients.
+
+
+def _abs_means(tensors, numels):
+    if hasattr(torch, '_foreach_norm'):
+        sums = torch._foreach_norm(tensors, 1)
+    else:
+        sums = [t.abs().sum() for t in tensors]
+    return torch.stack(sums) / numels
+
+
+class GradientBalancer:
+    def __init__(self, parameters):
+        self.parameters = list(parameters)
+        self.numels = [p.numel() for p in self.parameters]
+        self.total = sum(self.numels)
+        p0 = self.parameters[0]
+        self.numel_t = torch.tensor(
+            self.numels, dtype=p0.dtype, device=p0.device)
+        self.buffers = []  # one flat gradient per saved slot, kept around
+        self.num_saved = 0
+        self.stash_buffer = None
+        self.zeros = None
+
+    def __len__(self):
+        return self.num_saved
+
+    def _grads(self):
+        # current gradients, zeros for parameters that have none
+        grads = []
+        for p, n in zip(self.parameters, self.numels):
+            if p.grad is not None:
+                grads.append(p.grad.view(-1))
+            else:
+                if self.zeros is None:
+                    self.zeros = torch.zeros(
+                        max(self.numels), dtype=p.dtype, device=p.device)
+                grads.append(self.zeros[:n])
+        return grads
+
+    def _views(self, flat):
+        return list(flat.split(self.numels))
+
+    def _new_buffer(self):
+        p0 = self.parameters[0]
+        return torch.empty(self.total, dtype=p0.dtype, device=p0.device)
+
+    def _zero_grads(self):
+        present = [p.grad for p in self.parameters if p.grad is not None]
+        if len(present) > 0:
+            torch._foreach_zero_(present)
+
+    def save(self, into=None):
+        # move the current gradients into a new saved slot, or add them to
+        # slot into (gradient accumulation); returns the slot
+        if into is None:
+            if self.num_saved == len(self.buffers):
+                self.buffers.append(self._new_buffer())
+            torch.cat(self._grads(), out=self.buffers[self.num_saved])
+            into = self.num_saved
+            self.num_saved += 1
+        else:
+            torch._foreach_add_(self._views(self.buffers[into]), self._grads())
+        self._zero_grads()
+        return into
+
+    def stash(self):
+        # set the current gradients aside (zeroing them) until unstash(), so
+        # the next backward can be saved on its own
+        if self.stash_buffer is None:
+            self.stash_buffer = self._new_buffer()
+        torch.cat(self._grads(), out=self.stash_buffer)
+        self._zero_grads()
+
+    def unstash(self):
+        # add the stashed gradients back in
+        index = [i for i, p in enumerate(self.parameters) if p.grad is not None]
+        views = self._views(self.stash_buffer)
+        torch._foreach_add_([self.parameters[i].grad.view(-1) for i in index],
+                            [views[i] for i in index])
+
+    def all_reduce(self):
+        # a process that saved fewer gradients (it skipped a batch) adds zeros
+        p0 = self.parameters[0]
+        num = distributed.all_max(self.num_saved, p0.device)
+        while self.num_saved < num:
+            if self.num_saved == len(self.buffers):
+                self.buffers.append(self._new_buffer())
+            self.buffers[self.num_saved].zero_()
+            self.num_saved += 1
+        distributed.average_gradients(
+            self.parameters, self.buffers[:self.num_saved])
+
+    def apply(self, multipliers, check_nan=True):
+        # add the saved gradients (the gi-th scaled by multipliers[gi]) into
+        # the current ones and forget them
+        abmean_Ds = _abs_means(self._grads(), self.numel_t)
+        if check_nan:
+            assert not torch.isnan(abmean_Ds).any()
+        # in case of zero mean, use the mean of the nonzero ones
+        nonzero = abmean_Ds != 0
+        nonzero_count = nonzero.sum()
+        fill = abmean_Ds.sum() / nonzero_count.clamp(min=1)
+        abmean_Ds = torch.where(
+            nonzero | (nonzero_count == 0), abmean_Ds, fill)
+
+        scales = []
+        for gi in range(self.num_saved):
+            views = self._views(self.buffers[gi])
+            abmean_R = _abs_means(views, self.numel_t)
+            scale = multipliers[gi] * abmean_Ds / abmean_R
+            scales.append(torch.where(
+                abmean_R != 0, scale, torch.zeros_like(scale)))
+        # the only sync with the host, for the multi-tensor scaling
+        scales = torch.stack(scales).tolist()
+
+        # parameters with no gradient only get one if something is added
+        index = [i for i, p in enumerate(self.parameters)
+                 if p.grad is not None or
+                 any(scale[i] != 0 for scale in scales)]
+        for i in index:
+            p = self.parameters[i]
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+        grads = [self.parameters[i].grad for i in index]
+        for gi in range(self.num_saved):
+            views = self._views(self.buffers[gi])
+            views = [views[i].view_as(g) for i, g in zip(index, grads)]
+            torch._foreach_mul_(views, [scales[gi][i] for i in index])
+            torch._foreach_add_(grads, views)
+        self.num_saved = 0
+
@@ -1,5 +1,7 @@
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
 from scipy.interpolate import griddata
 import sys
 
@@ -12,6 +14,8 @@ INTERPOLATION = {
 def warp_image(img, random_state=None, **kwargs):
     if img.shape[0] <= 5 or img.shape[1] <= 5:
         return img
+    if kwargs.get('mode', 'griddata') == 'fast':
+        return warp_image_fast(img, random_state, **kwargs)
     if random_state is None:
         random_state = np.random.RandomState()
 
@@ -85,9 +89,127 @@ def warp_image(img, random_state=None, **kwargs):
     return warped
 
 
+def _mesh(h, w, kwargs):
+    # number of control point intervals along each axis
+    w_mesh_interval = kwargs.get('w_mesh_interval', 12)
+    h_mesh_interval = kwargs.get('h_mesh_interval', 12)
+    if kwargs.get("fit_interval_to_image", True):
+        w_ratio = max(1, round(w / float(w_mesh_interval)))
+        h_ratio = max(1, round(h / float(h_mesh_interval)))
+    else:
+        w_ratio = max(1, int(np.ceil(w / float(w_mesh_interval))))
+        h_ratio = max(1, int(np.ceil(h / float(h_mesh_interval))))
+    return h_ratio, w_ratio
+
+
+def _interp_matrix(size, intervals, interpolation_method):
+    # size x intervals+1 weights interpolating values on control points at
+    # 0, size/intervals, ..., size to every pixel 0..size-1
+    pos = np.arange(size) * intervals / float(size)
+    base = np.floor(pos).astype(int)
+    t = pos - base
+    weights = np.zeros((size, intervals + 1))
+    rows = np.arange(size)
+    if interpolation_method == 'cubic':
+        # Keys cubic convolution (a=-0.5), clamped at the ends
+        a = -0.5
+        for offset in range(-1, 3):
+            d = np.abs(t - offset)
+            k = np.where(d <= 1,
+                         (a + 2) * d**3 - (a + 3) * d**2 + 1,
+                         a * d**3 - 5 * a * d**2 + 8 * a * d - 4 * a)
+            k[d >= 2] = 0
+            np.add.at(weights, (rows, np.clip(base + offset, 0, intervals)), k)
+    else:
+        weights[rows, base] += 1 - t
+        weights[rows, np.minimum(base + 1, intervals)] += t
+    return weights
+
+
+def warp_image_fast(img, random_state=None, **kwargs):
+    # Same distortion as warp_image, without the Delaunay triangulation
+    # griddata does: the control point offsets are interpolated to every
+    # pixel separably (bilinear or bicubic, one small matrix product per
+    # axis) and the inverse mapping is taken as pixel minus offset, which is
+    # what griddata's inverse comes to for small offsets.
+    if img.shape[0] <= 5 or img.shape[1] <= 5:
+        return img
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    w_mesh_std = kwargs.get('w_mesh_std', 1.5)
+    h_mesh_std = kwargs.get('h_mesh_std', 1.5)
+    interpolation_method = kwargs.get('interpolation', 'linear')
+
+    h, w = img.shape[:2]
+    h_ratio, w_ratio = _mesh(h, w, kwargs)
+
+    # Perturb control points
+    source_shape = ((h_ratio + 1) * (w_ratio + 1),)
+    offset_y = random_state.normal(0.0, h_mesh_std, size=source_shape)
+    offset_x = random_state.normal(0.0, w_mesh_std, size=source_shape)
+    offset_y = offset_y.reshape(h_ratio + 1, w_ratio + 1)
+    offset_x = offset_x.reshape(h_ratio + 1, w_ratio + 1)
+
+    interp_y = _interp_matrix(h, h_ratio, interpolation_method)
+    interp_x = _interp_matrix(w, w_ratio, interpolation_method)
+    grid_y, grid_x = np.mgrid[0:h, 0:w]
+    map_x = (grid_x - interp_y.dot(offset_x).dot(interp_x.T)).astype(np.float32)
+    map_y = (grid_y - interp_y.dot(offset_y).dot(interp_x.T)).astype(np.float32)
+    meanV = img.mean()
+    warped = cv2.remap(
+        img,
+        map_x,
+        map_y,
+        INTERPOLATION[interpolation_method],
+        borderValue=(
+            meanV,
+            meanV,
+            meanV))
+
+    return warped
+
+
+def warp_batch(imgs, **kwargs):
+    # warp_image_fast for a Batch x Channels x H x W tensor with
+    # grid_sample, a different random distortion per image. Pixels mapped
+    # from outside the image get that image's mean, as in warp_image.
+    batch_size, channels, h, w = imgs.size()
+    if h <= 5 or w <= 5:
+        return imgs
+    w_mesh_std = kwargs.get('w_mesh_std', 1.5)
+    h_mesh_std = kwargs.get('h_mesh_std', 1.5)
+    interpolation_method = kwargs.get('interpolation', 'linear')
+    mode = 'bicubic' if interpolation_method == 'cubic' else 'bilinear'
+
+    h_ratio, w_ratio = _mesh(h, w, kwargs)
+    std = torch.tensor([w_mesh_std, h_mesh_std],
+                       dtype=torch.float, device=imgs.device)
+    offsets = torch.randn(batch_size, 2, h_ratio + 1, w_ratio + 1,
+                          device=imgs.device) * std[None, :, None, None]
+    offsets = F.interpolate(offsets, size=(h, w), mode=mode,
+                            align_corners=True)  # Batch x 2(x,y) x H x W
+
+    grid_x = torch.arange(w, dtype=torch.float, device=imgs.device)
+    grid_y = torch.arange(h, dtype=torch.float, device=imgs.device)
+    map_x = grid_x[None, None, :] - offsets[:, 0]
+    map_y = grid_y[None, :, None] - offsets[:, 1]
+    # to grid_sample's [-1,1] coordinates
+    grid = torch.stack((map_x * (2.0 / (w - 1)) - 1,
+                        map_y * (2.0 / (h - 1)) - 1), dim=3)
+
+    meanV = imgs.mean(dim=(1, 2, 3), keepdim=True)
+    warped = F.grid_sample(imgs - meanV, grid.to(imgs.dtype), mode=mode,
+                           padding_mode='zeros', align_corners=True)
+    return warped + meanV
+
+
 if __name__ == "__main__":
     input_image = sys.argv[1]
     output_image = sys.argv[2]
     img = cv2.imread(input_image)
-    img = warp_image(img, draw_grid_lines=True)
+    if len(sys.argv) > 3:
+        img = warp_image(img, mode=sys.argv[3])
+    else:
+        img = warp_image(img, draw_grid_lines=True)
     cv2.imwrite(output_image, img)
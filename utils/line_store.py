@@ -0,0 +1,130 @@
+import os
+import json
+import cv2
+import numpy as np
+
+
+# A "line store" is every line image of a dataset, already cropped out of its
+# form and height-normalized, packed one after another (uint8, row-major) into
+# a single file:
+#   <path>.bin  raw pixels
+#   <path>.json {"img_height":H, "max_width":W, "lines":{key:[offset,h,w]}}
+# The .bin is memory-mapped, so reading a line is a zero-copy view instead of
+# decoding the full form PNG.
+# Use pack_lines.py to build one and "line_store": <path> in the data_loader
+# config to use it.
+
+
+def line_key(img_path, lb=None):
+    # lb is the [top,bottom,left,right] crop of the line in img_path, None if
+    # the image is already a single line
+    if lb is None:
+        return img_path
+    return '{}:{},{},{},{}'.format(img_path, *lb)
+
+
+def crop_line(img, lb):
+    if lb is None:
+        return img
+    top = max(lb[0], 0)
+    left = max(lb[2], 0)
+    bot = min(lb[1], img.shape[0])
+    right = min(lb[3], img.shape[1])
+    return img[top:bot, left:right]
+
+
+def resize_line(img, img_height, max_width):
+    # same height normalization the author datasets do when they read a line
+    if img.shape[0] != img_height:
+        percent = float(img_height) / img.shape[0]
+        if img.shape[1] * percent > max_width:
+            percent = max_width / img.shape[1]
+    elif img.shape[1] > max_width:
+        percent = max_width / img.shape[1]
+    else:
+        return img
+    img = cv2.resize(img, (0, 0), fx=percent,
+                     fy=percent, interpolation=cv2.INTER_CUBIC)
+    if img.shape[0] < img_height:
+        diff = img_height - img.shape[0]
+        img = np.pad(
+            img, ((diff // 2, diff // 2 + diff %
+                   2), (0, 0)), 'constant', constant_values=255)
+    return img
+
+
+def resized_width(h, w, img_height, max_width):
+    # width resize_line() gives a h x w line, without reading it
+    if h != img_height:
+        return min(w * float(img_height) / h, max_width)
+    return min(w, max_width)
+
+
+class LineStore:
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.json') as f:
+            index = json.load(f)
+        self.img_height = index['img_height']
+        self.max_width = index['max_width']
+        self.lines = index['lines']
+        # opened lazily so each DataLoader worker maps the file itself
+        self.data = None
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, key):
+        return key in self.lines
+
+    def get(self, key):
+        if self.data is None:
+            self.data = np.memmap(self.path + '.bin', dtype=np.uint8, mode='r')
+        offset, h, w = self.lines[key]
+        return self.data[offset:offset + h * w].reshape(h, w)
+
+    def width(self, key):
+        return self.lines[key][2]
+
+    def matches(self, img_height, max_width):
+        return self.img_height == img_height and self.max_width == max_width
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+
+def pack_lines(path, sources, img_height, max_width):
+    # sources is a list of (img_path, lb) as returned by a dataset's
+    # line_sources(). Lines are grouped by form so each form is decoded once.
+    sources = sorted(set((img_path, None if lb is None else tuple(lb))
+                     for img_path, lb in sources), key=lambda s: s[0])
+    index = {}
+    offset = 0
+    last_path = None
+    with open(path + '.bin', 'wb') as f:
+        for i, (img_path, lb) in enumerate(sources):
+            if img_path != last_path:
+                form = cv2.imread(img_path, 0)
+                last_path = img_path
+            if form is None:
+                print('Error, could not read image: {}'.format(img_path))
+                continue
+            img = crop_line(form, lb)
+            if img.shape[0] == 0 or img.shape[1] == 0:
+                print('Error, empty line {} in {}'.format(lb, img_path))
+                continue
+            img = np.ascontiguousarray(
+                resize_line(img, img_height, max_width), dtype=np.uint8)
+            f.write(img.tobytes())
+            index[line_key(img_path, lb)] = [
+                offset, img.shape[0], img.shape[1]]
+            offset += img.size
+            print('packed {}/{}'.format(i + 1, len(sources)), end='\r')
+    with open(path + '.json', 'w') as f:
+        json.dump({'img_height': img_height,
+                   'max_width': max_width,
+                   'lines': index}, f)
+    print('packed {} lines ({} MB) into {}.bin'.format(
+        len(index), offset / (1024 * 1024), path))
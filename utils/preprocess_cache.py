@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+# On-disk cache of the deterministic part of reading a line: decode, crop,
+# height-normalize and (when the augmentation has 'normalization')
+# deskew+skeletonize. Entries are addressed by a hash of the source image
+# (path, size, mtime), the crop box and the preprocessing parameters, so
+# changing img_height/max_width/normalization or editing an image never hits
+# a stale entry, and the cache can be shared between runs and configs.
+# Each entry is a .npy file. Reads touch the file's mtime and, when the cache
+# grows past its size cap, the least recently used entries are deleted.
+# Everything lives in the filesystem, so DataLoader workers (and concurrent
+# runs) can share one cache directory.
+# Use "preprocess_cache": <dir> in the data_loader config, optionally with
+# "preprocess_cache_size": <MB> (default 2048).
+
+VERSION = 1
+
+
+class PreprocessCache:
+    def __init__(self, cache_dir, max_mb=2048):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        # bytes in the cache as far as this process knows, counted on first put
+        self.size = None
+
+    def key(self, img_path, lb, params):
+        try:
+            stat = os.stat(img_path)
+            source = [img_path, stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            source = [img_path]
+        lb = None if lb is None else [int(v) for v in lb]
+        desc = json.dumps([VERSION, source, lb, params], sort_keys=True)
+        return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            img = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            # evicted by another process mid-read, or a partial file
+            return None
+        return img
+
+    def put(self, key, img):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so readers never see a partial entry
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(img))
+        os.replace(tmp_path, path)
+
+        if self.size is None:
+            self.size = self.total_size()
+        else:
+            self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        entries = []
+        for sub in os.listdir(self.cache_dir):
+            sub_dir = os.path.join(self.cache_dir, sub)
+            if not os.path.isdir(sub_dir):
+                continue
+            for name in os.listdir(sub_dir):
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(sub_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def total_size(self):
+        return sum(size for mtime, size, path in self.entries())
+
+    def evict(self):
+        # drop least recently used entries until under 90% of the cap
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, path in entries)
+        goal = 0.9 * self.max_bytes
+        for mtime, size, path in entries:
+            if total <= goal:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.size = total
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import pickle
+import numpy as np
+from glob import glob
+from collections import defaultdict
+
+
+# A "style store" is a directory holding extracted style vectors as columns:
+#   <path>/meta.json    rows, the shape of each component, the author index
+#                       (author -> [start, end) row ranges) and, for the
+#                       datasets' style_loc, whether there are ids
+#   <path>/<name>.f32   one file per component, float32, row after row
+#                       ("style" for plain style vectors; "global", "spacing"
+#                       and "char" for char-specific styles)
+#   <path>/ids.jsonl    optional, the line ids each row was extracted from
+# The component files are memory-mapped, so opening a store is reading
+# meta.json and a style is a zero-copy view. Rows can be appended; meta.json
+# is only replaced once the rows are written, so a store is always complete
+# up to the last append (anything after it is overwritten by the next one).
+# get_styles.py writes them; generate.py, render_server.py, eval_writer_id.py,
+# umap_styles.py and the author datasets' "style_loc" read them (or the older
+# pickles). Convert pickles with
+# python -m utils.style_store <store path> <pickle glob>
+
+VERSION = 1
+CHAR_SPEC_COMPONENTS = ['global', 'spacing', 'char']
+
+
+class StyleStore:
+    def __init__(self, path, mode='r'):
+        # mode 'r' to read, 'a' to append (creating the store if needed)
+        self.path = path
+        self.mode = mode
+        if os.path.exists(self._meta_path()):
+            with open(self._meta_path()) as f:
+                meta = json.load(f)
+            assert meta['version'] == VERSION
+        else:
+            assert mode == 'a', 'no style store at {}'.format(path)
+            os.makedirs(path, exist_ok=True)
+            meta = {'version': VERSION, 'rows': 0, 'components': None,
+                    'authors': {}, 'has_ids': None, 'ids_bytes': 0,
+                    'info': {}}
+        self.rows = meta['rows']
+        self.components = meta['components']  # [[name, shape], ...]
+        self.author_ranges = meta['authors']
+        self.has_ids = meta['has_ids']
+        self.ids_bytes = meta['ids_bytes'] if 'ids_bytes' in meta else 0
+        self.info = meta['info']
+        self.arrays = None
+        self.id_list = None
+
+    @staticmethod
+    def is_store(path):
+        return os.path.exists(os.path.join(path, 'meta.json'))
+
+    def _meta_path(self):
+        return os.path.join(self.path, 'meta.json')
+
+    def _component_path(self, name):
+        return os.path.join(self.path, name + '.f32')
+
+    def _open(self):
+        self.arrays = {}
+        for name, shape in self.components:
+            if self.rows > 0:
+                self.arrays[name] = np.memmap(
+                    # copy-on-write: torch.from_numpy wants writable arrays,
+                    # and changes stay in memory
+                    self._component_path(name), dtype=np.float32, mode='c',
+                    shape=(self.rows,) + tuple(shape))
+            else:
+                self.arrays[name] = np.zeros(
+                    (0,) + tuple(shape), dtype=np.float32)
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def char_spec(self):
+        return self.components is not None and len(self.components) > 1
+
+    @property
+    def authors(self):
+        return list(self.author_ranges.keys())
+
+    def component(self, name):
+        # rows x shape array of one component
+        if self.arrays is None:
+            self._open()
+        return self.arrays[name]
+
+    def get(self, i):
+        # the style of row i: an array, or a (global, spacing, char) tuple
+        if self.arrays is None:
+            self._open()
+        if self.char_spec:
+            return tuple(self.arrays[name][i]
+                         for name in CHAR_SPEC_COMPONENTS)
+        return self.arrays['style'][i]
+
+    def rows_of(self, author):
+        # row indices of an author's styles
+        ranges = self.author_ranges[author] if author in self.author_ranges else []
+        if len(ranges) == 1:
+            return np.arange(ranges[0][0], ranges[0][1])
+        return np.concatenate([np.arange(start, end) for start, end in ranges]
+                              + [np.zeros(0, dtype=np.int64)])
+
+    def by_author(self):
+        # {author: [style, ...]}, the views in the order they were appended
+        return {author: [self.get(i) for i in self.rows_of(author)]
+                for author in self.author_ranges}
+
+    def row_authors(self):
+        # the author of each row
+        authors = np.empty(self.rows, dtype=object)
+        for author, ranges in self.author_ranges.items():
+            for start, end in ranges:
+                authors[start:end] = author
+        return authors
+
+    def ids(self, i):
+        if self.id_list is None:
+            with open(os.path.join(self.path, 'ids.jsonl'), 'rb') as f:
+                lines = f.read(self.ids_bytes).decode('utf-8').splitlines()
+            self.id_list = [json.loads(line) for line in lines]
+        return self.id_list[i]
+
+    def matrix(self, names=None):
+        # rows x features, the components (all by default) flattened and
+        # concatenated; a copy
+        if self.arrays is None:
+            self._open()
+        if names is None:
+            names = [name for name, shape in self.components]
+        return np.concatenate(
+            [self.arrays[name].reshape(self.rows, -1) for name in names], axis=1)
+
+    def append(self, styles, authors, ids=None, info=None):
+        # Add rows: styles is an array (rows x ...) or a tuple of global,
+        # spacing and char style arrays, authors has the author of each row
+        # and ids (if the store has them) the list of line ids of each.
+        # info is merged into the store's info (kept in meta.json), e.g. to
+        # know where an extraction got to.
+        assert self.mode == 'a'
+        if isinstance(styles, (tuple, list)):
+            arrays = dict(zip(CHAR_SPEC_COMPONENTS, styles))
+            names = CHAR_SPEC_COMPONENTS
+        else:
+            arrays = {'style': styles}
+            names = ['style']
+        arrays = {name: np.ascontiguousarray(a, dtype=np.float32)
+                  for name, a in arrays.items()}
+        num = len(authors)
+        if self.components is None:
+            self.components = [[name, list(arrays[name].shape[1:])]
+                               for name in names]
+            self.has_ids = ids is not None
+        assert [name for name, shape in self.components] == names
+        assert self.has_ids == (ids is not None)
+        for name, shape in self.components:
+            assert arrays[name].shape == (num,) + tuple(shape)
+            with open(self._component_path(name), 'r+b' if os.path.exists(
+                    self._component_path(name)) else 'wb') as f:
+                # whatever is past the last complete append is dropped
+                f.seek(self.rows * int(np.prod(shape, dtype=np.int64)) * 4)
+                f.write(arrays[name].tobytes())
+                f.truncate()
+        if ids is not None:
+            self._append_ids(ids)
+
+        for i, author in enumerate(authors):
+            author = str(author)
+            row = self.rows + i
+            ranges = self.author_ranges.setdefault(author, [])
+            if len(ranges) > 0 and ranges[-1][1] == row:
+                ranges[-1][1] = row + 1
+            else:
+                ranges.append([row, row + 1])
+        self.rows += num
+        if info is not None:
+            self.info.update(info)
+        self._write_meta()
+        self.arrays = None
+        self.id_list = None
+
+    def update_info(self, info):
+        assert self.mode == 'a'
+        self.info.update(info)
+        self._write_meta()
+
+    def _append_ids(self, ids):
+        path = os.path.join(self.path, 'ids.jsonl')
+        lines = ''.join(json.dumps([str(i) for i in row_ids]) + '\n'
+                        for row_ids in ids).encode('utf-8')
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.seek(self.ids_bytes)
+            f.write(lines)
+            f.truncate()
+        self.ids_bytes += len(lines)
+
+    def _write_meta(self):
+        tmp_path = self._meta_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': VERSION,
+                       'rows': self.rows,
+                       'components': self.components,
+                       'authors': self.author_ranges,
+                       'has_ids': self.has_ids,
+                       'ids_bytes': self.ids_bytes,
+                       'info': self.info}, f)
+        os.replace(tmp_path, self._meta_path())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+
+def read_pickles(style_loc):
+    # (styles, authors, ids or None) of each pickle matching style_loc
+    if style_loc[-1] != '*':
+        style_loc += '*'
+    all_style_files = glob(style_loc)
+    assert(len(all_style_files) > 0)
+    for loc in all_style_files:
+        with open(loc, 'rb') as f:
+            data = pickle.load(f)
+        yield data['styles'], data['authors'], data['ids'] if 'ids' in data else None
+
+
+def convert_pickles(path, style_loc):
+    store = StyleStore(path, 'a')
+    for styles, authors, ids in read_pickles(style_loc):
+        if isinstance(styles, list):
+            # char-specific: a list of (global, spacing, char) tuples
+            styles = tuple(np.stack([s[k] for s in styles])
+                           for k in range(3))
+        store.append(styles, list(authors), ids)
+    print('{} styles of {} authors in {}'.format(
+        len(store), len(store.author_ranges), path))
+    return store
+
+
+def load_styles_by_id(style_loc):
+    # For the author datasets' "style_loc": {author: {line id: [styles of the
+    # author not extracted from that line]}}, from a store or pickles
+    no_ids = '{} has no line ids; style_loc needs styles extracted with the ids of their lines (get_styles.py on an author dataset)'
+    if StyleStore.is_store(style_loc):
+        store = StyleStore(style_loc)
+        assert store.has_ids, no_ids.format(style_loc)
+        by_author_styles = defaultdict(list)
+        for author in store.author_ranges:
+            for i in store.rows_of(author):
+                by_author_styles[author].append(
+                    (store.get(i), set(store.ids(i))))
+    else:
+        by_author_styles = defaultdict(list)
+        for styles, authors, ids in read_pickles(style_loc):
+            assert ids is not None, no_ids.format(style_loc)
+            for i in range(len(authors)):
+                by_author_styles[authors[i]].append((styles[i], ids[i]))
+
+    styles = defaultdict(lambda: defaultdict(list))
+    for author in by_author_styles:
+        all_ids = set()
+        for style, ids in by_author_styles[author]:
+            all_ids.update(ids)
+        for id in all_ids:
+            for style, ids in by_author_styles[author]:
+                if id not in ids:
+                    styles[author][id].append(style)
+    return styles
+
+
+if __name__ == '__main__':
+    convert_pickles(sys.argv[1], sys.argv[2])
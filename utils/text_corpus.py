@@ -0,0 +1,246 @@
+import os
+import re
+import sys
+import json
+import numpy as np
+
+
+# A text corpus prebuilt for TextData, so it doesn't have to read and
+# whitespace-normalize the whole file at every start:
+#   <textfile>.<mode>.codes  the (normalized) text, one code point per element
+#                            (uint8/16/32, whatever fits the text)
+#   <textfile>.<mode>.index  int64 offsets: word/line boundaries, and for
+#                            'chars' the positions of each balance character
+#   <textfile>.<mode>.json   sizes, dtype and where each part of .index is
+# Everything is memory-mapped. Modes match TextData's:
+#   'chars' text with \s+ replaced by ' ' (plus a per-character index so a
+#           window containing a given character is an O(1) lookup)
+#   'words' 'chars' split on spaces, dropping words that are only punctuation
+#   'lines' the raw text split on newlines
+# It is (re)built automatically the first time it's needed (a build writes
+# temporary files and renames them, so concurrent builds are safe), or with
+# python -m utils.text_corpus <textfile> [mode]
+
+BALANCE_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+PUNCTUATION = '.,:\'"?!'
+CHUNK = 1 << 24  # characters
+VERSION = 1
+
+
+def _paths(textfile, mode):
+    prefix = '{}.{}'.format(textfile, mode)
+    return prefix + '.codes', prefix + '.index', prefix + '.json'
+
+
+def _source_stamp(textfile):
+    stat = os.stat(textfile)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _chunks(textfile):
+    with open(textfile) as f:
+        while True:
+            chunk = f.read(CHUNK)
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+
+def _codes(text):
+    return np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+
+
+def _count(codes_mm, length, values):
+    # occurrences of each value in the codes
+    counts = np.zeros(len(values), dtype=np.int64)
+    for start in range(0, length, CHUNK):
+        block = codes_mm[start:start + CHUNK]
+        for i, v in enumerate(values):
+            counts[i] += np.count_nonzero(block == v)
+    return counts
+
+
+def _positions(codes_mm, length, values, out, offsets):
+    # write the positions of each value into out[offsets[i]:offsets[i+1]]
+    cursor = offsets[:-1].copy()
+    for start in range(0, length, CHUNK):
+        block = codes_mm[start:start + CHUNK]
+        for i, v in enumerate(values):
+            pos = np.nonzero(block == v)[0] + start
+            out[cursor[i]:cursor[i] + len(pos)] = pos
+            cursor[i] += len(pos)
+
+
+def build_corpus(textfile, mode='chars'):
+    # Each file is written under a temporary name and renamed into place, the
+    # .json last, so several processes (e.g. distributed training ranks)
+    # building the same corpus at once never see, or truncate, one another's
+    # partial files; whichever finishes last wins, with identical contents.
+    final_paths = _paths(textfile, mode)
+    codes_path, index_path, json_path = [
+        '{}.{}.tmp'.format(path, os.getpid()) for path in final_paths]
+    print('indexing text corpus {} ({})'.format(textfile, mode))
+
+    # the widest code point decides the dtype
+    max_code = 0
+    for chunk in _chunks(textfile):
+        max_code = max(max_code, int(_codes(chunk).max()))
+    if max_code < 256:
+        dtype = 'uint8'
+    elif max_code < 65536:
+        dtype = 'uint16'
+    else:
+        dtype = 'uint32'
+
+    # same as re.sub('\\s+', ' ', text), a chunk at a time
+    length = 0
+    prev_space = False
+    with open(codes_path, 'wb') as f:
+        for chunk in _chunks(textfile):
+            if mode != 'lines':
+                chunk = re.sub('\\s+', ' ', chunk)
+                if prev_space and chunk.startswith(' '):
+                    chunk = chunk[1:]
+                if len(chunk) > 0:
+                    prev_space = chunk.endswith(' ')
+            f.write(_codes(chunk).astype(dtype).tobytes())
+            length += len(chunk)
+    codes = np.memmap(codes_path, dtype=dtype, mode='r', shape=(length,)) \
+        if length > 0 else np.zeros(0, dtype)
+
+    meta = {'version': VERSION,
+            'source': _source_stamp(textfile),
+            'mode': mode,
+            'dtype': dtype,
+            'length': length}
+    if mode == 'chars':
+        values = [ord(c) for c in BALANCE_CHARS]
+        counts = _count(codes, length, values)
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        index = np.memmap(index_path, dtype=np.int64, mode='w+',
+                          shape=(max(int(offsets[-1]), 1),))
+        _positions(codes, length, values, index, offsets)
+        index.flush()
+        meta['chars'] = {c: [int(offsets[i]), int(counts[i])]
+                         for i, c in enumerate(BALANCE_CHARS)}
+    else:
+        # item i is codes[index[i]:index[num+i]]
+        sep = ord(' ') if mode == 'words' else ord('\n')
+        num_sep = int(_count(codes, length, [sep])[0])
+        seps = np.zeros(num_sep, dtype=np.int64)
+        _positions(codes, length, [sep], seps,
+                   np.array([0, num_sep], dtype=np.int64))
+        starts = np.concatenate(([0], seps + 1))
+        ends = np.concatenate((seps, [length]))
+        if mode == 'words':
+            # text.strip().split(' ') without the words that are only
+            # punctuation (or empty)
+            punct = np.zeros(max(max_code + 1, 128), dtype=bool)
+            punct[[ord(c) for c in PUNCTUATION]] = True
+            content = np.zeros(length + 1, dtype=np.int64)
+            for start in range(0, length, CHUNK):
+                block = np.asarray(codes[start:start + CHUNK])
+                content[start + 1:start + 1 + len(block)] = \
+                    ~punct[block] & (block != sep)
+            np.cumsum(content, out=content)
+            keep = content[ends] - content[starts] > 0
+            starts = starts[keep]
+            ends = ends[keep]
+        index = np.memmap(index_path, dtype=np.int64, mode='w+',
+                          shape=(max(2 * len(starts), 1),))
+        index[:len(starts)] = starts
+        index[len(starts):2 * len(starts)] = ends
+        index.flush()
+        meta['items'] = len(starts)
+    del codes, index
+    with open(json_path, 'w') as f:
+        json.dump(meta, f)
+    for tmp_path, path in zip([codes_path, index_path, json_path],
+                              final_paths):
+        os.replace(tmp_path, path)
+    print('indexed {} characters'.format(length))
+
+
+class TextCorpus:
+    # Behaves like the str (mode 'chars') or list of str ('words'/'lines')
+    # TextData used to keep in memory
+    def __init__(self, textfile, mode='chars', build=True):
+        if build and not self.is_built(textfile, mode):
+            build_corpus(textfile, mode)
+        self.codes_path, self.index_path, json_path = _paths(textfile, mode)
+        with open(json_path) as f:
+            meta = json.load(f)
+        self.mode = mode
+        self.dtype = meta['dtype']
+        self.length = meta['length']
+        self.chars = meta['chars'] if mode == 'chars' else None
+        self.items = meta['items'] if mode != 'chars' else None
+        # opened lazily so each DataLoader worker maps the files itself
+        self.codes = None
+        self.index = None
+
+    @staticmethod
+    def is_built(textfile, mode='chars'):
+        codes_path, index_path, json_path = _paths(textfile, mode)
+        if not os.path.exists(json_path):
+            return False
+        with open(json_path) as f:
+            meta = json.load(f)
+        return meta['version'] == VERSION and meta['source'] == _source_stamp(
+            textfile)
+
+    def _open(self):
+        if self.length > 0:
+            self.codes = np.memmap(self.codes_path, dtype=self.dtype,
+                                   mode='r', shape=(self.length,))
+        else:
+            self.codes = np.zeros(0, self.dtype)
+        self.index = np.memmap(self.index_path, dtype=np.int64, mode='r')
+
+    def _decode(self, start, end):
+        if self.codes is None:
+            self._open()
+        return self.codes[start:end].astype('<u4').tobytes().decode('utf-32-le')
+
+    def __len__(self):
+        return self.length if self.items is None else self.items
+
+    def __getitem__(self, i):
+        if self.items is not None:
+            if self.index is None:
+                self._open()
+            if i < 0:
+                i += self.items
+            return self._decode(
+                self.index[i], self.index[self.items + i])
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            assert step == 1
+            return self._decode(start, max(start, stop))
+        if i < 0:
+            i += self.length
+        return self._decode(i, i + 1)
+
+    def window_with(self, char, length):
+        # start of a random window of length chars that has char in it
+        # (None if char is never in the text)
+        start, count = self.chars[char] if char in self.chars else (0, 0)
+        if count == 0:
+            return None
+        if self.index is None:
+            self._open()
+        pos = int(self.index[start + np.random.randint(count)])
+        lo = max(0, pos - length + 1)
+        hi = min(pos, self.length - length)
+        return np.random.randint(lo, hi + 1) if hi >= lo else max(hi, 0)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['codes'] = None
+        state['index'] = None
+        return state
+
+
+if __name__ == '__main__':
+    build_corpus(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'chars')